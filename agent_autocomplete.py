@@ -10,6 +10,15 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 import os
 import json
 import re
+import numpy as np
+import pandas as pd
+from write_buffer import WriteBuffer
+from change_plan import PlanCambios
+from sheets_backend import get_client
+from metrics import instrumentado, en_fase, fase, leer_valores
+from claves import Claves
+from normalizacion import normalizar_ctg, normalizar_cpe
+from registros import CartaPorte, Descarga, Pesada
 
 SCOPES = [
     'https://www.googleapis.com/auth/spreadsheets',
@@ -64,6 +73,17 @@ CONFIG = {
     'CPE_COL_DESTINO': 22,           # localidad_destino
 }
 
+# Campos de Fletes que completa el agente: (nombre, clave de CONFIG con su columna)
+CAMPOS_FLETES = [
+    ('producto', 'FLETES_COL_PRODUCTO'),
+    ('origen', 'FLETES_COL_ORIGEN'),
+    ('destino', 'FLETES_COL_DESTINO'),
+    ('transportista', 'FLETES_COL_TRANSPORTISTA'),
+    ('chofer', 'FLETES_COL_CHOFER'),
+    ('m_pesadas', 'FLETES_COL_M_PESADAS'),
+    ('m_descargas', 'FLETES_COL_M_DESCARGAS'),
+]
+
 # Color gris para datos autocompletados
 COLOR_GRIS = {'red': 0.5, 'green': 0.5, 'blue': 0.5}
 
@@ -106,48 +126,35 @@ def get_credentials():
     return creds
 
 
-def normalizar_cpe(cpe):
-    """Normaliza número de CPE para comparación"""
-    if not cpe:
-        return ''
-    return str(cpe).strip().upper().replace(' ', '')
-
-
-def normalizar_ctg(ctg):
-    """Normaliza CTG para comparación"""
-    if not ctg:
-        return ''
-    # Remover ceros a la izquierda y espacios
-    return str(ctg).strip().lstrip('0')
-
-
+@en_fase('parseo')
 def cargar_datos_pesadas(gc):
     """Carga datos de Pesadas indexados por CPE"""
     ss = gc.open_by_key(CONFIG['PESADAS_SPREADSHEET_ID'])
     hoja = ss.worksheet(CONFIG['PESADAS_SHEET'])
-    datos = hoja.get_all_values()
+    datos = leer_valores(hoja)
 
     pesadas_por_cpe = {}
     for fila in datos[1:]:
         if len(fila) > CONFIG['PESADAS_COL_CPE']:
             cpe = normalizar_cpe(fila[CONFIG['PESADAS_COL_CPE']] if len(fila) > CONFIG['PESADAS_COL_CPE'] else '')
             if cpe:
-                pesadas_por_cpe[cpe] = {
-                    'neto': fila[CONFIG['PESADAS_COL_NETO']] if len(fila) > CONFIG['PESADAS_COL_NETO'] else '',
-                    'origen': fila[CONFIG['PESADAS_COL_ORIGEN']] if len(fila) > CONFIG['PESADAS_COL_ORIGEN'] else '',
-                    'transportista': fila[CONFIG['PESADAS_COL_TRANSPORTISTA']] if len(fila) > CONFIG['PESADAS_COL_TRANSPORTISTA'] else '',
-                    'chofer': fila[CONFIG['PESADAS_COL_CHOFER']] if len(fila) > CONFIG['PESADAS_COL_CHOFER'] else '',
-                    'producto': fila[CONFIG['PESADAS_COL_PRODUCTO']] if len(fila) > CONFIG['PESADAS_COL_PRODUCTO'] else '',
-                }
+                pesadas_por_cpe[cpe] = Pesada(
+                    neto=fila[CONFIG['PESADAS_COL_NETO']] if len(fila) > CONFIG['PESADAS_COL_NETO'] else '',
+                    origen=fila[CONFIG['PESADAS_COL_ORIGEN']] if len(fila) > CONFIG['PESADAS_COL_ORIGEN'] else '',
+                    transportista=fila[CONFIG['PESADAS_COL_TRANSPORTISTA']] if len(fila) > CONFIG['PESADAS_COL_TRANSPORTISTA'] else '',
+                    chofer=fila[CONFIG['PESADAS_COL_CHOFER']] if len(fila) > CONFIG['PESADAS_COL_CHOFER'] else '',
+                    producto=fila[CONFIG['PESADAS_COL_PRODUCTO']] if len(fila) > CONFIG['PESADAS_COL_PRODUCTO'] else '',
+                )
 
     return pesadas_por_cpe
 
 
+@en_fase('parseo')
 def cargar_datos_descargas(gc):
     """Carga datos de Descargas indexados por CTG y CPE"""
     ss = gc.open_by_key(CONFIG['CPE_SPREADSHEET_ID'])
     hoja = ss.worksheet(CONFIG['DESCARGAS_SHEET'])
-    datos = hoja.get_all_values()
+    datos = leer_valores(hoja)
 
     descargas_por_ctg = {}
     descargas_por_cpe = {}
@@ -156,12 +163,15 @@ def cargar_datos_descargas(gc):
         ctg = normalizar_ctg(fila[CONFIG['DESCARGAS_COL_CTG']] if len(fila) > CONFIG['DESCARGAS_COL_CTG'] else '')
         cpe = normalizar_cpe(fila[CONFIG['DESCARGAS_COL_CPE']] if len(fila) > CONFIG['DESCARGAS_COL_CPE'] else '')
 
-        registro = {
-            'peso_neto': fila[CONFIG['DESCARGAS_COL_PESO_NETO']] if len(fila) > CONFIG['DESCARGAS_COL_PESO_NETO'] else '',
-            'origen': fila[CONFIG['DESCARGAS_COL_ORIGEN']] if len(fila) > CONFIG['DESCARGAS_COL_ORIGEN'] else '',
-            'transportista': fila[CONFIG['DESCARGAS_COL_TRANSPORTISTA']] if len(fila) > CONFIG['DESCARGAS_COL_TRANSPORTISTA'] else '',
-            'producto': fila[CONFIG['DESCARGAS_COL_PRODUCTO']] if len(fila) > CONFIG['DESCARGAS_COL_PRODUCTO'] else '',
-        }
+        if not ctg and not cpe:
+            continue
+
+        registro = Descarga(
+            peso_neto=fila[CONFIG['DESCARGAS_COL_PESO_NETO']] if len(fila) > CONFIG['DESCARGAS_COL_PESO_NETO'] else '',
+            origen=fila[CONFIG['DESCARGAS_COL_ORIGEN']] if len(fila) > CONFIG['DESCARGAS_COL_ORIGEN'] else '',
+            transportista=fila[CONFIG['DESCARGAS_COL_TRANSPORTISTA']] if len(fila) > CONFIG['DESCARGAS_COL_TRANSPORTISTA'] else '',
+            producto=fila[CONFIG['DESCARGAS_COL_PRODUCTO']] if len(fila) > CONFIG['DESCARGAS_COL_PRODUCTO'] else '',
+        )
 
         if ctg:
             descargas_por_ctg[ctg] = registro
@@ -171,11 +181,12 @@ def cargar_datos_descargas(gc):
     return descargas_por_ctg, descargas_por_cpe
 
 
+@en_fase('parseo')
 def cargar_datos_cpe(gc):
     """Carga datos de Cartas de Porte indexados por número CPE y CTG"""
     ss = gc.open_by_key(CONFIG['CPE_SPREADSHEET_ID'])
     hoja = ss.worksheet(CONFIG['CPE_SHEET'])
-    datos = hoja.get_all_values()
+    datos = leer_valores(hoja)
 
     cpe_por_numero = {}
     cpe_por_ctg = {}
@@ -184,15 +195,18 @@ def cargar_datos_cpe(gc):
         ctg = normalizar_ctg(fila[CONFIG['CPE_COL_CTG']] if len(fila) > CONFIG['CPE_COL_CTG'] else '')
         numero_cpe = normalizar_cpe(fila[CONFIG['CPE_COL_NUMERO_CPE']] if len(fila) > CONFIG['CPE_COL_NUMERO_CPE'] else '')
 
-        registro = {
-            'ctg': ctg,
-            'numero_cpe': numero_cpe,
-            'transportista': fila[CONFIG['CPE_COL_TRANSPORTISTA']] if len(fila) > CONFIG['CPE_COL_TRANSPORTISTA'] else '',
-            'chofer': fila[CONFIG['CPE_COL_CHOFER']] if len(fila) > CONFIG['CPE_COL_CHOFER'] else '',
-            'producto': fila[CONFIG['CPE_COL_PRODUCTO']] if len(fila) > CONFIG['CPE_COL_PRODUCTO'] else '',
-            'origen': fila[CONFIG['CPE_COL_ORIGEN']] if len(fila) > CONFIG['CPE_COL_ORIGEN'] else '',
-            'destino': fila[CONFIG['CPE_COL_DESTINO']] if len(fila) > CONFIG['CPE_COL_DESTINO'] else '',
-        }
+        if not ctg and not numero_cpe:
+            continue
+
+        registro = CartaPorte(
+            numero_cpe=numero_cpe,
+            ctg=ctg,
+            transportista=fila[CONFIG['CPE_COL_TRANSPORTISTA']] if len(fila) > CONFIG['CPE_COL_TRANSPORTISTA'] else '',
+            chofer=fila[CONFIG['CPE_COL_CHOFER']] if len(fila) > CONFIG['CPE_COL_CHOFER'] else '',
+            producto=fila[CONFIG['CPE_COL_PRODUCTO']] if len(fila) > CONFIG['CPE_COL_PRODUCTO'] else '',
+            origen=fila[CONFIG['CPE_COL_ORIGEN']] if len(fila) > CONFIG['CPE_COL_ORIGEN'] else '',
+            destino=fila[CONFIG['CPE_COL_DESTINO']] if len(fila) > CONFIG['CPE_COL_DESTINO'] else '',
+        )
 
         if numero_cpe:
             cpe_por_numero[numero_cpe] = registro
@@ -202,77 +216,88 @@ def cargar_datos_cpe(gc):
     return cpe_por_numero, cpe_por_ctg
 
 
+# Prioridad de fuentes por campo: (fuente, clave de búsqueda, atributo).
+# PRIORIDAD: Siempre buscar primero por CTG en CPE (Cartas de Porte).
+PRIORIDADES = {
+    # CPE por CTG (localidad_origen) -> Descargas -> Pesadas
+    'origen': [('cpe_por_ctg', 'ctg', 'origen'), ('cpe_data', 'cpe', 'origen'),
+               ('descargas_ctg', 'ctg', 'origen'), ('pesadas', 'cpe', 'origen')],
+    # CPE por CTG (localidad_destino)
+    'destino': [('cpe_por_ctg', 'ctg', 'destino'), ('cpe_data', 'cpe', 'destino')],
+    # CPE por CTG (grano_tipo) -> Descargas -> Pesadas
+    'producto': [('cpe_por_ctg', 'ctg', 'producto'), ('cpe_data', 'cpe', 'producto'),
+                 ('descargas_ctg', 'ctg', 'producto'), ('pesadas', 'cpe', 'producto')],
+    # CPE por CTG -> Pesadas
+    'chofer': [('cpe_por_ctg', 'ctg', 'chofer'), ('cpe_data', 'cpe', 'chofer'),
+               ('pesadas', 'cpe', 'chofer')],
+    # CPE por CTG -> Pesadas -> Descargas
+    'transportista': [('cpe_por_ctg', 'ctg', 'transportista'), ('cpe_data', 'cpe', 'transportista'),
+                      ('pesadas', 'cpe', 'transportista'), ('descargas_ctg', 'ctg', 'transportista')],
+    # Solo de Pesadas (por CPE)
+    'm_pesadas': [('pesadas', 'cpe', 'neto')],
+    # Solo de Descargas (por CTG, y si no por CPE)
+    'm_descargas': [('descargas_ctg', 'ctg', 'peso_neto'), ('descargas_cpe', 'cpe', 'peso_neto')],
+}
+
+# Campos donde también se corrige la capitalización si el valor no coincide exactamente
+CAMPOS_CORREGIBLES = ('transportista', 'origen')
+
+
+def construir_tablas(pesadas, descargas_ctg, descargas_cpe, cpe_data, cpe_por_ctg):
+    """
+    Precalcula, para cada campo, la lista de tablas en orden de prioridad.
+    Los CTG y números de CPE se convierten a ids enteros (claves.Claves) y cada tabla es
+    un array indexado por id; solo se guardan valores no vacíos, así None significa
+    "seguir con la próxima fuente". Retorna (claves, tablas).
+    """
+    fuentes = {
+        'pesadas': pesadas,
+        'descargas_ctg': descargas_ctg,
+        'descargas_cpe': descargas_cpe,
+        'cpe_data': cpe_data,
+        'cpe_por_ctg': cpe_por_ctg,
+    }
+    claves = Claves()
+    tabla_claves = {'ctg': claves.ctgs, 'cpe': claves.cpes}
+
+    # Primero se asignan todos los ids, así todas las tablas tienen el mismo largo
+    ids = {}
+    for prioridad in PRIORIDADES.values():
+        for fuente, clave, _ in prioridad:
+            if fuente not in ids:
+                ids[fuente] = [(tabla_claves[clave].id(k), reg) for k, reg in fuentes[fuente].items()]
+
+    tablas = {}
+    for campo, prioridad in PRIORIDADES.items():
+        tablas[campo] = [
+            (clave, tabla_claves[clave].arreglo({i: getattr(reg, atributo) for i, reg in ids[fuente]
+                                                 if i >= 0 and getattr(reg, atributo)}))
+            for fuente, clave, atributo in prioridad
+        ]
+    return claves, tablas
+
+
 def buscar_dato(campo, ctg, cpe, pesadas, descargas_ctg, descargas_cpe, cpe_data, cpe_por_ctg):
     """
-    Busca un dato faltante en las hojas vinculadas.
+    Busca un dato faltante en las hojas vinculadas (una sola fila).
     Retorna el valor encontrado o None.
     PRIORIDAD: Siempre buscar primero por CTG en CPE (Cartas de Porte).
     """
-    ctg_norm = normalizar_ctg(ctg)
-    cpe_norm = normalizar_cpe(cpe)
+    claves = {'ctg': normalizar_ctg(ctg), 'cpe': normalizar_cpe(cpe)}
+    fuentes = {
+        'pesadas': pesadas,
+        'descargas_ctg': descargas_ctg,
+        'descargas_cpe': descargas_cpe,
+        'cpe_data': cpe_data,
+        'cpe_por_ctg': cpe_por_ctg,
+    }
 
     valor = None
-
-    if campo == 'origen':
-        # PRIORIDAD: CPE por CTG (localidad_origen) -> Descargas -> Pesadas
-        if ctg_norm and ctg_norm in cpe_por_ctg:
-            valor = cpe_por_ctg[ctg_norm].get('origen')
-        if not valor and cpe_norm and cpe_norm in cpe_data:
-            valor = cpe_data[cpe_norm].get('origen')
-        if not valor and ctg_norm and ctg_norm in descargas_ctg:
-            valor = descargas_ctg[ctg_norm].get('origen')
-        if not valor and cpe_norm and cpe_norm in pesadas:
-            valor = pesadas[cpe_norm].get('origen')
-
-    elif campo == 'destino':
-        # PRIORIDAD: CPE por CTG (localidad_destino)
-        if ctg_norm and ctg_norm in cpe_por_ctg:
-            valor = cpe_por_ctg[ctg_norm].get('destino')
-        if not valor and cpe_norm and cpe_norm in cpe_data:
-            valor = cpe_data[cpe_norm].get('destino')
-
-    elif campo == 'producto':
-        # PRIORIDAD: CPE por CTG (grano_tipo) -> Descargas -> Pesadas
-        if ctg_norm and ctg_norm in cpe_por_ctg:
-            valor = cpe_por_ctg[ctg_norm].get('producto')
-        if not valor and cpe_norm and cpe_norm in cpe_data:
-            valor = cpe_data[cpe_norm].get('producto')
-        if not valor and ctg_norm and ctg_norm in descargas_ctg:
-            valor = descargas_ctg[ctg_norm].get('producto')
-        if not valor and cpe_norm and cpe_norm in pesadas:
-            valor = pesadas[cpe_norm].get('producto')
-
-    elif campo == 'chofer':
-        # PRIORIDAD: CPE por CTG -> Pesadas
-        if ctg_norm and ctg_norm in cpe_por_ctg:
-            valor = cpe_por_ctg[ctg_norm].get('chofer')
-        if not valor and cpe_norm and cpe_norm in cpe_data:
-            valor = cpe_data[cpe_norm].get('chofer')
-        if not valor and cpe_norm and cpe_norm in pesadas:
-            valor = pesadas[cpe_norm].get('chofer')
-
-    elif campo == 'transportista':
-        # PRIORIDAD: CPE por CTG -> Pesadas -> Descargas
-        if ctg_norm and ctg_norm in cpe_por_ctg:
-            valor = cpe_por_ctg[ctg_norm].get('transportista')
-        if not valor and cpe_norm and cpe_norm in cpe_data:
-            valor = cpe_data[cpe_norm].get('transportista')
-        if not valor and cpe_norm and cpe_norm in pesadas:
-            valor = pesadas[cpe_norm].get('transportista')
-        if not valor and ctg_norm and ctg_norm in descargas_ctg:
-            valor = descargas_ctg[ctg_norm].get('transportista')
-
-    elif campo == 'm_pesadas':
-        # Solo de Pesadas (por CPE)
-        if cpe_norm and cpe_norm in pesadas:
-            valor = pesadas[cpe_norm].get('neto')
-
-    elif campo == 'm_descargas':
-        # Solo de Descargas (por CTG)
-        if ctg_norm and ctg_norm in descargas_ctg:
-            valor = descargas_ctg[ctg_norm].get('peso_neto')
-        if not valor and cpe_norm and cpe_norm in descargas_cpe:
-            valor = descargas_cpe[cpe_norm].get('peso_neto')
+    for fuente, clave, atributo in PRIORIDADES.get(campo, []):
+        if claves[clave] and claves[clave] in fuentes[fuente]:
+            valor = getattr(fuentes[fuente][claves[clave]], atributo)
+        if valor:
+            break
 
     # Limpiar valor
     if valor and str(valor).strip():
@@ -281,132 +306,158 @@ def buscar_dato(campo, ctg, cpe, pesadas, descargas_ctg, descargas_cpe, cpe_data
     return None
 
 
-def ejecutar_autocompletado():
+def planificar_autocompletado(datos_fletes, claves, tablas, campos):
+    """
+    Calcula todos los campos a completar en una sola pasada vectorizada.
+    Convierte CTG/CPE a ids una vez por valor distinto y resuelve cada campo indexando
+    las tablas precalculadas (construir_tablas), respetando el orden de prioridad de fuentes.
+    Retorna (cambios, estadisticas); cambios es una lista de
+    (fila, columna_base1, valor, valor_anterior, motivo).
+    """
+    filas = datos_fletes[1:]
+    if not filas:
+        return [], {'campos_completados': 0, 'transportistas_corregidos': 0, 'filas_procesadas': 0}
+
+    max_col = max([CONFIG['FLETES_COL_CTG'], CONFIG['FLETES_COL_CPE']] + [col for _, col in campos])
+    df = pd.DataFrame(filas).reindex(columns=range(max_col + 1)).fillna('').astype(str)
+    df.index = range(2, len(df) + 2)  # número de fila en la hoja (encabezado = 1)
+
+    ctg_raw = df[CONFIG['FLETES_COL_CTG']]
+    cpe_raw = df[CONFIG['FLETES_COL_CPE']]
+
+    # Saltar filas sin CTG ni CPE (no hay forma de vincular)
+    df = df[(ctg_raw != '') | (cpe_raw != '')]
+    ids = {
+        'ctg': claves.ctgs.ids(df[CONFIG['FLETES_COL_CTG']]),
+        'cpe': claves.cpes.ids(df[CONFIG['FLETES_COL_CPE']]),
+    }
+
+    cambios = []
+    campos_completados = 0
+    transportistas_corregidos = 0
+    filas_modificadas = pd.Series(False, index=df.index)
+
+    for campo_nombre, col_idx in campos:
+        # Mejor valor disponible según prioridad de fuentes
+        valor = np.full(len(df), None, dtype=object)
+        for clave, tabla in tablas[campo_nombre]:
+            faltan = pd.isna(valor)
+            if not faltan.any():
+                break
+            valor[faltan] = tabla[ids[clave][faltan]]
+
+        valor = pd.Series(valor, index=df.index).dropna().astype(str).str.strip()
+        valor = valor[valor != '']
+        if valor.empty:
+            continue
+
+        actual = df.loc[valor.index, col_idx].str.strip()
+        vacio = actual == ''
+
+        if campo_nombre in CAMPOS_CORREGIBLES:
+            # Mismo texto pero diferente capitalización, corregir
+            corregir = ~vacio & (actual != valor) & (actual.str.upper() == valor.str.upper())
+        else:
+            corregir = pd.Series(False, index=valor.index)
+
+        escribir = vacio | corregir
+        for fila, nuevo in valor[escribir].items():
+            motivo = 'completar' if vacio[fila] else 'corregir_mayusculas'
+            cambios.append((fila, col_idx + 1, nuevo, df.at[fila, col_idx], f"{motivo}:{campo_nombre}"))
+
+        if campo_nombre == 'transportista':
+            campos_completados += int(vacio.sum())
+            transportistas_corregidos += int(corregir.sum())
+        else:
+            campos_completados += int(escribir.sum())
+        filas_modificadas[escribir[escribir].index] = True
+
+    cambios.sort()
+    estadisticas = {
+        'campos_completados': campos_completados,
+        'transportistas_corregidos': transportistas_corregidos,
+        'filas_procesadas': int(filas_modificadas.sum())
+    }
+    return cambios, estadisticas
+
+
+@instrumentado('ejecutar_autocompletado')
+def ejecutar_autocompletado(progreso=None, dry_run=False):
     """
     Ejecuta el autocompletado de campos vacíos en Fletes.
     Escribe los valores encontrados con formato de texto gris.
+    El avance se informa llamando progreso(etapa, mensaje) si se pasa un callback.
+    Con dry_run=True no escribe nada y devuelve el plan de cambios en 'plan'.
     """
+    def reportar(etapa, mensaje):
+        if progreso:
+            progreso(etapa, mensaje)
+
     try:
-        creds = get_credentials()
-        gc = gspread.authorize(creds)
+        gc = get_client(get_credentials)
 
-        print("Cargando datos de hojas vinculadas...")
+        reportar('carga', "Cargando datos de hojas vinculadas...")
 
         # Cargar datos de referencia
         pesadas = cargar_datos_pesadas(gc)
         descargas_ctg, descargas_cpe = cargar_datos_descargas(gc)
         cpe_data, cpe_por_ctg = cargar_datos_cpe(gc)
 
-        print(f"  - Pesadas: {len(pesadas)} registros")
-        print(f"  - Descargas: {len(descargas_ctg)} por CTG, {len(descargas_cpe)} por CPE")
-        print(f"  - CPE: {len(cpe_data)} por número, {len(cpe_por_ctg)} por CTG")
+        reportar('carga', f"Pesadas: {len(pesadas)} registros, "
+                          f"Descargas: {len(descargas_ctg)} por CTG / {len(descargas_cpe)} por CPE, "
+                          f"CPE: {len(cpe_data)} por número / {len(cpe_por_ctg)} por CTG")
+
+        # Mejor valor por campo y por CTG/CPE, en orden de prioridad
+        with fase('parseo'):
+            claves, tablas = construir_tablas(pesadas, descargas_ctg, descargas_cpe, cpe_data, cpe_por_ctg)
 
         # Cargar Fletes
         ss = gc.open_by_key(CONFIG['CPE_SPREADSHEET_ID'])
         hoja_fletes = ss.worksheet(CONFIG['FLETES_SHEET'])
-        datos_fletes = hoja_fletes.get_all_values()
+        datos_fletes = leer_valores(hoja_fletes)
 
-        print(f"Procesando {len(datos_fletes) - 1} filas de Fletes...")
+        reportar('proceso', f"Procesando {len(datos_fletes) - 1} filas de Fletes...")
 
         # Campos a autocompletar: (nombre, columna_fletes)
-        campos = [
-            ('producto', CONFIG['FLETES_COL_PRODUCTO']),
-            ('origen', CONFIG['FLETES_COL_ORIGEN']),
-            ('destino', CONFIG['FLETES_COL_DESTINO']),
-            ('transportista', CONFIG['FLETES_COL_TRANSPORTISTA']),
-            ('chofer', CONFIG['FLETES_COL_CHOFER']),
-            ('m_pesadas', CONFIG['FLETES_COL_M_PESADAS']),
-            ('m_descargas', CONFIG['FLETES_COL_M_DESCARGAS']),
-        ]
-
-        actualizaciones = []
-        formatos = []
-        campos_completados = 0
-        filas_procesadas = 0
-
-        transportistas_corregidos = 0
-
-        for idx, fila in enumerate(datos_fletes[1:], start=2):  # start=2 por encabezado
-            ctg = fila[CONFIG['FLETES_COL_CTG']] if len(fila) > CONFIG['FLETES_COL_CTG'] else ''
-            cpe = fila[CONFIG['FLETES_COL_CPE']] if len(fila) > CONFIG['FLETES_COL_CPE'] else ''
-
-            # Saltar filas sin CTG ni CPE (no hay forma de vincular)
-            if not ctg and not cpe:
-                continue
-
-            fila_modificada = False
-
-            for campo_nombre, col_idx in campos:
-                valor_actual = fila[col_idx] if len(fila) > col_idx else ''
-                valor_actual_str = str(valor_actual).strip() if valor_actual else ''
-
-                # Buscar el valor correcto en las hojas vinculadas
-                valor_nuevo = buscar_dato(
-                    campo_nombre, ctg, cpe,
-                    pesadas, descargas_ctg, descargas_cpe,
-                    cpe_data, cpe_por_ctg
-                )
-
-                if not valor_nuevo:
-                    continue
-
-                # Para TRANSPORTISTA y ORIGEN: también corregir si no coincide exactamente
-                if campo_nombre in ('transportista', 'origen'):
-                    if not valor_actual_str:
-                        # Está vacío, completar
-                        celda = gspread.utils.rowcol_to_a1(idx, col_idx + 1)
-                        actualizaciones.append({'range': celda, 'values': [[valor_nuevo]]})
-                        formatos.append(celda)
-                        campos_completados += 1
-                        fila_modificada = True
-                    elif valor_actual_str != valor_nuevo and valor_actual_str.upper() == valor_nuevo.upper():
-                        # Mismo texto pero diferente capitalización, corregir
-                        celda = gspread.utils.rowcol_to_a1(idx, col_idx + 1)
-                        actualizaciones.append({'range': celda, 'values': [[valor_nuevo]]})
-                        formatos.append(celda)
-                        if campo_nombre == 'transportista':
-                            transportistas_corregidos += 1
-                        else:
-                            campos_completados += 1
-                        fila_modificada = True
-                else:
-                    # Para otros campos: solo completar si está vacío
-                    if not valor_actual_str:
-                        celda = gspread.utils.rowcol_to_a1(idx, col_idx + 1)
-                        actualizaciones.append({'range': celda, 'values': [[valor_nuevo]]})
-                        formatos.append(celda)
-                        campos_completados += 1
-                        fila_modificada = True
-
-            if fila_modificada:
-                filas_procesadas += 1
-
-        print(f"Encontrados {campos_completados} campos para completar, {transportistas_corregidos} transportistas corregidos, en {filas_procesadas} filas")
-
-        # Aplicar actualizaciones en batch
-        if actualizaciones:
-            print("Escribiendo datos...")
-            hoja_fletes.batch_update(actualizaciones)
-
-            # Aplicar formato gris a las celdas actualizadas
-            print("Aplicando formato gris...")
-            for celda in formatos:
-                try:
-                    hoja_fletes.format(celda, {
-                        'textFormat': {
-                            'foregroundColor': COLOR_GRIS
-                        }
-                    })
-                except Exception as e:
-                    print(f"  Error formateando {celda}: {e}")
-
-        print("Autocompletado finalizado.")
+        campos = [(nombre, CONFIG[clave]) for nombre, clave in CAMPOS_FLETES]
+
+        cambios, estadisticas = planificar_autocompletado(datos_fletes, claves, tablas, campos)
+        campos_completados = estadisticas['campos_completados']
+        transportistas_corregidos = estadisticas['transportistas_corregidos']
+        filas_procesadas = estadisticas['filas_procesadas']
+
+        plan = PlanCambios('autocompletado')
+        for fila, col, valor, anterior, motivo in cambios:
+            plan.agregar(hoja_fletes, fila, col, anterior, valor, motivo,
+                         formato={'textFormat': {'foregroundColor': COLOR_GRIS}})
+
+        reportar('proceso', f"Encontrados {campos_completados} campos para completar, "
+                            f"{transportistas_corregidos} transportistas corregidos, en {filas_procesadas} filas")
+
+        # Valores y formato gris: el buffer agrupa por columna y filas contiguas,
+        # así el formato sale en una sola batchUpdate con requests repeatCell
+        resumen = {'requests': 0, 'errores_formato': []}
+        extra = {'cambios_planeados': len(plan), 'dry_run': dry_run}
+        if dry_run:
+            extra['plan'] = plan.to_dict()
+            extra['resumen_plan'] = plan.resumen()
+            reportar('escritura', f"Dry-run: {len(plan)} cambios planeados, no se escribió nada")
+        elif cambios:
+            buffer = WriteBuffer()
+            plan.aplicar(buffer)
+            resumen = buffer.flush(progreso=lambda hechas, total: reportar(
+                'escritura', f"Request {hechas}/{total} enviada"))
+
+        reportar('fin', "Autocompletado finalizado.")
 
         return {
+            **extra,
             'success': True,
             'campos_completados': campos_completados,
             'transportistas_corregidos': transportistas_corregidos,
             'filas_procesadas': filas_procesadas,
+            'requests_escritura': resumen['requests'],
+            'errores_formato': resumen['errores_formato'],
             'detalles': {
                 'pesadas_referencia': len(pesadas),
                 'descargas_referencia': len(descargas_ctg),
@@ -415,7 +466,7 @@ def ejecutar_autocompletado():
         }
 
     except Exception as e:
-        print(f"Error en autocompletado: {e}")
+        reportar('error', f"Error en autocompletado: {e}")
         return {
             'success': False,
             'error': str(e),
@@ -428,7 +479,7 @@ if __name__ == '__main__':
     print("=" * 50)
     print("Agente Autocompletador de Fletes")
     print("=" * 50)
-    resultado = ejecutar_autocompletado()
+    resultado = ejecutar_autocompletado(progreso=lambda etapa, mensaje: print(f"[{etapa}] {mensaje}"))
     print("\nResultado:")
     print(f"  Éxito: {resultado['success']}")
     print(f"  Campos completados: {resultado['campos_completados']}")
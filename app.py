@@ -3,7 +3,7 @@ Asignador de CPEs a Pesadas
 Match por: Patente + Fecha
 """
 
-from flask import Flask, render_template, jsonify
+from flask import Flask, render_template, jsonify, request, Response, stream_with_context
 from flask_cors import CORS
 import gspread
 from google.oauth2.credentials import Credentials
@@ -11,8 +11,19 @@ from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 import os
 import json
-import re
+import hashlib
+import hmac
+import secrets
+import time
 from datetime import datetime
+from write_buffer import WriteBuffer
+from change_plan import PlanCambios
+from sheets_backend import get_client, leer_hojas
+from metrics import instrumentado, en_fase, fase, leer_valores, prometheus
+from data_loader import data_loader
+from claves import Claves
+from normalizacion import normalizar_patente, extraer_patentes, normalizar_fecha, normalizar_producto
+from registros import CartaPorte
 
 app = Flask(__name__)
 CORS(app)
@@ -57,11 +68,33 @@ CONFIG = {
     'DESCARGAS_COL_PESO_NETO': 16, # Q: Peso Neto
 }
 
+# Encabezado de Fletes que corresponde a cada constante FLETES_COL_*
+FLETES_ENCABEZADOS = {
+    'FLETES_COL_CANTIDAD': 'Cantidad',
+    'FLETES_COL_CTG': 'CTG',
+    'FLETES_COL_CPE': 'CPE',
+    'FLETES_COL_NETO_PESADAS': 'M Pesadas todos',
+    'FLETES_COL_M_CPES': "M CPE's",
+    'FLETES_COL_NETO_DESCARGAS': 'M Descargas todos',
+}
+
+# Clave con la que /dry-run firma los planes que después acepta /aplicar-plan. Con
+# preload_app (gunicorn.conf.py) la generan el proceso maestro y la heredan todos los
+# workers; sin preload, o con varias instancias, configurar PLANES_SECRETO.
+SECRETO_PLANES = os.environ.get('PLANES_SECRETO', '').encode('utf-8') or secrets.token_bytes(32)
+
+# Segundos durante los que se puede aplicar un plan firmado
+VIGENCIA_PLANES = int(os.environ.get('PLANES_VIGENCIA', '3600'))
+
 SCOPES = [
     'https://www.googleapis.com/auth/spreadsheets',
     'https://www.googleapis.com/auth/drive'
 ]
 
+# Colores de fondo para celdas escritas por los procesadores
+COLOR_VERDE = {'red': 0.71, 'green': 0.84, 'blue': 0.66}
+COLOR_ROJO = {'red': 0.92, 'green': 0.6, 'blue': 0.6}
+
 
 def get_credentials():
     """Obtiene credenciales de Google OAuth"""
@@ -102,79 +135,9 @@ def get_credentials():
     return creds
 
 
-def normalizar_patente(patente):
-    """Normaliza patente eliminando espacios, guiones y puntos"""
-    if not patente:
-        return ''
-    return str(patente).strip().upper().replace(' ', '').replace('-', '').replace('.', '')
-
-
-def extraer_patentes_de_array(patente_str):
-    """
-    Extrae patentes de un string que puede ser:
-    - Un array JSON: '["ABC123","DEF456"]'
-    - Una patente simple: 'ABC 123'
-    Retorna lista de patentes normalizadas
-    """
-    if not patente_str:
-        return []
-
-    patente_str = str(patente_str).strip()
-    patentes = []
-
-    # Intentar parsear como JSON array
-    if patente_str.startswith('['):
-        try:
-            lista = json.loads(patente_str)
-            for p in lista:
-                norm = normalizar_patente(p)
-                if norm:
-                    patentes.append(norm)
-        except json.JSONDecodeError:
-            # Si falla el JSON, intentar extraer con regex
-            matches = re.findall(r'"([^"]+)"', patente_str)
-            for m in matches:
-                norm = normalizar_patente(m)
-                if norm:
-                    patentes.append(norm)
-    else:
-        # Es una patente simple
-        norm = normalizar_patente(patente_str)
-        if norm:
-            patentes.append(norm)
-
-    return patentes
-
-
-def normalizar_fecha(fecha):
-    """Normaliza fecha a formato YYYY-MM-DD para comparación"""
-    if not fecha:
-        return ''
-
-    # Si ya es datetime
-    if isinstance(fecha, datetime):
-        return fecha.strftime('%Y-%m-%d')
-
-    # Intentar parsear string
-    fecha_str = str(fecha).strip()
-
-    # Probar diferentes formatos
-    formatos = [
-        '%Y-%m-%d',
-        '%d/%m/%Y',
-        '%d-%m-%Y',
-        '%Y/%m/%d',
-        '%d/%m/%y',
-    ]
-
-    for fmt in formatos:
-        try:
-            dt = datetime.strptime(fecha_str, fmt)
-            return dt.strftime('%Y-%m-%d')
-        except ValueError:
-            continue
-
-    return fecha_str
+def columnas_fletes_esperadas():
+    """Índices de Fletes según CONFIG, por nombre de encabezado (para validar contra la hoja)"""
+    return {encabezado: CONFIG[clave] for clave, encabezado in FLETES_ENCABEZADOS.items()}
 
 
 def parse_number(value):
@@ -192,35 +155,23 @@ def parse_number(value):
         return None
 
 
-def normalizar_producto(producto):
-    """Normaliza el nombre del producto para comparación (soja, maiz, trigo, etc)"""
-    if not producto:
-        return ''
-    prod = str(producto).strip().lower()
-    # Normalizar variantes comunes
-    if 'soja' in prod or 'soya' in prod:
-        return 'soja'
-    if 'maiz' in prod or 'maíz' in prod:
-        return 'maiz'
-    if 'trigo' in prod:
-        return 'trigo'
-    if 'girasol' in prod:
-        return 'girasol'
-    if 'cebada' in prod:
-        return 'cebada'
-    if 'sorgo' in prod:
-        return 'sorgo'
-    return prod
-
-
+@en_fase('parseo')
 def cargar_cpes(gc):
     """Carga todos los CPE con sus datos - indexado por patente, guardando TODOS los CPEs (lista)"""
     ss = gc.open_by_key(CONFIG['CPE_SPREADSHEET_ID'])
     hoja = ss.worksheet(CONFIG['CPE_SHEET_NAME'])
-    datos = hoja.get_all_values()
+    return cpes_por_patente(leer_valores(hoja), Claves())
 
-    # Diccionario: patente -> [lista de {numero_cpe, fecha, ctg, grano_tipo}]
-    cpes = {}
+
+def cpes_por_patente(datos, claves):
+    """
+    Indexa las filas crudas de la hoja CPE (con encabezado) por patente.
+    Retorna una lista indexada por id de patente (claves.patentes) con la lista de
+    CartaPorte de cada una (numero_cpe, ctg, fecha, grano_tipo e id en claves.cpes).
+    El último lugar queda vacío para que buscar con id -1 no necesite chequeo.
+    """
+    cpes = []
+    vistos = set()  # (id patente, id cpe): cada CPE una sola vez por patente
 
     # Saltar encabezado
     for fila in datos[1:]:
@@ -235,24 +186,27 @@ def cargar_cpes(gc):
 
         if not numero_cpe or not patente_raw:
             continue
+        id_cpe = claves.cpes.id(numero_cpe)
+        if id_cpe < 0:
+            continue
 
-        fecha_norm = normalizar_fecha(fecha)
-        ctg_norm = ctg.strip() if ctg else ''
-        grano_norm = normalizar_producto(grano_tipo)
-
-        # Extraer todas las patentes del array (camión + acoplado)
-        patentes = extraer_patentes_de_array(patente_raw)
+        # Ids de todas las patentes del array (camión + acoplado)
+        ids_patentes = claves.ids_patentes(patente_raw)
+        if not ids_patentes:
+            continue
 
         # Crear una entrada por cada patente (guardando TODOS los CPEs en lista)
-        cpe_data = {'numero_cpe': numero_cpe, 'fecha': fecha_norm, 'ctg': ctg_norm, 'grano_tipo': grano_norm}
-        for patente_norm in patentes:
-            if patente_norm:
-                if patente_norm not in cpes:
-                    cpes[patente_norm] = []
-                # Evitar duplicados (mismo numero_cpe)
-                if not any(c['numero_cpe'] == numero_cpe for c in cpes[patente_norm]):
-                    cpes[patente_norm].append(cpe_data)
+        cpe_data = CartaPorte(numero_cpe=numero_cpe, ctg=ctg.strip() if ctg else '', fecha=normalizar_fecha(fecha),
+                              grano_tipo=normalizar_producto(grano_tipo), id=id_cpe)
+        for id_patente in ids_patentes:
+            if (id_patente, id_cpe) in vistos:
+                continue
+            vistos.add((id_patente, id_cpe))
+            while len(cpes) <= id_patente:
+                cpes.append([])
+            cpes[id_patente].append(cpe_data)
 
+    cpes.extend([] for _ in range(len(claves.patentes) + 1 - len(cpes)))
     return cpes
 
 
@@ -284,7 +238,44 @@ def calcular_dias_diferencia(fecha_pesada, fecha_cpe):
         return float('inf')
 
 
-def asignar_cpes():
+def candidatos_cpe(lista_cpes, fecha_pesada_norm, producto_norm, usadas=()):
+    """
+    Motor de asignación de CPE a una pesada, a partir de las CPEs de su patente:
+    excluye las ya usadas (ids de claves.cpes), se queda con las del mismo producto (si no hay, con todas)
+    y de esas las que tienen fecha entre el día de la pesada y 7 días después.
+    Retorna (candidatos, en_rango); en_rango es [(dias, cpe)] ordenado por cercanía.
+    """
+    disponibles = [c for c in lista_cpes if c.id not in usadas]
+    mismo_producto = [c for c in disponibles if c.grano_tipo == producto_norm]
+    candidatos = mismo_producto if mismo_producto else disponibles
+
+    en_rango = []
+    for c in candidatos:
+        dias = calcular_dias_diferencia(fecha_pesada_norm, c.fecha)
+        if 0 <= dias <= 7:  # CPE mismo día o hasta 7 días después
+            en_rango.append((dias, c))
+    en_rango.sort(key=lambda x: x[0])
+    return candidatos, en_rango
+
+
+def empatadas(en_rango):
+    """CPEs que comparten la fecha más cercana (2+ = empate real, se marca REVISAR)"""
+    if not en_rango:
+        return []
+    return [c for dias, c in en_rango if dias == en_rango[0][0]]
+
+
+def resultado_plan(plan, dry_run):
+    """Campos del plan de cambios que se agregan al resultado de cada proceso"""
+    resultado = {'cambios_planeados': len(plan), 'dry_run': dry_run}
+    if dry_run:
+        resultado['plan'] = plan.to_dict()
+        resultado['resumen_plan'] = plan.resumen()
+    return resultado
+
+
+@instrumentado('asignar_cpes')
+def asignar_cpes(buffer=None, dry_run=False):
     """
     Proceso principal: asigna CPEs a Pesadas.
 
@@ -298,29 +289,45 @@ def asignar_cpes():
        - Si 1 candidato: asignar
        - Si 2+: asignar más cercana + marcar REVISAR
        - Si 0: dejar vacío
+
+    Si se pasa un WriteBuffer, las escrituras quedan pendientes en él
+    (para aplicarlas junto con las de otros pasos); si no, se aplican al final.
+    Con dry_run=True no escribe nada y devuelve el plan de cambios en 'plan'.
     """
     try:
-        creds = get_credentials()
-        gc = gspread.authorize(creds)
+        propio = buffer is None
+        if propio:
+            buffer = WriteBuffer()
+        plan = PlanCambios('asignar_cpes')
 
-        # Cargar CPEs (indexado por patente, lista de todos los CPEs)
-        cpes = cargar_cpes(gc)
-        total_patentes_cpe = len(cpes)
+        gc = get_client(get_credentials)
+
+        # CPE y Pesadas se descargan en paralelo
+        hojas = leer_hojas(gc, {
+            'cpe': (CONFIG['CPE_SPREADSHEET_ID'], CONFIG['CPE_SHEET_NAME']),
+            'pesadas': (CONFIG['PESADAS_SPREADSHEET_ID'], CONFIG['PESADAS_SHEET_NAME'])
+        })
+
+        # Indexar CPEs por id de patente (lista de todos los CPEs)
+        claves = Claves()
+        with fase('parseo'):
+            cpes = cpes_por_patente(hojas['cpe'][1], claves)
+        total_patentes_cpe = sum(1 for lista in cpes if lista)
 
         # Contar CPEs duplicados (patentes con múltiples CPEs)
-        patentes_duplicadas = sum(1 for lista in cpes.values() if len(lista) > 1)
+        patentes_duplicadas = sum(1 for lista in cpes if len(lista) > 1)
 
-        # Abrir hoja de Pesadas
-        ss_pesadas = gc.open_by_key(CONFIG['PESADAS_SPREADSHEET_ID'])
-        hoja_pesadas = ss_pesadas.worksheet(CONFIG['PESADAS_SHEET_NAME'])
-        datos_pesadas = hoja_pesadas.get_all_values()
+        hoja_pesadas, datos_pesadas = hojas['pesadas']
+        datos_pesadas = buffer.superponer(hoja_pesadas, datos_pesadas)
 
-        # PASO 1: Cargar CPEs ya asignadas (para no reutilizar)
-        cpes_ya_usadas = set()
-        for fila in datos_pesadas[1:]:
-            cpe_existente = fila[CONFIG['PESADAS_COL_CPE']] if len(fila) > CONFIG['PESADAS_COL_CPE'] else ''
-            if cpe_existente and str(cpe_existente).strip():
-                cpes_ya_usadas.add(str(cpe_existente).strip())
+        # PASO 1: Cargar CPEs ya asignadas (para no reutilizar), como ids de claves.cpes
+        with fase('parseo'):
+            cpes_ya_usadas = set()
+            for fila in datos_pesadas[1:]:
+                cpe_existente = fila[CONFIG['PESADAS_COL_CPE']] if len(fila) > CONFIG['PESADAS_COL_CPE'] else ''
+                if cpe_existente:
+                    cpes_ya_usadas.add(claves.cpes.id(cpe_existente))
+            cpes_ya_usadas.discard(-1)
 
         # Estadísticas
         total_pesadas = 0
@@ -334,10 +341,6 @@ def asignar_cpes():
         # Lista para tracking de duplicados (para la página de control)
         duplicados_info = []
 
-        # Batch de actualizaciones
-        actualizaciones_cpe = []
-        actualizaciones_revisar = []
-
         # PASO 2: Procesar cada pesada (saltar encabezado)
         for idx, fila in enumerate(datos_pesadas[1:], start=2):
             if len(fila) <= CONFIG['PESADAS_COL_PATENTE']:
@@ -361,38 +364,19 @@ def asignar_cpes():
                 continue
 
             # Normalizar datos de la pesada
-            patente_norm = normalizar_patente(patente_pesada)
-            fecha_pesada_norm = normalizar_fecha(fecha_pesada)
-            producto_pesada_norm = normalizar_producto(producto_pesada)
-
-            if not patente_norm or patente_norm not in cpes:
-                sin_match += 1
-                continue
-
-            lista_cpes = cpes[patente_norm]
-
-            # FILTRO 1: Excluir CPEs ya usadas
-            cpes_disponibles = [c for c in lista_cpes if c['numero_cpe'] not in cpes_ya_usadas]
-
-            if not cpes_disponibles:
+            id_patente = claves.patentes.buscar(patente_pesada)
+            if not cpes[id_patente]:
                 sin_match += 1
                 continue
 
-            # FILTRO 2: Filtrar por producto (palabra clave)
-            cpes_mismo_producto = [c for c in cpes_disponibles if c['grano_tipo'] == producto_pesada_norm]
-
-            # Si no hay match por producto, intentar con todos
-            candidatos = cpes_mismo_producto if cpes_mismo_producto else cpes_disponibles
+            fecha_pesada_norm = normalizar_fecha(fecha_pesada)
+            producto_pesada_norm = normalizar_producto(producto_pesada)
 
-            # FILTRO 3: Filtrar por fecha (CPE >= pesada, máximo 7 días)
-            cpes_en_rango = []
-            for c in candidatos:
-                dias = calcular_dias_diferencia(fecha_pesada_norm, c['fecha'])
-                if 0 <= dias <= 7:  # CPE mismo día o hasta 7 días después
-                    c['dias_diferencia'] = dias
-                    cpes_en_rango.append(c)
+            # FILTROS: CPEs no usadas, mismo producto y fecha entre 0 y 7 días después
+            candidatos, en_rango = candidatos_cpe(cpes[id_patente], fecha_pesada_norm,
+                                                  producto_pesada_norm, cpes_ya_usadas)
 
-            if not cpes_en_rango:
+            if not en_rango:
                 # Hay candidatos pero fuera de rango de fechas
                 if candidatos:
                     fuera_de_rango += 1
@@ -400,74 +384,60 @@ def asignar_cpes():
                     sin_match += 1
                 continue
 
-            # ASIGNACIÓN
-            numero_cpe = None
+            # ASIGNACIÓN: la más cercana
+            elegida = en_rango[0][1]
+            numero_cpe = elegida.numero_cpe
             marcar_revisar = False
 
-            if len(cpes_en_rango) == 1:
-                # Único candidato válido
-                numero_cpe = cpes_en_rango[0]['numero_cpe']
-                matches_unicos += 1
+            # Solo marcar REVISAR si hay empate real (2+ CPEs con la misma fecha)
+            cpes_mismo_dia = empatadas(en_rango)
+
+            if len(cpes_mismo_dia) > 1:
+                # Empate real: múltiples CPEs con la misma fecha más cercana
+                matches_con_empate += 1
+                marcar_revisar = True
+
+                # Registrar info para control
+                duplicados_info.append({
+                    'fila': idx,
+                    'fecha_pesada': fecha_pesada,
+                    'producto_pesada': producto_pesada,
+                    'patente': patente_pesada,
+                    'neto': neto_pesada,
+                    'cpe_asignado': numero_cpe,
+                    'candidatos': len(en_rango),
+                    'empate_real': len(cpes_mismo_dia),
+                    'opciones': [{'cpe': c.numero_cpe, 'fecha': c.fecha, 'dias': dias}
+                                for dias, c in en_rango[:5]]
+                })
             else:
-                # Múltiples candidatos: ordenar por fecha más cercana
-                cpes_en_rango.sort(key=lambda x: x['dias_diferencia'])
-                numero_cpe = cpes_en_rango[0]['numero_cpe']
-
-                # Solo marcar REVISAR si hay empate real (2+ CPEs con la misma fecha)
-                dias_mejor = cpes_en_rango[0]['dias_diferencia']
-                cpes_mismo_dia = [c for c in cpes_en_rango if c['dias_diferencia'] == dias_mejor]
-
-                if len(cpes_mismo_dia) > 1:
-                    # Empate real: múltiples CPEs con la misma fecha más cercana
-                    matches_con_empate += 1
-                    marcar_revisar = True
-
-                    # Registrar info para control
-                    duplicados_info.append({
-                        'fila': idx,
-                        'fecha_pesada': fecha_pesada,
-                        'producto_pesada': producto_pesada,
-                        'patente': patente_pesada,
-                        'neto': neto_pesada,
-                        'cpe_asignado': numero_cpe,
-                        'candidatos': len(cpes_en_rango),
-                        'empate_real': len(cpes_mismo_dia),
-                        'opciones': [{'cpe': c['numero_cpe'], 'fecha': c['fecha'], 'dias': c['dias_diferencia']}
-                                    for c in cpes_en_rango[:5]]
-                    })
-                else:
-                    # Sin empate: hay un ganador claro (fecha más cercana)
-                    matches_unicos += 1
+                # Único candidato o ganador claro (fecha más cercana)
+                matches_unicos += 1
 
             if numero_cpe:
                 # Marcar CPE como usada (para no reutilizar en esta corrida)
-                cpes_ya_usadas.add(numero_cpe)
+                cpes_ya_usadas.add(elegida.id)
 
                 # Agregar actualización de CPE
-                col_cpe = CONFIG['PESADAS_COL_CPE'] + 1
-                actualizaciones_cpe.append({
-                    'range': f'{gspread.utils.rowcol_to_a1(idx, col_cpe)}',
-                    'values': [[numero_cpe]]
-                })
+                motivo = 'empate' if marcar_revisar else 'match_unico'
+                plan.agregar(hoja_pesadas, idx, CONFIG['PESADAS_COL_CPE'] + 1,
+                             cpe_actual, numero_cpe, f"cpe:{motivo}")
 
                 # Si hay empate, marcar REVISAR en columna T
                 if marcar_revisar:
-                    col_verificado = CONFIG['PESADAS_COL_VERIFICADO'] + 1
-                    actualizaciones_revisar.append({
-                        'range': f'{gspread.utils.rowcol_to_a1(idx, col_verificado)}',
-                        'values': [['REVISAR']]
-                    })
+                    verificado = fila[CONFIG['PESADAS_COL_VERIFICADO']] if len(fila) > CONFIG['PESADAS_COL_VERIFICADO'] else ''
+                    plan.agregar(hoja_pesadas, idx, CONFIG['PESADAS_COL_VERIFICADO'] + 1,
+                                 verificado, 'REVISAR', f"revisar:{len(cpes_mismo_dia)} candidatos mismo dia")
 
                 matches_nuevos += 1
 
-        # Aplicar actualizaciones en batch
-        if actualizaciones_cpe:
-            hoja_pesadas.batch_update(actualizaciones_cpe)
-
-        if actualizaciones_revisar:
-            hoja_pesadas.batch_update(actualizaciones_revisar)
+        # Aplicar actualizaciones (CPE y REVISAR van en la misma request)
+        plan.aplicar(buffer)
+        if propio and not dry_run:
+            buffer.flush()
 
         return {
+            **resultado_plan(plan, dry_run),
             'success': True,
             'total_patentes_cpe': total_patentes_cpe,
             'patentes_duplicadas': patentes_duplicadas,
@@ -489,44 +459,65 @@ def asignar_cpes():
         }
 
 
-def matchear_pesadas_fletes():
+@instrumentado('matchear_pesadas_fletes')
+def matchear_pesadas_fletes(buffer=None, dry_run=False):
     """
     Lleva el Neto de Pesadas a Fletes facturados.
     Match: Pesadas.CPE -> CPE.numero_cpe -> CPE.ctg -> Fletes.CTG
+    Con dry_run=True no escribe nada y devuelve el plan de cambios en 'plan'.
     """
     try:
-        creds = get_credentials()
-        gc = gspread.authorize(creds)
+        propio = buffer is None
+        if propio:
+            buffer = WriteBuffer()
+        plan = PlanCambios('matchear_pesadas_fletes')
+
+        gc = get_client(get_credentials)
+
+        # CPE, Pesadas y Fletes se descargan en paralelo
+        hojas = leer_hojas(gc, {
+            'cpe': (CONFIG['CPE_SPREADSHEET_ID'], CONFIG['CPE_SHEET_NAME']),
+            'pesadas': (CONFIG['PESADAS_SPREADSHEET_ID'], CONFIG['PESADAS_SHEET_NAME']),
+            'fletes': (CONFIG['CPE_SPREADSHEET_ID'], CONFIG['FLETES_SHEET_NAME'])
+        })
 
-        # 1. Cargar mapeo CPE: numero_cpe -> ctg
-        ss_cpe = gc.open_by_key(CONFIG['CPE_SPREADSHEET_ID'])
-        hoja_cpe = ss_cpe.worksheet(CONFIG['CPE_SHEET_NAME'])
-        datos_cpe = hoja_cpe.get_all_values()
+        # 1. Cargar mapeo CPE: id numero_cpe -> id ctg
+        datos_cpe = hojas['cpe'][1]
+        claves = Claves()
 
-        cpe_a_ctg = {}  # numero_cpe -> ctg
-        for fila in datos_cpe[1:]:
-            if len(fila) > CONFIG['CPE_COL_NUMERO_CPE']:
-                ctg = fila[CONFIG['CPE_COL_CTG']] if len(fila) > CONFIG['CPE_COL_CTG'] else ''
-                numero_cpe = fila[CONFIG['CPE_COL_NUMERO_CPE']] if len(fila) > CONFIG['CPE_COL_NUMERO_CPE'] else ''
-                if ctg and numero_cpe:
-                    cpe_a_ctg[numero_cpe.strip()] = ctg.strip()
+        with fase('parseo'):
+            cpe_a_ctg = {}  # id numero_cpe -> id ctg (en el orden de la hoja)
+            for fila in datos_cpe[1:]:
+                if len(fila) > CONFIG['CPE_COL_NUMERO_CPE']:
+                    ctg = fila[CONFIG['CPE_COL_CTG']] if len(fila) > CONFIG['CPE_COL_CTG'] else ''
+                    numero_cpe = fila[CONFIG['CPE_COL_NUMERO_CPE']] if len(fila) > CONFIG['CPE_COL_NUMERO_CPE'] else ''
+                    if ctg and numero_cpe:
+                        cpe_a_ctg[claves.cpes.id(numero_cpe)] = claves.ctgs.id(ctg)
 
         # 2. Cargar Pesadas con CPE asignado: obtener Neto por CPE
-        ss_pesadas = gc.open_by_key(CONFIG['PESADAS_SPREADSHEET_ID'])
-        hoja_pesadas = ss_pesadas.worksheet(CONFIG['PESADAS_SHEET_NAME'])
-        datos_pesadas = hoja_pesadas.get_all_values()
-
-        pesadas_por_cpe = {}  # cpe -> neto
-        for fila in datos_pesadas[1:]:
-            if len(fila) > CONFIG['PESADAS_COL_CPE']:
-                cpe = fila[CONFIG['PESADAS_COL_CPE']] if len(fila) > CONFIG['PESADAS_COL_CPE'] else ''
-                neto = fila[CONFIG['PESADAS_COL_NETO']] if len(fila) > CONFIG['PESADAS_COL_NETO'] else ''
-                if cpe and str(cpe).strip() and neto:
-                    pesadas_por_cpe[str(cpe).strip()] = neto
+        hoja_pesadas, datos_pesadas = hojas['pesadas']
+        datos_pesadas = buffer.superponer(hoja_pesadas, datos_pesadas)
+
+        with fase('parseo'):
+            pesadas_por_cpe = {}  # id cpe -> neto
+            for fila in datos_pesadas[1:]:
+                if len(fila) > CONFIG['PESADAS_COL_CPE']:
+                    cpe = fila[CONFIG['PESADAS_COL_CPE']] if len(fila) > CONFIG['PESADAS_COL_CPE'] else ''
+                    neto = fila[CONFIG['PESADAS_COL_NETO']] if len(fila) > CONFIG['PESADAS_COL_NETO'] else ''
+                    if cpe and neto:
+                        pesadas_por_cpe[claves.cpes.id(cpe)] = neto
+            pesadas_por_cpe.pop(-1, None)
+
+            # Índice CTG -> Neto: el de la primera CPE de ese CTG (en orden de la hoja) que tiene pesada
+            neto_por_ctg = claves.ctgs.lista()
+            for id_cpe, id_ctg in cpe_a_ctg.items():
+                if neto_por_ctg[id_ctg] is None and id_cpe in pesadas_por_cpe:
+                    neto_por_ctg[id_ctg] = pesadas_por_cpe[id_cpe]
+            neto_por_ctg[-1] = None
 
         # 3. Cargar Fletes y buscar matches por CTG
-        hoja_fletes = ss_cpe.worksheet(CONFIG['FLETES_SHEET_NAME'])
-        datos_fletes = hoja_fletes.get_all_values()
+        hoja_fletes, datos_fletes = hojas['fletes']
+        datos_fletes = buffer.superponer(hoja_fletes, datos_fletes)
 
         # Estadísticas
         total_fletes = 0
@@ -534,9 +525,6 @@ def matchear_pesadas_fletes():
         matches_nuevos = 0
         sin_match = 0
 
-        # Batch de actualizaciones
-        actualizaciones = []
-
         for idx, fila in enumerate(datos_fletes[1:], start=2):
             if len(fila) <= CONFIG['FLETES_COL_CTG']:
                 continue
@@ -556,46 +544,23 @@ def matchear_pesadas_fletes():
                 continue
 
             # Buscar: CTG -> numero_cpe -> Neto de Pesadas
-            neto_encontrado = None
-
-            # Buscar qué CPE tiene este CTG
-            for numero_cpe, ctg in cpe_a_ctg.items():
-                if ctg == ctg_flete:
-                    # Encontramos el CPE, ahora buscar el Neto en Pesadas
-                    if numero_cpe in pesadas_por_cpe:
-                        neto_encontrado = pesadas_por_cpe[numero_cpe]
-                        break
+            neto_encontrado = neto_por_ctg[claves.ctgs.buscar(ctg_flete)]
 
             if neto_encontrado:
-                col_neto = CONFIG['FLETES_COL_NETO_PESADAS'] + 1
-                actualizaciones.append({
-                    'range': f'{gspread.utils.rowcol_to_a1(idx, col_neto)}',
-                    'values': [[neto_encontrado]]
-                })
+                plan.agregar(hoja_fletes, idx, CONFIG['FLETES_COL_NETO_PESADAS'] + 1,
+                             neto_actual, neto_encontrado, f"neto_pesadas:ctg {ctg_flete}",
+                             formato={'backgroundColor': COLOR_VERDE})
                 matches_nuevos += 1
             else:
                 sin_match += 1
 
-        # Aplicar actualizaciones en batch
-        if actualizaciones:
-            hoja_fletes.batch_update(actualizaciones)
-
-            # Aplicar formato verde a todas las celdas en un solo batch
-            if len(actualizaciones) > 0:
-                celdas = [act['range'] for act in actualizaciones]
-                # Agrupar en rangos para formatear de una sola vez (máximo 10 por llamada)
-                for i in range(0, len(celdas), 10):
-                    grupo = celdas[i:i+10]
-                    try:
-                        hoja_fletes.batch_format([{
-                            'range': celda,
-                            'format': {'backgroundColor': {'red': 0.71, 'green': 0.84, 'blue': 0.66}}
-                        } for celda in grupo])
-                    except Exception:
-                        # Si batch_format no está disponible, formatear sin color
-                        pass
+        # Aplicar actualizaciones (valores y formato verde en una request cada uno)
+        plan.aplicar(buffer)
+        if propio and not dry_run:
+            buffer.flush()
 
         return {
+            **resultado_plan(plan, dry_run),
             'success': True,
             'total_cpes_mapeados': len(cpe_a_ctg),
             'pesadas_con_cpe': len(pesadas_por_cpe),
@@ -612,31 +577,47 @@ def matchear_pesadas_fletes():
         }
 
 
-def matchear_descargas_fletes():
+@instrumentado('matchear_descargas_fletes')
+def matchear_descargas_fletes(buffer=None, dry_run=False):
     """
     Lleva el Peso Neto de Descargas a Fletes facturados.
     Match directo por CTG
+    Con dry_run=True no escribe nada y devuelve el plan de cambios en 'plan'.
     """
     try:
-        creds = get_credentials()
-        gc = gspread.authorize(creds)
-        ss = gc.open_by_key(CONFIG['CPE_SPREADSHEET_ID'])
+        propio = buffer is None
+        if propio:
+            buffer = WriteBuffer()
+        plan = PlanCambios('matchear_descargas_fletes')
 
-        # 1. Cargar Descargas: CTG -> Peso Neto
-        hoja_descargas = ss.worksheet(CONFIG['DESCARGAS_SHEET_NAME'])
-        datos_descargas = hoja_descargas.get_all_values()
+        gc = get_client(get_credentials)
 
-        descargas_por_ctg = {}  # ctg -> peso_neto
-        for fila in datos_descargas[1:]:
-            if len(fila) > CONFIG['DESCARGAS_COL_PESO_NETO']:
-                ctg = fila[CONFIG['DESCARGAS_COL_CTG']] if len(fila) > CONFIG['DESCARGAS_COL_CTG'] else ''
-                peso_neto = fila[CONFIG['DESCARGAS_COL_PESO_NETO']] if len(fila) > CONFIG['DESCARGAS_COL_PESO_NETO'] else ''
-                if ctg and str(ctg).strip() and peso_neto:
-                    descargas_por_ctg[str(ctg).strip()] = peso_neto
+        # Descargas y Fletes se descargan en paralelo
+        hojas = leer_hojas(gc, {
+            'descargas': (CONFIG['CPE_SPREADSHEET_ID'], CONFIG['DESCARGAS_SHEET_NAME']),
+            'fletes': (CONFIG['CPE_SPREADSHEET_ID'], CONFIG['FLETES_SHEET_NAME'])
+        })
+
+        # 1. Cargar Descargas: CTG -> Peso Neto
+        datos_descargas = hojas['descargas'][1]
+
+        claves = Claves()
+        with fase('parseo'):
+            pesos = []  # (id ctg, peso_neto) en el orden de la hoja: gana la última fila de cada CTG
+            for fila in datos_descargas[1:]:
+                if len(fila) > CONFIG['DESCARGAS_COL_PESO_NETO']:
+                    ctg = fila[CONFIG['DESCARGAS_COL_CTG']] if len(fila) > CONFIG['DESCARGAS_COL_CTG'] else ''
+                    peso_neto = fila[CONFIG['DESCARGAS_COL_PESO_NETO']] if len(fila) > CONFIG['DESCARGAS_COL_PESO_NETO'] else ''
+                    if ctg and peso_neto:
+                        pesos.append((claves.ctgs.id(ctg), peso_neto))
+            descargas_por_ctg = claves.ctgs.lista()  # id ctg -> peso_neto
+            for id_ctg, peso_neto in pesos:
+                descargas_por_ctg[id_ctg] = peso_neto
+            descargas_por_ctg[-1] = None
 
         # 2. Cargar Fletes y buscar matches por CTG
-        hoja_fletes = ss.worksheet(CONFIG['FLETES_SHEET_NAME'])
-        datos_fletes = hoja_fletes.get_all_values()
+        hoja_fletes, datos_fletes = hojas['fletes']
+        datos_fletes = buffer.superponer(hoja_fletes, datos_fletes)
 
         # Estadísticas
         total_fletes = 0
@@ -644,9 +625,6 @@ def matchear_descargas_fletes():
         matches_nuevos = 0
         sin_match = 0
 
-        # Batch de actualizaciones
-        actualizaciones = []
-
         for idx, fila in enumerate(datos_fletes[1:], start=2):
             if len(fila) <= CONFIG['FLETES_COL_CTG']:
                 continue
@@ -666,46 +644,30 @@ def matchear_descargas_fletes():
                 continue
 
             # Buscar en Descargas por CTG
-            if ctg_flete in descargas_por_ctg:
-                peso_neto = descargas_por_ctg[ctg_flete]
-                col_neto = CONFIG['FLETES_COL_NETO_DESCARGAS'] + 1
-                actualizaciones.append({
-                    'range': f'{gspread.utils.rowcol_to_a1(idx, col_neto)}',
-                    'values': [[peso_neto]]
-                })
+            peso_neto = descargas_por_ctg[claves.ctgs.buscar(ctg_flete)]
+            if peso_neto is not None:
+                plan.agregar(hoja_fletes, idx, CONFIG['FLETES_COL_NETO_DESCARGAS'] + 1,
+                             neto_actual, peso_neto, f"neto_descargas:ctg {ctg_flete}",
+                             formato={'backgroundColor': COLOR_VERDE})
                 matches_nuevos += 1
             else:
                 sin_match += 1
 
-        # Aplicar actualizaciones en batch
-        if actualizaciones:
+        # Aplicar actualizaciones
+        plan.aplicar(buffer)
+        if propio and not dry_run:
             try:
-                hoja_fletes.batch_update(actualizaciones)
+                buffer.flush()
             except Exception as batch_error:
                 return {
                     'success': False,
-                    'error': f'Error en batch_update: {str(batch_error)}',
-                    'primera_actualizacion': actualizaciones[0] if actualizaciones else None
+                    'error': f'Error en batch_update: {str(batch_error)}'
                 }
 
-            # Aplicar formato verde a todas las celdas en un solo batch
-            if len(actualizaciones) > 0:
-                celdas = [act['range'] for act in actualizaciones]
-                # Agrupar en rangos para formatear de una sola vez (máximo 10 por llamada)
-                for i in range(0, len(celdas), 10):
-                    grupo = celdas[i:i+10]
-                    try:
-                        hoja_fletes.batch_format([{
-                            'range': celda,
-                            'format': {'backgroundColor': {'red': 0.71, 'green': 0.84, 'blue': 0.66}}
-                        } for celda in grupo])
-                    except Exception:
-                        # Si batch_format no está disponible, formatear sin color
-                        pass
-
         return {
+            **resultado_plan(plan, dry_run),
             'success': True,
-            'descargas_con_ctg': len(descargas_por_ctg),
+            'descargas_con_ctg': len(claves.ctgs),
             'total_fletes': total_fletes,
             'ya_tenian_neto': ya_tenian_neto,
             'matches_nuevos': matches_nuevos,
@@ -719,44 +681,54 @@ def matchear_descargas_fletes():
         }
 
 
-def traer_cpes_a_fletes():
+@instrumentado('traer_cpes_a_fletes')
+def traer_cpes_a_fletes(buffer=None, dry_run=False):
     """
     Busca el numero_cpe en Cartas de Porte por CTG y lo trae a Fletes.
     - Columna CPE: escribe el numero_cpe
     - Columna M CPE's: escribe "si" (verde) o "no" (rojo)
+    Con dry_run=True no escribe nada y devuelve el plan de cambios en 'plan'.
     """
     try:
-        creds = get_credentials()
-        gc = gspread.authorize(creds)
-        ss = gc.open_by_key(CONFIG['CPE_SPREADSHEET_ID'])
+        propio = buffer is None
+        if propio:
+            buffer = WriteBuffer()
+        plan = PlanCambios('traer_cpes_a_fletes')
 
-        # 1. Cargar CPE: CTG -> numero_cpe
-        hoja_cpe = ss.worksheet(CONFIG['CPE_SHEET_NAME'])
-        datos_cpe = hoja_cpe.get_all_values()
+        gc = get_client(get_credentials)
 
-        cpe_por_ctg = {}  # ctg -> numero_cpe
-        for fila in datos_cpe[1:]:
-            if len(fila) > CONFIG['CPE_COL_NUMERO_CPE']:
-                ctg = fila[CONFIG['CPE_COL_CTG']] if len(fila) > CONFIG['CPE_COL_CTG'] else ''
-                numero_cpe = fila[CONFIG['CPE_COL_NUMERO_CPE']] if len(fila) > CONFIG['CPE_COL_NUMERO_CPE'] else ''
-                if ctg and str(ctg).strip() and numero_cpe:
-                    cpe_por_ctg[str(ctg).strip()] = numero_cpe
+        # CPE y Fletes se descargan en paralelo
+        hojas = leer_hojas(gc, {
+            'cpe': (CONFIG['CPE_SPREADSHEET_ID'], CONFIG['CPE_SHEET_NAME']),
+            'fletes': (CONFIG['CPE_SPREADSHEET_ID'], CONFIG['FLETES_SHEET_NAME'])
+        })
+
+        # 1. Cargar CPE: CTG -> numero_cpe
+        datos_cpe = hojas['cpe'][1]
+
+        claves = Claves()
+        with fase('parseo'):
+            numeros = []  # (id ctg, numero_cpe) en el orden de la hoja: gana la última fila de cada CTG
+            for fila in datos_cpe[1:]:
+                if len(fila) > CONFIG['CPE_COL_NUMERO_CPE']:
+                    ctg = fila[CONFIG['CPE_COL_CTG']] if len(fila) > CONFIG['CPE_COL_CTG'] else ''
+                    numero_cpe = fila[CONFIG['CPE_COL_NUMERO_CPE']] if len(fila) > CONFIG['CPE_COL_NUMERO_CPE'] else ''
+                    if ctg and numero_cpe:
+                        numeros.append((claves.ctgs.id(ctg), numero_cpe))
+            cpe_por_ctg = claves.ctgs.lista()  # id ctg -> numero_cpe
+            for id_ctg, numero_cpe in numeros:
+                cpe_por_ctg[id_ctg] = numero_cpe
+            cpe_por_ctg[-1] = None
 
         # 2. Cargar Fletes y buscar matches por CTG
-        hoja_fletes = ss.worksheet(CONFIG['FLETES_SHEET_NAME'])
-        datos_fletes = hoja_fletes.get_all_values()
+        hoja_fletes, datos_fletes = hojas['fletes']
+        datos_fletes = buffer.superponer(hoja_fletes, datos_fletes)
 
         # Estadísticas
         total_fletes = 0
         con_cpe = 0
         sin_cpe = 0
 
-        # Batch de actualizaciones
-        actualizaciones_cpe = []
-        actualizaciones_match = []
-        formatos_verde = []
-        formatos_rojo = []
-
         for idx, fila in enumerate(datos_fletes[1:], start=2):
             if len(fila) <= CONFIG['FLETES_COL_CTG']:
                 continue
@@ -768,11 +740,10 @@ def traer_cpes_a_fletes():
 
             total_fletes += 1
             ctg_flete = str(ctg_flete).strip()
+            numero_cpe = cpe_por_ctg[claves.ctgs.buscar(ctg_flete)]
 
             col_cpe = CONFIG['FLETES_COL_CPE'] + 1  # F
             col_match = CONFIG['FLETES_COL_M_CPES'] + 1  # R
-            celda_cpe = gspread.utils.rowcol_to_a1(idx, col_cpe)
-            celda_match = gspread.utils.rowcol_to_a1(idx, col_match)
 
             # Obtener valor actual de M CPE's para no sobrescribir clasificaciones manuales
             m_cpes_actual = fila[CONFIG['FLETES_COL_M_CPES']] if len(fila) > CONFIG['FLETES_COL_M_CPES'] else ''
@@ -787,7 +758,7 @@ def traer_cpes_a_fletes():
 
             # Si ya tiene un valor protegido, no tocar esta fila
             if m_cpes_actual in valores_protegidos:
-                if ctg_flete in cpe_por_ctg:
+                if numero_cpe is not None:
                     con_cpe += 1
                 else:
                     sin_cpe += 1
@@ -795,65 +766,35 @@ def traer_cpes_a_fletes():
 
             # Solo llegamos aquí si M CPE's está vacío o tiene otro valor no protegido
             # Buscar en CPE por CTG
-            if ctg_flete in cpe_por_ctg:
-                numero_cpe = cpe_por_ctg[ctg_flete]
-                actualizaciones_cpe.append({
-                    'range': celda_cpe,
-                    'values': [[numero_cpe]]
-                })
-                actualizaciones_match.append({
-                    'range': celda_match,
-                    'values': [['si']]
-                })
-                formatos_verde.append(celda_match)
+            if numero_cpe is not None:
+                cpe_actual = fila[CONFIG['FLETES_COL_CPE']] if len(fila) > CONFIG['FLETES_COL_CPE'] else ''
+                m_cpes_original = fila[CONFIG['FLETES_COL_M_CPES']] if len(fila) > CONFIG['FLETES_COL_M_CPES'] else ''
+                plan.agregar(hoja_fletes, idx, col_cpe, cpe_actual, numero_cpe, f"cpe:ctg {ctg_flete}")
+                plan.agregar(hoja_fletes, idx, col_match, m_cpes_original, 'si', f"m_cpes:ctg {ctg_flete} en CPE",
+                             formato={'backgroundColor': COLOR_VERDE})
                 con_cpe += 1
             else:
                 # Escribir "no" solo si está vacío
-                actualizaciones_match.append({
-                    'range': celda_match,
-                    'values': [['no']]
-                })
-                formatos_rojo.append(celda_match)
+                m_cpes_original = fila[CONFIG['FLETES_COL_M_CPES']] if len(fila) > CONFIG['FLETES_COL_M_CPES'] else ''
+                plan.agregar(hoja_fletes, idx, col_match, m_cpes_original, 'no', f"m_cpes:ctg {ctg_flete} sin CPE",
+                             formato={'backgroundColor': COLOR_ROJO})
                 sin_cpe += 1
 
-        # Aplicar actualizaciones en batch
-        todas_actualizaciones = actualizaciones_cpe + actualizaciones_match
-        if todas_actualizaciones:
+        # Aplicar actualizaciones (verde y rojo van juntos en la request de formatos)
+        plan.aplicar(buffer)
+        if propio and not dry_run:
             try:
-                hoja_fletes.batch_update(todas_actualizaciones)
+                buffer.flush()
             except Exception as batch_error:
                 return {
                     'success': False,
                     'error': f'Error en batch_update: {str(batch_error)}'
                 }
 
-            # Aplicar formato verde a los "si" en batch
-            if formatos_verde:
-                for i in range(0, len(formatos_verde), 10):
-                    grupo = formatos_verde[i:i+10]
-                    try:
-                        hoja_fletes.batch_format([{
-                            'range': celda,
-                            'format': {'backgroundColor': {'red': 0.71, 'green': 0.84, 'blue': 0.66}}
-                        } for celda in grupo])
-                    except Exception:
-                        pass
-
-            # Aplicar formato rojo a los "no" en batch
-            if formatos_rojo:
-                for i in range(0, len(formatos_rojo), 10):
-                    grupo = formatos_rojo[i:i+10]
-                    try:
-                        hoja_fletes.batch_format([{
-                            'range': celda,
-                            'format': {'backgroundColor': {'red': 0.92, 'green': 0.6, 'blue': 0.6}}
-                        } for celda in grupo])
-                    except Exception:
-                        pass
-
         return {
+            **resultado_plan(plan, dry_run),
             'success': True,
-            'cpe_disponibles': len(cpe_por_ctg),
+            'cpe_disponibles': len(claves.ctgs),
             'total_fletes': total_fletes,
             'con_cpe': con_cpe,
             'sin_cpe': sin_cpe
@@ -889,80 +830,210 @@ def matchear_descargas():
     return jsonify(resultado)
 
 
+def procesos_dry_run():
+    """Procesos que aceptan dry_run, por nombre de endpoint"""
+    from agent_autocomplete import ejecutar_autocompletado
+    return {
+        'traer-cpes': traer_cpes_a_fletes,
+        'asignar': asignar_cpes,
+        'matchear-fletes': matchear_pesadas_fletes,
+        'matchear-descargas': matchear_descargas_fletes,
+        'autocompletar': ejecutar_autocompletado
+    }
+
+
+def celdas_escribibles():
+    """{(spreadsheet_id, hoja): {columnas base 1}} que escriben los procesos"""
+    from agent_autocomplete import CONFIG as CONFIG_AGENTE, CAMPOS_FLETES
+
+    fletes = {CONFIG[clave] + 1 for clave in ('FLETES_COL_CPE', 'FLETES_COL_NETO_PESADAS',
+                                               'FLETES_COL_M_CPES', 'FLETES_COL_NETO_DESCARGAS')}
+    fletes |= {CONFIG_AGENTE[clave] + 1 for _, clave in CAMPOS_FLETES}
+    return {
+        (CONFIG['PESADAS_SPREADSHEET_ID'], CONFIG['PESADAS_SHEET_NAME']):
+            {CONFIG['PESADAS_COL_CPE'] + 1, CONFIG['PESADAS_COL_VERIFICADO'] + 1},
+        (CONFIG['CPE_SPREADSHEET_ID'], CONFIG['FLETES_SHEET_NAME']): fletes,
+    }
+
+
+def firmar_plan(plan_dict, emitido):
+    """Firma (HMAC) de un plan emitido por /dry-run en el momento `emitido` (epoch)"""
+    cuerpo = json.dumps([emitido, plan_dict], sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hmac.new(SECRETO_PLANES, cuerpo.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def validar_plan(plan_dict, plan_id):
+    """
+    Error (texto) si el plan no es uno emitido por /dry-run hace menos de VIGENCIA_PLANES
+    segundos, sin modificar, o si toca celdas que no escribe ningún proceso; None si sirve.
+    """
+    emitido, _, firma = str(plan_id or '').partition('.')
+    if not emitido.isdigit() or not hmac.compare_digest(firma, firmar_plan(plan_dict, int(emitido))):
+        return 'Plan no emitido por /dry-run o modificado (falta plan_id o no coincide)'
+    if time.time() - int(emitido) > VIGENCIA_PLANES:
+        return 'El plan venció: volver a correr /dry-run'
+
+    permitidas = celdas_escribibles()
+    for cambio in plan_dict.get('cambios', []):
+        columnas = permitidas.get((cambio.get('spreadsheet_id'), cambio.get('hoja')), set())
+        if cambio.get('col') not in columnas or not isinstance(cambio.get('fila'), int) or cambio['fila'] < 2:
+            return f"Celda fuera de lo que escriben los procesos: {cambio.get('hoja')}!{cambio.get('celda')}"
+    return None
+
+
+@app.route('/dry-run/<proceso>', methods=['GET', 'POST'])
+def dry_run(proceso):
+    """
+    Corre un proceso sin escribir y devuelve su plan de cambios
+    (celda, valor anterior, valor nuevo y motivo) para revisarlo o aplicarlo con /aplicar-plan.
+    El plan va firmado en 'plan_id': /aplicar-plan solo acepta planes emitidos acá.
+    """
+    procesos = procesos_dry_run()
+    if proceso not in procesos:
+        return jsonify({'success': False, 'error': f"Proceso desconocido: {proceso}",
+                        'procesos': list(procesos)}), 404
+    resultado = procesos[proceso](dry_run=True)
+    if resultado.get('plan') is not None:
+        emitido = int(time.time())
+        resultado['plan_id'] = f"{emitido}.{firmar_plan(resultado['plan'], emitido)}"
+    return jsonify(resultado)
+
+
+@app.route('/aplicar-plan', methods=['POST'])
+def aplicar_plan():
+    """
+    Aplica un plan devuelto por /dry-run (body JSON: los campos 'plan' y 'plan_id',
+    tal como los devolvió). Se rechazan los planes sin firma válida o vencidos.
+    Por defecto verifica que cada celda siga teniendo el valor anterior;
+    las que cambiaron desde el dry-run se saltean y se devuelven en 'conflictos'.
+    """
+    try:
+        body = request.get_json(force=True) or {}
+        plan_dict = body.get('plan')
+        if not isinstance(plan_dict, dict):
+            return jsonify({'success': False, 'error': "Falta el campo 'plan' devuelto por /dry-run"}), 400
+        error = validar_plan(plan_dict, body.get('plan_id'))
+        if error:
+            return jsonify({'success': False, 'error': error}), 403
+
+        plan = PlanCambios.from_dict(plan_dict)
+        verificar = str(request.args.get('verificar', '1')).lower() not in ('0', 'false', 'no')
+        gc = get_client(get_credentials)
+        resultado = plan.aplicar(gc=gc, verificar=verificar)
+        return jsonify({
+            'success': True,
+            'aplicados': resultado['aplicados'],
+            'conflictos': resultado['conflictos'],
+            'requests': resultado['escritura']['requests']
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
 @app.route('/health')
 def health():
     return jsonify({'status': 'ok'})
 
 
-@app.route('/ver-descargas')
-def ver_descargas():
-    """Ver encabezados de Descargas Todos"""
+@app.route('/metrics')
+def metrics():
+    """Tiempos por paso/fase y llamadas a Sheets acumulados, en formato Prometheus"""
+    return Response(prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+def stream_hoja(cache_key, limit_defecto):
+    """
+    Respuesta NDJSON de una hoja: primera línea con los encabezados, luego una línea por fila.
+    Query params: offset (filas de datos a saltear), limit, columns (encabezados separados por coma).
+    Se sirve desde el snapshot del DataLoader si está vigente; si no, se lee por páginas.
+    """
     try:
-        creds = get_credentials()
-        gc = gspread.authorize(creds)
-        ss = gc.open_by_key(CONFIG['CPE_SPREADSHEET_ID'])
-        hoja = ss.worksheet('Descargas Todos')
-        datos = hoja.get_all_values()
-        return jsonify({
-            'encabezados': datos[0] if datos else [],
-            'ejemplo_fila': datos[1] if len(datos) > 1 else []
-        })
+        offset = max(0, request.args.get('offset', 0, type=int))
+        limit = request.args.get('limit', limit_defecto, type=int)
+        limit = None if limit is not None and limit < 0 else limit  # limit=-1: todas las filas
+        columnas = [c.strip() for c in request.args.get('columns', '').split(',') if c.strip()]
+
+        encabezados, filas = data_loader.iterar_filas(cache_key, offset=offset, limit=limit)
+
+        if columnas:
+            faltantes = [c for c in columnas if c not in encabezados]
+            if faltantes:
+                return jsonify({'error': f"Columnas inexistentes: {', '.join(faltantes)}"})
+            indices = [encabezados.index(c) for c in columnas]
+        else:
+            columnas = encabezados
+            indices = list(range(len(encabezados)))
     except Exception as e:
         return jsonify({'error': str(e)})
 
+    def generar():
+        yield json.dumps({'total_columnas': len(encabezados), 'encabezados': encabezados},
+                         ensure_ascii=False) + '\n'
+        try:
+            for fila in filas:
+                yield json.dumps({c: fila[i] for c, i in zip(columnas, indices)}, ensure_ascii=False) + '\n'
+        except Exception as e:
+            yield json.dumps({'error': str(e)}) + '\n'
+
+    return Response(stream_with_context(generar()), mimetype='application/x-ndjson')
+
+
+@app.route('/ver-descargas')
+def ver_descargas():
+    """Ver encabezados y filas de Descargas Todos (NDJSON)"""
+    return stream_hoja('descargas', limit_defecto=1)
+
 
 @app.route('/ver-fletes')
 def ver_fletes():
-    """Ver encabezados de Fletes facturados todos"""
-    try:
-        creds = get_credentials()
-        gc = gspread.authorize(creds)
-        ss = gc.open_by_key(CONFIG['CPE_SPREADSHEET_ID'])
-        hoja = ss.worksheet('Fletes facturados todos')
-        datos = hoja.get_all_values()
-        return jsonify({
-            'total_columnas': len(datos[0]) if datos else 0,
-            'encabezados': datos[0] if datos else [],
-            'ejemplo_fila': datos[1] if len(datos) > 1 else []
-        })
-    except Exception as e:
-        return jsonify({'error': str(e)})
+    """Ver encabezados y filas de Fletes facturados todos (NDJSON)"""
+    return stream_hoja('fletes', limit_defecto=1)
 
 
 @app.route('/ver-oc-fletes')
 def ver_oc_fletes():
-    """Ver encabezados de OC Fletes"""
-    try:
-        creds = get_credentials()
-        gc = gspread.authorize(creds)
-        ss = gc.open_by_key('1e_GIvBUY8uskXXL7c2TsBydxprT_h36VlsLhYooz72w')
-        hoja = ss.worksheet('OC Fletes')
-        datos = hoja.get_all_values()
-        return jsonify({
-            'total_columnas': len(datos[0]) if datos else 0,
-            'encabezados': datos[0] if datos else [],
-            'ejemplo_filas': datos[1:6] if len(datos) > 1 else []
-        })
-    except Exception as e:
-        return jsonify({'error': str(e)})
+    """Ver encabezados y filas de OC Fletes (NDJSON)"""
+    return stream_hoja('oc_fletes', limit_defecto=5)
+
+
+def indexar_cpes(cpes_dict, max_ejemplos=3):
+    """
+    Índices secundarios sobre {(patente, fecha): numero_cpe}: por fecha y por patente,
+    con la cantidad total y unos pocos ejemplos precalculados.
+    """
+    por_fecha = {}
+    por_patente = {}
+    for clave, numero_cpe in cpes_dict.items():
+        patente, fecha = clave
+        for indice, k in ((por_fecha, fecha), (por_patente, patente)):
+            entrada = indice.get(k)
+            if entrada is None:
+                entrada = indice[k] = {'total': 0, 'ejemplos': []}
+            entrada['total'] += 1
+            if len(entrada['ejemplos']) < max_ejemplos:
+                entrada['ejemplos'].append((clave, numero_cpe))
+    return por_fecha, por_patente
 
 
 @app.route('/analizar')
 def analizar():
-    """Análisis profundo de por qué no hay matches"""
+    """
+    Análisis profundo de por qué no hay matches.
+    Analiza todas las pesadas sin CPE asignada, paginado con ?pagina=1&por_pagina=100
+    """
     try:
-        creds = get_credentials()
-        gc = gspread.authorize(creds)
+        pagina = max(1, request.args.get('pagina', 1, type=int))
+        por_pagina = min(1000, max(1, request.args.get('por_pagina', 100, type=int)))
 
-        # Cargar CPEs
-        ss_cpe = gc.open_by_key(CONFIG['CPE_SPREADSHEET_ID'])
-        hoja_cpe = ss_cpe.worksheet(CONFIG['CPE_SHEET_NAME'])
-        datos_cpe = hoja_cpe.get_all_values()
+        gc = get_client(get_credentials)
 
-        # Cargar Pesadas
-        ss_pesadas = gc.open_by_key(CONFIG['PESADAS_SPREADSHEET_ID'])
-        hoja_pesadas = ss_pesadas.worksheet(CONFIG['PESADAS_SHEET_NAME'])
-        datos_pesadas = hoja_pesadas.get_all_values()
+        # Cargar CPEs y Pesadas en paralelo
+        hojas = leer_hojas(gc, {
+            'cpe': (CONFIG['CPE_SPREADSHEET_ID'], CONFIG['CPE_SHEET_NAME']),
+            'pesadas': (CONFIG['PESADAS_SPREADSHEET_ID'], CONFIG['PESADAS_SHEET_NAME'])
+        })
+        datos_cpe = hojas['cpe'][1]
+        datos_pesadas = hojas['pesadas'][1]
 
         # Crear diccionario de CPEs: {(patente, fecha): numero_cpe}
         cpes_dict = {}
@@ -973,39 +1044,68 @@ def analizar():
                 patente_raw = fila[CONFIG['CPE_COL_PATENTE']] if len(fila) > CONFIG['CPE_COL_PATENTE'] else ''
 
                 if numero_cpe and fecha:
-                    for p in extraer_patentes_de_array(patente_raw):
+                    for p in extraer_patentes(patente_raw):
                         cpes_dict[(p, fecha)] = numero_cpe
 
-        # Analizar primeras 20 pesadas
+        # Índices por fecha y por patente (evita recorrer cpes_dict por cada pesada)
+        por_fecha, por_patente = indexar_cpes(cpes_dict)
+        vacio = {'total': 0, 'ejemplos': []}
+
+        # Analizar todas las pesadas sin CPE, en una sola pasada
         analisis = []
-        for fila in datos_pesadas[1:21]:
-            if len(fila) > CONFIG['PESADAS_COL_PATENTE']:
-                fecha_pesada = normalizar_fecha(fila[CONFIG['PESADAS_COL_FECHA']] if len(fila) > CONFIG['PESADAS_COL_FECHA'] else '')
-                patente_pesada = normalizar_patente(fila[CONFIG['PESADAS_COL_PATENTE']] if len(fila) > CONFIG['PESADAS_COL_PATENTE'] else '')
+        resumen = {
+            'con_match_exacto': 0,
+            'patente_sin_cpes': 0,
+            'patente_con_cpes_otra_fecha': 0,
+            'fecha_sin_cpes': 0
+        }
+        for idx, fila in enumerate(datos_pesadas[1:], start=2):
+            if len(fila) <= CONFIG['PESADAS_COL_PATENTE']:
+                continue
+            cpe_actual = fila[CONFIG['PESADAS_COL_CPE']] if len(fila) > CONFIG['PESADAS_COL_CPE'] else ''
+            if str(cpe_actual).strip():
+                continue
 
-                # Buscar CPEs con misma fecha
-                cpes_misma_fecha = [(k, v) for k, v in cpes_dict.items() if k[1] == fecha_pesada]
+            fecha_pesada = normalizar_fecha(fila[CONFIG['PESADAS_COL_FECHA']] if len(fila) > CONFIG['PESADAS_COL_FECHA'] else '')
+            patente_pesada = normalizar_patente(fila[CONFIG['PESADAS_COL_PATENTE']])
 
-                # Buscar CPEs con misma patente
-                cpes_misma_patente = [(k, v) for k, v in cpes_dict.items() if k[0] == patente_pesada]
+            misma_fecha = por_fecha.get(fecha_pesada, vacio)
+            misma_patente = por_patente.get(patente_pesada, vacio)
 
-                # Match exacto
-                match = cpes_dict.get((patente_pesada, fecha_pesada))
+            # Match exacto
+            match = cpes_dict.get((patente_pesada, fecha_pesada))
 
-                analisis.append({
-                    'fecha_pesada': fecha_pesada,
-                    'patente_pesada': patente_pesada,
-                    'tiene_match': match is not None,
-                    'cpe_match': match,
-                    'cpes_misma_fecha': len(cpes_misma_fecha),
-                    'cpes_misma_patente': len(cpes_misma_patente),
-                    'ejemplo_misma_fecha': cpes_misma_fecha[:3] if cpes_misma_fecha else [],
-                    'ejemplo_misma_patente': cpes_misma_patente[:3] if cpes_misma_patente else [],
-                })
+            if match is not None:
+                resumen['con_match_exacto'] += 1
+            elif misma_patente['total'] == 0:
+                resumen['patente_sin_cpes'] += 1
+            else:
+                resumen['patente_con_cpes_otra_fecha'] += 1
+            if misma_fecha['total'] == 0:
+                resumen['fecha_sin_cpes'] += 1
+
+            analisis.append({
+                'fila': idx,
+                'fecha_pesada': fecha_pesada,
+                'patente_pesada': patente_pesada,
+                'tiene_match': match is not None,
+                'cpe_match': match,
+                'cpes_misma_fecha': misma_fecha['total'],
+                'cpes_misma_patente': misma_patente['total'],
+                'ejemplo_misma_fecha': misma_fecha['ejemplos'],
+                'ejemplo_misma_patente': misma_patente['ejemplos'],
+            })
+
+        inicio = (pagina - 1) * por_pagina
 
         return jsonify({
             'total_cpes_unicas': len(cpes_dict),
-            'analisis_pesadas': analisis
+            'total_pesadas_sin_cpe': len(analisis),
+            'resumen': resumen,
+            'pagina': pagina,
+            'por_pagina': por_pagina,
+            'total_paginas': (len(analisis) + por_pagina - 1) // por_pagina,
+            'analisis_pesadas': analisis[inicio:inicio + por_pagina]
         })
 
     except Exception as e:
@@ -1016,13 +1116,16 @@ def analizar():
 def debug():
     """Endpoint para debug - muestra ejemplos de datos"""
     try:
-        creds = get_credentials()
-        gc = gspread.authorize(creds)
+        gc = get_client(get_credentials)
+
+        # CPE y Pesadas en paralelo
+        hojas = leer_hojas(gc, {
+            'cpe': (CONFIG['CPE_SPREADSHEET_ID'], CONFIG['CPE_SHEET_NAME']),
+            'pesadas': (CONFIG['PESADAS_SPREADSHEET_ID'], CONFIG['PESADAS_SHEET_NAME'])
+        })
 
         # Cargar algunos CPEs de ejemplo
-        ss_cpe = gc.open_by_key(CONFIG['CPE_SPREADSHEET_ID'])
-        hoja_cpe = ss_cpe.worksheet(CONFIG['CPE_SHEET_NAME'])
-        datos_cpe = hoja_cpe.get_all_values()
+        datos_cpe = hojas['cpe'][1]
 
         ejemplos_cpe = []
         for fila in datos_cpe[1:6]:  # Primeras 5 filas
@@ -1033,13 +1136,11 @@ def debug():
                     'fecha_original': fila[CONFIG['CPE_COL_FECHA']] if len(fila) > CONFIG['CPE_COL_FECHA'] else '',
                     'fecha_normalizada': normalizar_fecha(fila[CONFIG['CPE_COL_FECHA']] if len(fila) > CONFIG['CPE_COL_FECHA'] else ''),
                     'patente_original': patente_raw,
-                    'patentes_extraidas': extraer_patentes_de_array(patente_raw),
+                    'patentes_extraidas': extraer_patentes(patente_raw),
                 })
 
         # Cargar algunos Pesadas de ejemplo
-        ss_pesadas = gc.open_by_key(CONFIG['PESADAS_SPREADSHEET_ID'])
-        hoja_pesadas = ss_pesadas.worksheet(CONFIG['PESADAS_SHEET_NAME'])
-        datos_pesadas = hoja_pesadas.get_all_values()
+        datos_pesadas = hojas['pesadas'][1]
 
         ejemplos_pesadas = []
         for fila in datos_pesadas[1:6]:  # Primeras 5 filas
@@ -1063,7 +1164,7 @@ def debug():
                     cpes_recientes.append({
                         'numero_cpe': fila[CONFIG['CPE_COL_NUMERO_CPE']] if len(fila) > CONFIG['CPE_COL_NUMERO_CPE'] else '',
                         'fecha': fecha_norm,
-                        'patentes': extraer_patentes_de_array(patente_raw)
+                        'patentes': extraer_patentes(patente_raw)
                     })
                     if len(cpes_recientes) >= 10:
                         break
@@ -1093,6 +1194,71 @@ def debug():
         return jsonify({'error': str(e)})
 
 
+@app.route('/buscar')
+def buscar():
+    """
+    Drill-down por claves sobre el espejo SQLite (ESPEJO_SQLITE_PATH): filas de Fletes,
+    Pesadas, Descargas y CPE que coinciden con ?ctg=, ?cpe=, ?patente= (+ ?fecha=) o
+    ?transportista=, por índice y sin recorrer las hojas. Parámetro opcional limite (100).
+    """
+    try:
+        if data_loader.espejo is None:
+            return jsonify({'success': False, 'error': 'Espejo SQLite desactivado (configurar ESPEJO_SQLITE_PATH)'})
+
+        filtros = {c: request.args.get(c, '').strip() for c in ('ctg', 'cpe', 'patente', 'fecha', 'transportista')}
+        if not any(filtros[c] for c in ('ctg', 'cpe', 'patente', 'transportista')):
+            return jsonify({'success': False, 'error': 'Indicar ctg, cpe, patente o transportista'})
+        limite = min(1000, max(1, request.args.get('limite', 100, type=int)))
+
+        # Cargar (o refrescar si venció) las hojas: cada carga sincroniza su tabla del espejo
+        for cargar in (data_loader.get_fletes, data_loader.get_pesadas, data_loader.get_descargas,
+                       data_loader.get_cpe):
+            cargar()
+
+        resultado = data_loader.espejo.buscar(limite=limite, **{c: v or None for c, v in filtros.items()})
+        return jsonify({
+            'success': True,
+            'filtros': {c: v for c, v in filtros.items() if v},
+            'resultados': resultado,
+            'totales': {tabla: len(filas) for tabla, filas in resultado.items()},
+            'espejo': data_loader.espejo.estado()
+        })
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/query', methods=['GET', 'POST'])
+def query():
+    """
+    Consultas SQL de solo lectura (SELECT / WITH) sobre los DataFrames cacheados de
+    Fletes, Pesadas, Descargas y CPE (tablas fletes, pesadas, descargas, cpe y
+    cpe_patentes), sin leer Google Sheets. Parámetros: sql (query string, form o JSON)
+    y max_filas opcional. Sin sql retorna el esquema de las tablas.
+    """
+    from consultas import motor_consultas, EJEMPLOS
+
+    try:
+        cuerpo = request.get_json(silent=True) or {}
+        sql = request.values.get('sql') or cuerpo.get('sql', '')
+        max_filas = request.values.get('max_filas', type=int) or cuerpo.get('max_filas')
+
+        if not sql.strip():
+            return jsonify({
+                'success': False,
+                'error': 'Falta el parámetro sql',
+                'tablas': {tabla: [{'columna': c, 'tipo': t} for c, t in columnas]
+                           for tabla, columnas in motor_consultas.esquema().items()},
+                'ejemplos': EJEMPLOS
+            })
+
+        resultado = motor_consultas.consultar(sql, max_filas=max_filas)
+        return jsonify({'success': True, 'total': len(resultado['filas']), **resultado})
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
 if __name__ == '__main__':
     print("=" * 50)
     print("Asignador de CPEs a Pesadas")
@@ -0,0 +1,293 @@
+"""
+Benchmark del pipeline de matching
+Genera planillas sintéticas (Fletes, Pesadas, Descargas y CPE) con el formato real,
+corre cada proceso contra el backend local y guarda los tiempos en JSON
+para comparar entre commits.
+
+Uso:
+    python benchmark.py --tamanios 1000,10000 --salida bench.json
+    python benchmark.py --tamanios 1000 --comparar bench_anterior.json
+"""
+
+import argparse
+import json
+import platform
+import random
+import statistics
+import subprocess
+import time
+from datetime import date, datetime, timedelta
+
+from sheets_backend import ClienteLocal, usar_cliente_local
+
+ENCABEZADOS_FLETES = [
+    'Numero de factura', 'Fecha', 'Producto', 'Cantidad', 'CTG', 'CPE', 'Origen', 'Destino',
+    'Transportista', 'Chofer', 'Subtotal', 'IVA', 'Total', 'Tarifa', 'KM', 'Clasificacion',
+    'M Pesadas todos', "M CPE's", 'M Descargas todos', 'M Tarifa Segun la OC (manual)',
+    'M Precio acordado (manual)'
+]
+
+ENCABEZADOS_PESADAS = [
+    'Nº', 'Fecha', 'Mes', 'Año', 'Producto', 'Cantidad', '     Bruto', '     Tara', 'Neto',
+    '           Destino', 'Origen', 'Placa Camion', 'Tranportista', 'Carta de porte/Remito',
+    'Chofer', 'Rubro (GAN O AGR)', 'Extras', 'Campo', 'Clasificacion', 'Verificado Duplicado'
+]
+
+ENCABEZADOS_DESCARGAS = [
+    'Comprador', 'Fecha Descarga', 'Destino', 'Cliente', 'Contrato', 'Ticket', 'Producto',
+    'Cosecha', 'Campo', 'Orígen', 'Kilometros', 'Carta de porte/Remito', 'CTG', 'Peso Bruto',
+    'Tara', 'Merma', 'Peso Neto', 'Humedad', 'Zaranda', 'Chamico', 'Dañado', 'Proteina',
+    'Observaciones', 'Estado', 'Analisis', 'Puerto', 'Placa Camion', 'Nombre Transporte'
+]
+
+ENCABEZADOS_CPE = [
+    'ctg', 'numero_cpe', 'fecha_documento', 'tipo_cpe', 'estado', 'sucursal', 'nro_orden',
+    'titular_cuit', 'titular', 'remitente_cuit', 'remitente', 'destinatario_cuit', 'destinatario',
+    'transportista_cuit', 'transportista', 'chofer_cuit', 'chofer', 'grano_tipo', 'cosecha',
+    'localidad_origen', 'planta_origen', 'km_recorrer', 'localidad_destino', 'planta_destino',
+    'peso_bruto', 'peso_tara', 'dominios_vehiculos'
+]
+
+PRODUCTOS = ['Soja', 'Maíz', 'Trigo', 'Girasol', 'Sorgo']
+VARIANTES_PRODUCTO = {
+    'Soja': ['soja', 'SOJA', 'Soja 2da', 'soya'],
+    'Maíz': ['maiz', 'MAIZ', 'Maíz', 'maíz colorado'],
+    'Trigo': ['trigo', 'TRIGO', 'Trigo pan'],
+    'Girasol': ['girasol', 'GIRASOL'],
+    'Sorgo': ['sorgo', 'SORGO'],
+}
+LOCALIDADES = ['Rosario', 'Pergamino', 'Junín', 'Venado Tuerto', 'Rufino', 'Casilda', 'Timbúes',
+               'San Lorenzo', 'Bahía Blanca', 'Necochea']
+TRANSPORTISTAS = ['Transportes del Sur SRL', 'Logística Pampa SA', 'Fletes Rufino', 'El Trébol SRL',
+                  'Hnos. García', 'Cargas Litoral SA']
+CHOFERES = ['Juan Pérez', 'Carlos Gómez', 'Miguel Fernández', 'Raúl Díaz', 'Sergio López',
+            'Jorge Martínez', 'Luis Romero', 'Diego Sosa']
+
+FECHA_INICIO = date(2024, 1, 1)
+
+# Procesos medidos (funciones de app.py, el agente y DataLoader.get_fletes)
+PROCESOS = [
+    'cargar_cpes', 'asignar_cpes', 'matchear_pesadas_fletes', 'matchear_descargas_fletes',
+    'traer_cpes_a_fletes', 'ejecutar_autocompletado', 'get_fletes'
+]
+
+
+def numero_ar(valor, decimales=0):
+    """30250.5 -> '30.250,50' (formato argentino: punto de miles, coma decimal)"""
+    texto = f"{valor:,.{decimales}f}"
+    return texto.replace(',', 'X').replace('.', ',').replace('X', '.')
+
+
+def patente_aleatoria(rnd):
+    """Patente Mercosur (AB123CD) o vieja (ABC123)"""
+    letras = 'ABCDEFGHIJKLMNOPRSTUVWXYZ'
+    if rnd.random() < 0.7:
+        return (rnd.choice(letras) + rnd.choice(letras) + f"{rnd.randint(0, 999):03d}" +
+                rnd.choice(letras) + rnd.choice(letras))
+    return ''.join(rnd.choice(letras) for _ in range(3)) + f"{rnd.randint(0, 999):03d}"
+
+
+def escribir_patente(patente, rnd):
+    """Variantes de carga manual: espacios, guiones o minúsculas"""
+    forma = rnd.random()
+    if forma < 0.2:
+        return f"{patente[:2]} {patente[2:5]} {patente[5:]}".strip()
+    if forma < 0.3:
+        return f"{patente[:3]}-{patente[3:]}"
+    if forma < 0.4:
+        return patente.lower()
+    return patente
+
+
+def generar_datos(filas, semilla=0):
+    """
+    Genera las cuatro hojas con ~`filas` filas cada una, con la forma de los datos reales:
+    arrays JSON de patentes en la columna AA de CPE, números con formato argentino,
+    patentes repetidas entre CPEs y pesadas entre 0 y 7 días antes de su CPE.
+    Retorna {spreadsheet_id: {hoja: [[fila], ...]}}, listo para ClienteLocal.desde_datos.
+    """
+    from app import CONFIG
+
+    rnd = random.Random(semilla)
+    flota = [patente_aleatoria(rnd) for _ in range(max(filas // 4, 10))]
+
+    cpe = [ENCABEZADOS_CPE]
+    pesadas = [ENCABEZADOS_PESADAS]
+    descargas = [ENCABEZADOS_DESCARGAS]
+    fletes = [ENCABEZADOS_FLETES]
+
+    for i in range(filas):
+        ctg = str(10100000000 + i)
+        numero_cpe = f"{rnd.randint(1, 20):05d}-{i + 1:08d}"
+        fecha = FECHA_INICIO + timedelta(days=rnd.randint(0, 364))
+        producto = rnd.choice(PRODUCTOS)
+        camion, acoplado = rnd.choice(flota), rnd.choice(flota)
+        transportista = rnd.choice(TRANSPORTISTAS)
+        chofer = rnd.choice(CHOFERES)
+        origen, destino = rnd.sample(LOCALIDADES, 2)
+        neto = rnd.randint(25000, 32000)
+
+        fila = [''] * len(ENCABEZADOS_CPE)
+        fila[0], fila[1], fila[2] = ctg, numero_cpe, fecha.strftime('%Y-%m-%d')
+        fila[14], fila[16], fila[17] = transportista, chofer, producto
+        fila[19], fila[22] = origen, destino
+        fila[24], fila[25] = str(neto + 15000), '15000'
+        fila[26] = json.dumps([camion, acoplado])
+        cpe.append(fila)
+
+        # Pesada en campo: 0-7 días antes de la CPE; algunas sin CPE, otras ya asignadas
+        if rnd.random() < 0.85:
+            fecha_pesada = fecha - timedelta(days=rnd.randint(0, 7))
+            fila = [''] * len(ENCABEZADOS_PESADAS)
+            fila[0] = str(i + 1)
+            fila[1] = fecha_pesada.strftime('%d/%m/%Y')
+            fila[2], fila[3] = str(fecha_pesada.month), str(fecha_pesada.year)
+            fila[4] = rnd.choice(VARIANTES_PRODUCTO[producto])
+            fila[6], fila[7], fila[8] = numero_ar(neto + 15000), numero_ar(15000), numero_ar(neto)
+            fila[9], fila[10] = destino, origen
+            fila[11] = escribir_patente(camion, rnd)
+            fila[12], fila[14] = transportista, chofer
+            if rnd.random() < 0.1:
+                fila[13] = numero_cpe
+            pesadas.append(fila)
+
+        # Descarga en destino, con merma
+        if rnd.random() < 0.75:
+            fila = [''] * len(ENCABEZADOS_DESCARGAS)
+            fila[0], fila[1], fila[2] = 'Acopio', (fecha + timedelta(days=1)).strftime('%d/%m/%Y'), destino
+            fila[6], fila[9] = producto.upper(), origen
+            fila[11], fila[12] = numero_cpe, ctg.zfill(12) if rnd.random() < 0.1 else ctg
+            fila[16] = numero_ar(neto - rnd.randint(0, 150), 2)
+            fila[26], fila[27] = camion, transportista.upper() if rnd.random() < 0.2 else transportista
+            descargas.append(fila)
+
+        # Flete facturado: la mayoría con un CTG conocido, algunos con CTG inexistente
+        if rnd.random() < 0.9:
+            fila = [''] * len(ENCABEZADOS_FLETES)
+            fila[0] = f"A-0001-{i + 1:08d}"
+            fila[1] = (fecha + timedelta(days=rnd.randint(1, 20))).strftime('%d/%m/%Y')
+            fila[3] = numero_ar(neto, 2)
+            fila[4] = ctg if rnd.random() < 0.9 else str(20100000000 + i)
+            tarifa = rnd.randint(15, 40) * 1000
+            subtotal = tarifa * neto / 1000
+            fila[10], fila[11], fila[12] = numero_ar(subtotal, 2), numero_ar(subtotal * 0.21, 2), numero_ar(subtotal * 1.21, 2)
+            fila[13], fila[14] = numero_ar(tarifa), str(rnd.randint(30, 400))
+            if rnd.random() < 0.3:
+                fila[6], fila[8] = origen, transportista.lower()
+            fletes.append(fila)
+
+    # Pesadas desordenadas como en la hoja real
+    cuerpo = pesadas[1:]
+    rnd.shuffle(cuerpo)
+    pesadas = [pesadas[0]] + cuerpo
+
+    return {
+        CONFIG['CPE_SPREADSHEET_ID']: {
+            CONFIG['CPE_SHEET_NAME']: cpe,
+            CONFIG['FLETES_SHEET_NAME']: fletes,
+            CONFIG['DESCARGAS_SHEET_NAME']: descargas,
+        },
+        CONFIG['PESADAS_SPREADSHEET_ID']: {
+            CONFIG['PESADAS_SHEET_NAME']: pesadas,
+        },
+    }
+
+
+def _ejecutar(proceso, cliente):
+    """Corre un proceso contra el cliente local; retorna el resultado (o None)"""
+    import app
+    if proceso == 'cargar_cpes':
+        return {'patentes': sum(1 for lista in app.cargar_cpes(cliente) if lista)}
+    if proceso == 'ejecutar_autocompletado':
+        from agent_autocomplete import ejecutar_autocompletado
+        return ejecutar_autocompletado()
+    if proceso == 'get_fletes':
+        from data_loader import DataLoader
+        return {'filas': len(DataLoader().get_fletes(use_cache=False))}
+    return getattr(app, proceso)()
+
+
+def medir(datos, proceso, repeticiones):
+    """Tiempo de `proceso` sobre una copia fresca de `datos` en cada repetición"""
+    tiempos = []
+    contadores = None
+    for _ in range(repeticiones):
+        cliente = ClienteLocal.desde_datos(datos)
+        usar_cliente_local(cliente)
+        inicio = time.perf_counter()
+        resultado = _ejecutar(proceso, cliente)
+        tiempos.append(time.perf_counter() - inicio)
+        contadores = cliente.contadores()
+        if isinstance(resultado, dict) and resultado.get('success') is False:
+            raise RuntimeError(f"{proceso}: {resultado.get('error')}")
+    return {
+        'segundos_min': min(tiempos),
+        'segundos_mediana': statistics.median(tiempos),
+        'repeticiones': repeticiones,
+        'llamadas': contadores['total_llamadas'],
+        'celdas_escritas': sum(contadores['celdas_escritas'].values())
+    }
+
+
+def _commit_actual():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return ''
+
+
+def correr(tamanios, procesos=PROCESOS, repeticiones=3, semilla=0):
+    """Corre el benchmark completo y retorna el dict que se guarda en JSON"""
+    resultados = []
+    for tamanio in tamanios:
+        datos = generar_datos(tamanio, semilla)
+        for proceso in procesos:
+            medicion = medir(datos, proceso, repeticiones)
+            medicion.update({'tamanio': tamanio, 'proceso': proceso})
+            resultados.append(medicion)
+            print(f"{tamanio:>8} filas  {proceso:<28} {medicion['segundos_mediana']:.3f}s  "
+                  f"({medicion['llamadas']} llamadas)")
+    return {
+        'commit': _commit_actual(),
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'semilla': semilla,
+        'resultados': resultados
+    }
+
+
+def comparar(actual, anterior):
+    """Imprime la relación de tiempos (mediana) contra una corrida anterior"""
+    previos = {(r['tamanio'], r['proceso']): r for r in anterior['resultados']}
+    print(f"\nComparación contra {anterior.get('commit') or 'corrida anterior'}:")
+    for r in actual['resultados']:
+        previo = previos.get((r['tamanio'], r['proceso']))
+        if not previo or not previo['segundos_mediana']:
+            continue
+        relacion = r['segundos_mediana'] / previo['segundos_mediana']
+        marca = '  <-- más lento' if relacion > 1.2 else ''
+        print(f"{r['tamanio']:>8} filas  {r['proceso']:<28} x{relacion:.2f}{marca}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark del pipeline de matching')
+    parser.add_argument('--tamanios', default='1000,10000',
+                        help='Filas por hoja, separadas por coma (p.ej. 1000,10000,100000,500000)')
+    parser.add_argument('--procesos', default=','.join(PROCESOS))
+    parser.add_argument('--repeticiones', type=int, default=3)
+    parser.add_argument('--semilla', type=int, default=0)
+    parser.add_argument('--salida', default='bench_output.json')
+    parser.add_argument('--comparar', help='JSON de una corrida anterior')
+    args = parser.parse_args()
+
+    resultado = correr([int(t) for t in args.tamanios.split(',')],
+                       args.procesos.split(','), args.repeticiones, args.semilla)
+
+    with open(args.salida, 'w', encoding='utf-8') as f:
+        json.dump(resultado, f, indent=2)
+    print(f"\nResultados guardados en {args.salida}")
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            comparar(resultado, json.load(f))
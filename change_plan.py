@@ -0,0 +1,126 @@
+"""
+Plan de Cambios - Lista estructurada de celdas a modificar por un procesador
+(celda, valor anterior, valor nuevo y motivo), que se puede revisar, comparar,
+guardar como JSON y aplicar más tarde con un WriteBuffer.
+"""
+
+import json
+import gspread
+
+from write_buffer import WriteBuffer
+
+
+class PlanCambios:
+    """Cambios propuestos por un procesador, en orden de generación"""
+
+    def __init__(self, proceso=''):
+        self.proceso = proceso
+        self.cambios = []
+        self._hojas = {}  # (spreadsheet_id, titulo) -> worksheet
+
+    def __len__(self):
+        return len(self.cambios)
+
+    def agregar(self, hoja, fila, col, anterior, nuevo, motivo, formato=None):
+        """Registra un cambio de celda (fila y columna base 1)"""
+        self._hojas[(hoja.spreadsheet_id, hoja.title)] = hoja
+        self.cambios.append({
+            'spreadsheet_id': hoja.spreadsheet_id,
+            'hoja': hoja.title,
+            'celda': gspread.utils.rowcol_to_a1(fila, col),
+            'fila': fila,
+            'col': col,
+            'anterior': anterior,
+            'nuevo': nuevo,
+            'motivo': motivo,
+            'formato': formato
+        })
+
+    def resumen(self):
+        """Cantidad de cambios por motivo"""
+        por_motivo = {}
+        for cambio in self.cambios:
+            por_motivo[cambio['motivo']] = por_motivo.get(cambio['motivo'], 0) + 1
+        return por_motivo
+
+    def to_dict(self):
+        return {'proceso': self.proceso, 'cambios': self.cambios}
+
+    @classmethod
+    def from_dict(cls, data):
+        plan = cls(data.get('proceso', ''))
+        plan.cambios = list(data.get('cambios', []))
+        return plan
+
+    def guardar(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=1)
+
+    @classmethod
+    def cargar(cls, path):
+        with open(path, encoding='utf-8') as f:
+            return cls.from_dict(json.load(f))
+
+    def diff(self, otro):
+        """
+        Compara con otro plan (p.ej. el mismo proceso con otra regla de matching).
+        Retorna {'agregados', 'quitados', 'modificados'} por celda.
+        """
+        def indexar(plan):
+            return {(c['spreadsheet_id'], c['hoja'], c['celda']): c for c in plan.cambios}
+
+        antes, despues = indexar(self), indexar(otro)
+        return {
+            'agregados': [despues[k] for k in despues if k not in antes],
+            'quitados': [antes[k] for k in antes if k not in despues],
+            'modificados': [
+                {'celda': despues[k]['celda'], 'hoja': despues[k]['hoja'],
+                 'antes': antes[k]['nuevo'], 'despues': despues[k]['nuevo']}
+                for k in despues if k in antes and antes[k]['nuevo'] != despues[k]['nuevo']
+            ]
+        }
+
+    def _get_hoja(self, gc, spreadsheet_id, titulo):
+        clave = (spreadsheet_id, titulo)
+        if clave not in self._hojas:
+            if gc is None:
+                raise ValueError(f"Se necesita un cliente para abrir la hoja '{titulo}'")
+            self._hojas[clave] = gc.open_by_key(spreadsheet_id).worksheet(titulo)
+        return self._hojas[clave]
+
+    def aplicar(self, buffer=None, gc=None, verificar=False):
+        """
+        Carga los cambios en un WriteBuffer. Si no se pasa buffer, usa uno propio y hace flush.
+        Con verificar=True relee cada hoja una vez y saltea las celdas cuyo valor actual
+        ya no coincide con `anterior` (el plan quedó viejo); se informan como conflictos.
+        """
+        propio = buffer is None
+        if propio:
+            buffer = WriteBuffer()
+
+        actuales = {}
+        conflictos = []
+        aplicados = 0
+        for cambio in self.cambios:
+            hoja = self._get_hoja(gc, cambio['spreadsheet_id'], cambio['hoja'])
+
+            if verificar:
+                clave = (cambio['spreadsheet_id'], cambio['hoja'])
+                if clave not in actuales:
+                    actuales[clave] = buffer.superponer(hoja, hoja.get_all_values())
+                datos = actuales[clave]
+                fila = datos[cambio['fila'] - 1] if len(datos) >= cambio['fila'] else []
+                actual = fila[cambio['col'] - 1] if len(fila) >= cambio['col'] else ''
+                if actual != (cambio['anterior'] or ''):
+                    conflictos.append(dict(cambio, actual=actual))
+                    continue
+
+            buffer.escribir(hoja, cambio['fila'], cambio['col'], cambio['nuevo'])
+            if cambio.get('formato'):
+                buffer.formatear(hoja, cambio['fila'], cambio['col'], cambio['formato'])
+            aplicados += 1
+
+        resultado = {'aplicados': aplicados, 'conflictos': conflictos}
+        if propio:
+            resultado['escritura'] = buffer.flush()
+        return resultado
@@ -0,0 +1,85 @@
+"""
+Claves - Interning de patentes, CTGs y números de CPE a enteros densos.
+Cada valor de la hoja se normaliza una sola vez por snapshot y se convierte en un id
+(0..n-1); los índices de los joins quedan como listas o arrays de NumPy indexados por
+id y los conjuntos de "ya usadas" como sets de enteros.
+
+El id -1 significa "clave vacía o desconocida": las listas y arrays se arman con un
+lugar de más al final, así indexar con -1 devuelve el valor vacío sin chequear.
+"""
+
+import numpy as np
+
+from normalizacion import (normalizar_patente, patentes_columna, extraer_patentes, normalizar_ctg,
+                           ctgs_columna, normalizar_cpe, cpes_columna)
+
+
+class TablaClaves:
+    """Clave canónica <-> id entero denso"""
+
+    def __init__(self, normalizar, normalizar_columna):
+        self.normalizar = normalizar
+        self.normalizar_columna = normalizar_columna
+        self.claves = []      # id -> clave canónica
+        self._ids = {}        # clave canónica -> id
+        self._crudos = {}     # valor tal como viene en la hoja -> id (no se renormaliza)
+
+    def __len__(self):
+        return len(self.claves)
+
+    def id(self, crudo):
+        """Id de un valor de la hoja, agregándolo si es nuevo (-1 si queda vacío)"""
+        i = self._crudos.get(crudo)
+        if i is None:
+            clave = self.normalizar(crudo)
+            if not clave:
+                i = -1
+            else:
+                i = self._ids.get(clave)
+                if i is None:
+                    i = len(self.claves)
+                    self._ids[clave] = i
+                    self.claves.append(clave)
+            self._crudos[crudo] = i
+        return i
+
+    def buscar(self, crudo):
+        """Id de un valor sin agregarlo (-1 si está vacío o no está en la tabla)"""
+        i = self._crudos.get(crudo)
+        if i is not None:
+            return i
+        clave = self.normalizar(crudo)
+        return self._ids.get(clave, -1) if clave else -1
+
+    def ids(self, serie):
+        """buscar() sobre una columna entera: array de ids (-1 donde no hay clave)"""
+        return self.normalizar_columna(serie).map(self._ids).fillna(-1).to_numpy(dtype=np.int64)
+
+    def lista(self, vacio=None):
+        """Lista indexable por id (con el lugar extra para -1)"""
+        return [vacio] * (len(self.claves) + 1)
+
+    def arreglo(self, valores):
+        """Array de objetos indexable por id a partir de {id: valor} (None donde falta)"""
+        arr = np.full(len(self.claves) + 1, None, dtype=object)
+        for i, valor in valores.items():
+            arr[i] = valor
+        return arr
+
+
+class Claves:
+    """Tablas de patentes, CTGs y números de CPE de un snapshot, en su forma canónica (normalizacion)"""
+
+    def __init__(self):
+        self.patentes = TablaClaves(normalizar_patente, patentes_columna)
+        self.ctgs = TablaClaves(normalizar_ctg, ctgs_columna)
+        self.cpes = TablaClaves(normalizar_cpe, cpes_columna)
+        self._arrays_patentes = {}  # texto del array de dominios -> tupla de ids
+
+    def ids_patentes(self, crudo):
+        """Ids de todas las patentes de un array de dominios (camión + acoplado), sin repetir el parseo"""
+        ids = self._arrays_patentes.get(crudo)
+        if ids is None:
+            ids = tuple(i for i in (self.patentes.id(p) for p in extraer_patentes(crudo)) if i >= 0)
+            self._arrays_patentes[crudo] = ids
+        return ids
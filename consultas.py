@@ -0,0 +1,260 @@
+"""
+Consultas - Motor SQL de solo lectura sobre los DataFrames cacheados de DataLoader
+(Fletes, Pesadas, Descargas y CPE), para los cortes puntuales que piden los operadores
+(merma por destino y mes, fletes por chofer) sin tocar update_dashboard ni la API de
+Sheets. Lo usan el endpoint /query (app.py) y la página Explorar del dashboard.
+
+Usa DuckDB (columnar) si está instalado y, si no, una base SQLite en memoria con las
+mismas tablas. Cada tabla se recarga solo cuando cambia la versión del snapshot de su
+hoja; los resultados se cachean por texto de la consulta y versiones de los snapshots.
+    CONSULTAS_MAX_FILAS=5000    filas que se devuelven como máximo por consulta
+    CONSULTAS_TIMEOUT=10        segundos antes de cancelar una consulta
+"""
+
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal
+
+import pandas as pd
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+from data_loader import data_loader
+from espejo import TABLA_PATENTES_CPE, _columnas_sql
+from metrics import contar
+
+MAX_FILAS = int(os.environ.get('CONSULTAS_MAX_FILAS', '5000'))
+TIMEOUT = float(os.environ.get('CONSULTAS_TIMEOUT', '10'))
+
+# Hojas de DataLoader que se exponen como tablas (más TABLA_PATENTES_CPE, derivada de cpe)
+TABLAS = ('fletes', 'pesadas', 'descargas', 'cpe')
+
+# Resultados que se conservan en el cache (los más recientes)
+MAX_RESULTADOS = 256
+
+# Comentarios iniciales y primera palabra de la consulta
+_LECTURA = re.compile(r'^\s*(?:(?:--[^\n]*(?:\n|$)|/\*.*?\*/)\s*)*\(*\s*(select|with)\b', re.I | re.S)
+
+# Acciones que el autorizador de SQLite deja pasar: solo lecturas
+_ACCIONES_LECTURA = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION,
+                     getattr(sqlite3, 'SQLITE_RECURSIVE', 33)}
+
+# Consultas de ejemplo para la página Explorar
+EJEMPLOS = {
+    'Merma por destino y mes': (
+        "SELECT destino, strftime('%Y-%m', fecha_dt) AS mes, COUNT(*) AS fletes,\n"
+        "       SUM(merma_kg) AS merma_kg, ROUND(AVG(merma_pct), 3) AS merma_pct\n"
+        "FROM fletes\n"
+        "WHERE merma_kg IS NOT NULL\n"
+        "GROUP BY 1, 2\n"
+        "ORDER BY 2 DESC, 4 DESC"
+    ),
+    'Fletes por chofer': (
+        "SELECT chofer, COUNT(*) AS fletes, SUM(m_pesadas_num) AS kg_pesados,\n"
+        "       SUM(total_num) AS facturado\n"
+        "FROM fletes\n"
+        "WHERE chofer <> ''\n"
+        "GROUP BY chofer\n"
+        "ORDER BY fletes DESC"
+    ),
+    'Patentes con más CPEs': (
+        "SELECT patente_norm, COUNT(*) AS cpes, MIN(fecha_dt) AS primera, MAX(fecha_dt) AS ultima\n"
+        "FROM cpe_patentes\n"
+        "GROUP BY patente_norm\n"
+        "ORDER BY cpes DESC"
+    ),
+}
+
+
+def preparar(df):
+    """
+    DataFrame de DataLoader como tabla de consulta: nombres de columna SQL (los del espejo),
+    `fila` con el número de fila en la hoja y las columnas numéricas guardadas como object
+    (merma_kg, merma_pct...) pasadas a float. Las tuplas de patentes van en patentes_cpe().
+    """
+    columnas = {'fila': df.index.to_numpy() + 2}
+    for col, nombre, _ in _columnas_sql(df):
+        serie = df[col]
+        if serie.dtype == object and pd.api.types.infer_dtype(serie, skipna=True) in (
+                'floating', 'integer', 'mixed-integer-float', 'decimal', 'empty'):
+            serie = pd.to_numeric(serie, errors='coerce')
+        columnas[nombre] = serie.to_numpy()
+    marco = pd.DataFrame(columnas)
+    # El texto como object: DuckDB lo lee bastante más rápido que el dtype str de pandas
+    return marco.astype({c: object for c in marco.columns if pd.api.types.is_string_dtype(marco[c])})
+
+
+def patentes_cpe(df):
+    """Una fila por patente de cada CPE (camión + acoplado), como TABLA_PATENTES_CPE del espejo"""
+    if 'patentes' not in df:
+        return pd.DataFrame({'fila': [], 'patente_norm': [], 'fecha_dt': []})
+    patentes = df['patentes'].explode().dropna()
+    return pd.DataFrame({
+        'fila': patentes.index.to_numpy() + 2,
+        'patente_norm': patentes.to_numpy(),
+        'fecha_dt': (df['fecha_dt'] if 'fecha_dt' in df else pd.Series(pd.NaT, index=df.index))
+        .loc[patentes.index].to_numpy(),
+    })
+
+
+def _solo_lectura(accion, *args):
+    """Autorizador de SQLite: rechaza todo lo que no sea leer"""
+    return sqlite3.SQLITE_OK if accion in _ACCIONES_LECTURA else sqlite3.SQLITE_DENY
+
+
+def _valor(v):
+    """Valor de una celda del resultado apto para JSON"""
+    if v is None or isinstance(v, (bool, int, str)):
+        return v
+    if isinstance(v, float):
+        return None if v != v else v
+    if isinstance(v, (datetime, date)):
+        return v.isoformat()
+    if isinstance(v, Decimal):
+        return float(v)
+    return str(v)
+
+
+class MotorConsultas:
+    """Tablas de consulta con los DataFrames de DataLoader y cache de resultados"""
+
+    def __init__(self, loader=data_loader):
+        self.loader = loader
+        self.motor = 'duckdb' if duckdb is not None else 'sqlite'
+        self._lock = threading.Lock()
+        self._versiones = {}                  # tabla -> versión del snapshot cargado
+        self._esquema = {}                    # tabla -> [(columna, tipo)]
+        self._resultados = OrderedDict()      # (consulta, versiones, max_filas) -> resultado
+        if self.motor == 'duckdb':
+            self._conn = duckdb.connect()
+            # Sin acceso a archivos ni a la red (read_csv, ATTACH, COPY...), y sin poder revertirlo
+            self._conn.execute('SET enable_external_access = false')
+            self._conn.execute('SET lock_configuration = true')
+        else:
+            self._conn = sqlite3.connect(':memory:', check_same_thread=False)
+            self._conn.set_authorizer(_solo_lectura)
+
+    def _sincronizar(self):
+        """Carga (o refresca si venció) las hojas y recarga las tablas cuya versión cambió"""
+        marcos = {tabla: self.loader.marco(tabla) for tabla in TABLAS}
+        versiones = tuple(self.loader.version(tabla) for tabla in TABLAS)
+        with self._lock:
+            cambiadas = {t: v for t, v in zip(TABLAS, versiones) if self._versiones.get(t) != v}
+            for tabla, version in cambiadas.items():
+                self._cargar(tabla, marcos[tabla])
+                self._versiones[tabla] = version
+            if cambiadas:
+                # Los resultados de snapshots anteriores ya no se pueden pedir
+                self._resultados = OrderedDict((k, v) for k, v in self._resultados.items() if k[1] == versiones)
+        return versiones
+
+    def _cargar(self, tabla, df):
+        tablas = {tabla: preparar(df)}
+        if tabla == 'cpe':
+            tablas[TABLA_PATENTES_CPE] = patentes_cpe(df)
+        for nombre, marco in tablas.items():
+            if self.motor == 'duckdb':
+                self._conn.register('_carga', marco)
+                try:
+                    self._conn.execute(f'CREATE OR REPLACE TABLE "{nombre}" AS SELECT * FROM _carga')
+                finally:
+                    self._conn.unregister('_carga')
+                self._esquema[nombre] = [(c[0], c[1]) for c in self._conn.execute(f'DESCRIBE "{nombre}"').fetchall()]
+            else:
+                self._conn.set_authorizer(None)
+                try:
+                    marco.to_sql(nombre, self._conn, if_exists='replace', index=False)
+                    self._esquema[nombre] = [(c[1], c[2]) for c in self._conn.execute(f'PRAGMA table_info("{nombre}")')]
+                finally:
+                    self._conn.set_authorizer(_solo_lectura)
+        contar(f'consultas_carga_{tabla}')
+
+    def esquema(self):
+        """{tabla: [(columna, tipo)]} de las tablas consultables"""
+        self._sincronizar()
+        with self._lock:
+            return dict(self._esquema)
+
+    def consultar(self, sql, max_filas=None):
+        """
+        Ejecuta una consulta SELECT (o WITH ... SELECT) sobre las tablas fletes, pesadas,
+        descargas, cpe y cpe_patentes. Retorna {columnas, filas, truncado, motor, ms, cache}
+        con a lo sumo max_filas filas (tope MAX_FILAS). ValueError si no es de solo lectura.
+        """
+        texto = (sql or '').strip().rstrip(';').strip()
+        if not texto:
+            raise ValueError('Consulta vacía')
+        if not _LECTURA.match(texto):
+            raise ValueError('Solo se permiten consultas de lectura (SELECT o WITH ... SELECT)')
+        max_filas = min(MAX_FILAS, max_filas or MAX_FILAS)
+
+        versiones = self._sincronizar()
+        clave = (texto, versiones, max_filas)
+        with self._lock:
+            resultado = self._resultados.get(clave)
+            if resultado is not None:
+                self._resultados.move_to_end(clave)
+        if resultado is not None:
+            contar('consultas_cache_hit')
+            return dict(resultado, cache=True)
+
+        contar('consultas_cache_miss')
+        inicio = time.perf_counter()
+        columnas, filas = self._ejecutar(texto, max_filas + 1)
+        resultado = {
+            'columnas': columnas,
+            'filas': [[_valor(v) for v in fila] for fila in filas[:max_filas]],
+            'truncado': len(filas) > max_filas,
+            'motor': self.motor,
+            'ms': round((time.perf_counter() - inicio) * 1000, 1),
+        }
+        with self._lock:
+            # Si otra consulta recargó tablas mientras tanto, el resultado no se guarda
+            if tuple(self._versiones.get(t) for t in TABLAS) == versiones:
+                self._resultados[clave] = resultado
+                while len(self._resultados) > MAX_RESULTADOS:
+                    self._resultados.popitem(last=False)
+        return dict(resultado, cache=False)
+
+    def _ejecutar(self, texto, limite):
+        """(columnas, primeras `limite` filas) de la consulta, cancelándola a los TIMEOUT segundos"""
+        if self.motor == 'duckdb':
+            sentencias = duckdb.extract_statements(texto)
+            if len(sentencias) != 1 or sentencias[0].type != duckdb.StatementType.SELECT:
+                raise ValueError('Solo se permite una consulta SELECT por vez')
+            cursor = self._conn.cursor()
+            reloj = threading.Timer(TIMEOUT, cursor.interrupt)
+            reloj.start()
+            try:
+                cursor.execute(texto)
+                return [d[0] for d in cursor.description], cursor.fetchmany(limite)
+            except duckdb.InterruptException:
+                raise TimeoutError(f'La consulta superó {TIMEOUT:g} s y se canceló')
+            finally:
+                reloj.cancel()
+                cursor.close()
+
+        vence = time.monotonic() + TIMEOUT
+        with self._lock:
+            self._conn.set_progress_handler(lambda: time.monotonic() > vence, 10000)
+            try:
+                cursor = self._conn.execute(texto)
+                return [d[0] for d in cursor.description or []], cursor.fetchmany(limite)
+            except sqlite3.OperationalError:
+                if time.monotonic() > vence:
+                    raise TimeoutError(f'La consulta superó {TIMEOUT:g} s y se canceló')
+                raise
+            finally:
+                self._conn.set_progress_handler(None, 0)
+
+
+# Instancia global
+motor_consultas = MotorConsultas()
@@ -0,0 +1,219 @@
+"""
+Perfilado de Callbacks - Middleware opcional para el servidor de Dash.
+Mide cada request a /_dash-update-component: tiempo, bytes de entrada y salida,
+y aciertos/fallos del cache de DataLoader; guarda un histograma móvil por callback
+y, si se configura, el perfil (cProfile o pyinstrument) de los requests lentos.
+
+Se activa con DASH_PERF=1; los resultados se ven en /debug/perf.
+    DASH_PERF_PROFILER=cprofile|pyinstrument   perfilar requests (por defecto no)
+    DASH_PERF_UMBRAL_MS=1000                   guardar el perfil solo si tarda más
+"""
+
+import cProfile
+import html
+import io
+import json
+import os
+import pstats
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from flask import Response, g, request
+
+from metrics import medir
+
+HABILITADO = os.environ.get('DASH_PERF', '0') == '1'
+PROFILER = os.environ.get('DASH_PERF_PROFILER', '')
+UMBRAL_MS = float(os.environ.get('DASH_PERF_UMBRAL_MS', '1000'))
+
+# Muestras que se guardan por callback para percentiles
+VENTANA = 500
+
+# Límites (ms) de los buckets del histograma
+BUCKETS_MS = [50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf')]
+
+# Perfiles de requests lentos que se conservan
+MAX_PERFILES = 10
+
+RUTA_CALLBACKS = '/_dash-update-component'
+
+
+class RegistroCallbacks:
+    """Histograma móvil y totales por callback"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks = {}
+        self.perfiles = deque(maxlen=MAX_PERFILES)
+
+    def registrar(self, nombre, ms, bytes_entrada, bytes_salida, contadores):
+        with self._lock:
+            cb = self._callbacks.setdefault(nombre, {
+                'muestras': deque(maxlen=VENTANA),
+                'buckets': [0] * len(BUCKETS_MS),
+                'llamadas': 0,
+                'bytes_entrada': 0,
+                'bytes_salida': 0,
+                'cache_hit': 0,
+                'cache_miss': 0
+            })
+            cb['muestras'].append(ms)
+            cb['buckets'][next(i for i, limite in enumerate(BUCKETS_MS) if ms <= limite)] += 1
+            cb['llamadas'] += 1
+            cb['bytes_entrada'] += bytes_entrada
+            cb['bytes_salida'] += bytes_salida
+            for nombre_contador, valor in contadores.items():
+                if nombre_contador.startswith('cache_hit_'):
+                    cb['cache_hit'] += valor
+                elif nombre_contador.startswith('cache_miss_'):
+                    cb['cache_miss'] += valor
+
+    def resumen(self):
+        def percentil(ordenadas, p):
+            return ordenadas[min(int(len(ordenadas) * p), len(ordenadas) - 1)]
+
+        with self._lock:
+            filas = []
+            for nombre, cb in self._callbacks.items():
+                ordenadas = sorted(cb['muestras'])
+                filas.append({
+                    'callback': nombre,
+                    'llamadas': cb['llamadas'],
+                    'p50_ms': round(percentil(ordenadas, 0.5), 1),
+                    'p95_ms': round(percentil(ordenadas, 0.95), 1),
+                    'max_ms': round(ordenadas[-1], 1),
+                    'kb_entrada_prom': round(cb['bytes_entrada'] / cb['llamadas'] / 1024, 1),
+                    'kb_salida_prom': round(cb['bytes_salida'] / cb['llamadas'] / 1024, 1),
+                    'cache_hit': cb['cache_hit'],
+                    'cache_miss': cb['cache_miss'],
+                    'histograma': dict(zip([str(b) for b in BUCKETS_MS], cb['buckets']))
+                })
+        return sorted(filas, key=lambda f: -f['p95_ms'])
+
+
+registro = RegistroCallbacks()
+
+
+def _nombre_callback(app_dash, output):
+    """Nombre de la función del callback a partir del 'output' del request"""
+    info = app_dash.callback_map.get(output)
+    if info and info.get('callback') is not None:
+        return info['callback'].__name__
+    return output
+
+
+def _iniciar_profiler():
+    if PROFILER == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+            return ('pyinstrument', profiler)
+        except ImportError:
+            pass
+    if PROFILER:
+        try:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return ('cprofile', profiler)
+        except ValueError:
+            # Ya hay otro profiler activo (otro request en paralelo)
+            return None
+    return None
+
+
+def _texto_perfil(tipo, profiler):
+    if tipo == 'pyinstrument':
+        profiler.stop()
+        return profiler.output_text()
+    profiler.disable()
+    salida = io.StringIO()
+    pstats.Stats(profiler, stream=salida).sort_stats('cumulative').print_stats(30)
+    return salida.getvalue()
+
+
+def instalar(app_dash):
+    """Agrega el middleware y la página /debug/perf al servidor Flask de la app Dash"""
+    server = app_dash.server
+
+    @server.before_request
+    def _antes():
+        if request.path != RUTA_CALLBACKS or request.method != 'POST':
+            return
+        try:
+            output = (request.get_json(silent=True) or {}).get('output', '')
+        except Exception:
+            output = ''
+        g.perf_callback = _nombre_callback(app_dash, output)
+        g.perf_medicion = medir(f'callback:{g.perf_callback}')
+        g.perf_m = g.perf_medicion.__enter__()
+        g.perf_profiler = _iniciar_profiler()
+        g.perf_inicio = time.perf_counter()
+
+    @server.after_request
+    def _despues(respuesta):
+        if not hasattr(g, 'perf_inicio'):
+            return respuesta
+        ms = (time.perf_counter() - g.perf_inicio) * 1000
+        g.perf_medicion.__exit__(None, None, None)
+        registro.registrar(
+            g.perf_callback, ms,
+            request.content_length or 0,
+            respuesta.calculate_content_length() or 0,
+            g.perf_m.contadores
+        )
+        if g.perf_profiler:
+            tipo, profiler = g.perf_profiler
+            texto = _texto_perfil(tipo, profiler)
+            if ms >= UMBRAL_MS:
+                registro.perfiles.append({
+                    'callback': g.perf_callback,
+                    'ms': round(ms, 1),
+                    'hora': datetime.now().strftime('%H:%M:%S'),
+                    'perfil': texto
+                })
+        del g.perf_inicio
+        return respuesta
+
+    @server.teardown_request
+    def _cerrar(error=None):
+        # Si el callback lanzó una excepción no pasa por after_request
+        if hasattr(g, 'perf_inicio'):
+            g.perf_medicion.__exit__(None, None, None)
+            if g.perf_profiler:
+                _texto_perfil(*g.perf_profiler)
+            del g.perf_inicio
+
+    @server.route('/debug/perf')
+    def debug_perf():
+        """Latencia por callback (?formato=json para los datos crudos)"""
+        callbacks = registro.resumen()
+        if request.args.get('formato') == 'json':
+            return Response(json.dumps({'callbacks': callbacks, 'perfiles': list(registro.perfiles)},
+                                       ensure_ascii=False), mimetype='application/json')
+
+        filas = ''.join(
+            f"<tr><td>{html.escape(c['callback'])}</td><td>{c['llamadas']}</td><td>{c['p50_ms']}</td>"
+            f"<td>{c['p95_ms']}</td><td>{c['max_ms']}</td><td>{c['kb_entrada_prom']}</td>"
+            f"<td>{c['kb_salida_prom']}</td><td>{c['cache_hit']}/{c['cache_miss']}</td>"
+            f"<td>{' '.join(f'≤{b}:{n}' for b, n in c['histograma'].items() if n)}</td></tr>"
+            for c in callbacks
+        )
+        perfiles = ''.join(
+            f"<h4>{html.escape(p['callback'])} — {p['ms']} ms ({p['hora']})</h4>"
+            f"<pre>{html.escape(p['perfil'])}</pre>"
+            for p in reversed(registro.perfiles)
+        )
+        return (
+            "<html><head><title>Perf callbacks</title></head><body style='font-family:sans-serif'>"
+            "<h2>Latencia de callbacks</h2>"
+            "<table border='1' cellpadding='4' cellspacing='0'>"
+            "<tr><th>Callback</th><th>Llamadas</th><th>p50 ms</th><th>p95 ms</th><th>Máx ms</th>"
+            "<th>KB entrada</th><th>KB salida</th><th>Cache hit/miss</th><th>Histograma (ms)</th></tr>"
+            f"{filas}</table>"
+            f"<h2>Requests lentos (≥ {UMBRAL_MS:g} ms)</h2>"
+            f"{perfiles or '<p>Sin perfiles (configurar DASH_PERF_PROFILER).</p>'}"
+            "</body></html>"
+        )
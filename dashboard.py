@@ -12,6 +12,8 @@ import plotly.graph_objects as go
 import pandas as pd
 from datetime import datetime, timedelta
 from data_loader import data_loader
+from manual_edits import cola_ediciones
+from indice_revision import indice_revision
 import requests
 
 # Colores del tema agro
@@ -37,6 +39,28 @@ app = dash.Dash(
 
 server = app.server
 
+# Perfilado de callbacks (opcional, DASH_PERF=1): ver /debug/perf
+from dash_perf import HABILITADO as PERF_HABILITADO, instalar as instalar_perf
+if PERF_HABILITADO:
+    instalar_perf(app)
+
+
+@server.route('/metrics')
+def metrics():
+    """Tiempos por paso/fase y llamadas a Sheets acumulados, en formato Prometheus"""
+    from flask import Response
+    from metrics import prometheus
+    return Response(prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+@server.route('/ready')
+def ready():
+    """Readiness: 200 cuando terminó el warm-up (aunque sea degradado), 503 mientras tanto"""
+    from flask import jsonify
+    from warmup import estado
+    resultado = estado()
+    return jsonify(resultado), (200 if resultado['listo'] else 503)
+
 
 def create_kpi_card(title, value, icon, color, subtitle=None):
     """Crea una tarjeta KPI"""
@@ -66,6 +90,7 @@ def get_navbar():
                 dbc.NavItem(dbc.NavLink("Dashboard", href="/", active="exact", className="px-3")),
                 dbc.NavItem(dbc.NavLink("Procesadores", href="/procesadores", active="exact", className="px-3")),
                 dbc.NavItem(dbc.NavLink("Trabajo Manual", href="/trabajo-manual", active="exact", className="px-3")),
+                dbc.NavItem(dbc.NavLink("Explorar", href="/explorar", active="exact", className="px-3")),
             ], className="ms-auto", navbar=True)
         ], fluid=True),
         color="success",
@@ -459,6 +484,10 @@ def get_trabajo_manual_content():
             "Trabajo Manual"
         ], className="mb-4"),
 
+        # Estado de la cola de ediciones (se escriben en lote cada pocos segundos)
+        html.Div(id='estado-cola-ediciones'),
+        dcc.Interval(id='intervalo-cola-ediciones', interval=3000),
+
         dbc.Tabs([
             # Tab 1: Sin CPE
             dbc.Tab(label="Sin CPE", tab_id="tab-sin-cpe", children=[
@@ -510,6 +539,7 @@ def get_trabajo_manual_content():
                     ], className="shadow-sm"),
 
                     dcc.Store(id='store-fletes-sin-cpe'),
+                    dcc.Store(id='cambio-sin-cpe'),
                 ])
             ]),
 
@@ -591,6 +621,76 @@ def get_trabajo_manual_content():
     ], fluid=True, className="py-4")
 
 
+def get_explorar_content():
+    """Página Explorar: consultas SQL de solo lectura sobre los datos cacheados (consultas.py)"""
+    from consultas import motor_consultas, EJEMPLOS
+
+    try:
+        esquema = motor_consultas.esquema()
+    except Exception as e:
+        print(f"Error cargando el esquema de consultas: {e}")
+        esquema = {}
+
+    return dbc.Container([
+        html.H3([
+            html.I(className="fas fa-search me-2"),
+            "Explorar"
+        ], className="mb-4"),
+
+        dbc.Alert([
+            html.I(className="fas fa-info-circle me-2"),
+            html.Strong("¿Para qué sirve? "),
+            "Cortes puntuales sobre Fletes, Pesadas, Descargas y CPE con SQL (solo SELECT), "
+            "sin tocar Google Sheets: se consultan los datos ya cargados."
+        ], color="primary", className="mb-3"),
+
+        dbc.Row([
+            dbc.Col([
+                dbc.Card([
+                    dbc.CardBody([
+                        dcc.Dropdown(
+                            id='explorar-ejemplo',
+                            options=[{'label': nombre, 'value': nombre} for nombre in EJEMPLOS],
+                            placeholder="Consultas de ejemplo...",
+                            className="mb-2"
+                        ),
+                        dcc.Textarea(
+                            id='explorar-sql',
+                            value=next(iter(EJEMPLOS.values())),
+                            style={'width': '100%', 'height': '180px', 'fontFamily': 'monospace', 'fontSize': '13px'}
+                        ),
+                        dbc.Button([
+                            html.I(className="fas fa-play me-2"),
+                            "Ejecutar"
+                        ], id="btn-explorar", color="success", className="mt-2")
+                    ])
+                ], className="shadow-sm")
+            ], md=8),
+            dbc.Col([
+                dbc.Card([
+                    dbc.CardHeader([
+                        html.I(className="fas fa-table me-2"),
+                        "Tablas"
+                    ], className="bg-light"),
+                    dbc.CardBody([
+                        html.Details([
+                            html.Summary(html.Code(tabla)),
+                            html.Small(", ".join(columna for columna, _ in columnas), className="text-muted")
+                        ], className="mb-1") for tabla, columnas in esquema.items()
+                    ] or [html.P("No se pudieron cargar las tablas.", className="text-muted mb-0")],
+                        style={'maxHeight': '260px', 'overflowY': 'auto'})
+                ], className="shadow-sm h-100")
+            ], md=4),
+        ], className="mb-4"),
+
+        dcc.Loading(
+            id="loading-explorar",
+            type="default",
+            children=html.Div(id="explorar-resultado")
+        ),
+    ], fluid=True, className="py-4")
+
+
 # Callback para navegación
 @app.callback(
     Output('page-content', 'children'),
@@ -601,6 +701,8 @@ def display_page(pathname):
         return get_procesadores_content()
     elif pathname == '/trabajo-manual':
         return get_trabajo_manual_content()
+    elif pathname == '/explorar':
+        return get_explorar_content()
     else:
         return get_dashboard_content()
 
@@ -740,9 +842,13 @@ def ejecutar_agente(n_clicks):
                     html.Br(),
                     f"Transportistas corregidos: {resultado.get('transportistas_corregidos', 0)}",
                     html.Br(),
-                    f"Filas procesadas: {resultado['filas_procesadas']}"
+                    f"Filas procesadas: {resultado['filas_procesadas']}",
+                    html.Br(),
+                    f"Requests de escritura: {resultado.get('requests_escritura', 0)}"
                 ], className="mb-0"),
-                html.Small("Los datos se muestran en gris en la hoja.", className="text-muted")
+                html.Small("Los datos se muestran en gris en la hoja.", className="text-muted"),
+                *[html.Div(f"Error de formato: {e}", className="text-danger small")
+                  for e in resultado.get('errores_formato', [])]
             ], color="success")
         else:
             return dbc.Alert(f"Error: {resultado['error']}", color="danger")
@@ -750,6 +856,15 @@ def ejecutar_agente(n_clicks):
         return dbc.Alert(f"Error: {str(e)}", color="danger")
 
 
+def linea_metricas(resultado):
+    """Tiempos, llamadas a Sheets y memoria de un paso, debajo de su resultado"""
+    from metrics import describir
+    texto = describir(resultado.get('metricas'))
+    if not texto:
+        return None
+    return html.Div(html.Small(texto, className="text-muted"), className="ms-4")
+
+
 # Callback para EJECUTAR TODO
 @app.callback(
     Output('resultado-ejecutar-todo', 'children'),
@@ -761,20 +876,26 @@ def ejecutar_todo(n_clicks):
         return ""
 
     import time
+    from write_buffer import WriteBuffer
+    from metrics import medir
     DELAY_ENTRE_PASOS = 15  # segundos entre pasos para evitar quota exceeded
 
     resultados = []
     errores = []
 
+    # Las escrituras de los pasos 0-3 se juntan y se aplican de una sola vez
+    buffer = WriteBuffer()
+
     # Paso 0: Traer CPEs a Fletes
     try:
         from app import traer_cpes_a_fletes
-        res0 = traer_cpes_a_fletes()
+        res0 = traer_cpes_a_fletes(buffer=buffer)
         if res0['success']:
             resultados.append(html.Div([
                 html.I(className="fas fa-check text-success me-2"),
                 html.Strong("Paso 0: "),
-                f"{res0['con_cpe']} con CPE, {res0['sin_cpe']} sin CPE"
+                f"{res0['con_cpe']} con CPE, {res0['sin_cpe']} sin CPE",
+                linea_metricas(res0)
             ]))
         else:
             errores.append(f"Paso 0: {res0['error']}")
@@ -786,12 +907,13 @@ def ejecutar_todo(n_clicks):
     # Paso 1: Asignar CPEs a Pesadas
     try:
         from app import asignar_cpes
-        res1 = asignar_cpes()
+        res1 = asignar_cpes(buffer=buffer)
         if res1['success']:
             resultados.append(html.Div([
                 html.I(className="fas fa-check text-success me-2"),
                 html.Strong("Paso 1: "),
-                f"{res1['matches_nuevos']} CPEs asignados"
+                f"{res1['matches_nuevos']} CPEs asignados",
+                linea_metricas(res1)
             ]))
         else:
             errores.append(f"Paso 1: {res1['error']}")
@@ -803,12 +925,13 @@ def ejecutar_todo(n_clicks):
     # Paso 2: Pesadas -> Fletes
     try:
         from app import matchear_pesadas_fletes
-        res2 = matchear_pesadas_fletes()
+        res2 = matchear_pesadas_fletes(buffer=buffer)
         if res2['success']:
             resultados.append(html.Div([
                 html.I(className="fas fa-check text-success me-2"),
                 html.Strong("Paso 2: "),
-                f"{res2['matches_nuevos']} pesos de pesadas llevados"
+                f"{res2['matches_nuevos']} pesos de pesadas llevados",
+                linea_metricas(res2)
             ]))
         else:
             errores.append(f"Paso 2: {res2['error']}")
@@ -820,18 +943,34 @@ def ejecutar_todo(n_clicks):
     # Paso 3: Descargas -> Fletes
     try:
         from app import matchear_descargas_fletes
-        res3 = matchear_descargas_fletes()
+        res3 = matchear_descargas_fletes(buffer=buffer)
         if res3['success']:
             resultados.append(html.Div([
                 html.I(className="fas fa-check text-success me-2"),
                 html.Strong("Paso 3: "),
-                f"{res3['matches_nuevos']} pesos de descargas llevados"
+                f"{res3['matches_nuevos']} pesos de descargas llevados",
+                linea_metricas(res3)
             ]))
         else:
             errores.append(f"Paso 3: {res3['error']}")
     except Exception as e:
         errores.append(f"Paso 3: {str(e)}")
 
+    # Escribir todo lo de los pasos 0-3 (el agente lee Fletes ya actualizado)
+    try:
+        with medir('escritura_pipeline') as medicion:
+            resumen = buffer.flush()
+        resultados.append(html.Div([
+            html.I(className="fas fa-save text-success me-2"),
+            html.Strong("Escritura: "),
+            f"{resumen['celdas']} cambios de celda en {resumen['requests']} requests",
+            linea_metricas({'metricas': medicion.resumen()})
+        ]))
+        for error in resumen['errores_formato']:
+            errores.append(f"Formato: {error}")
+    except Exception as e:
+        errores.append(f"Escritura: {str(e)}")
+
     time.sleep(DELAY_ENTRE_PASOS)
 
     # Agente Inteligente
@@ -842,7 +981,8 @@ def ejecutar_todo(n_clicks):
             resultados.append(html.Div([
                 html.I(className="fas fa-check text-success me-2"),
                 html.Strong("Agente: "),
-                f"{res_agente['campos_completados']} campos completados"
+                f"{res_agente['campos_completados']} campos completados",
+                linea_metricas(res_agente)
             ]))
         else:
             errores.append(f"Agente: {res_agente['error']}")
@@ -1126,72 +1266,13 @@ def cargar_duplicados(n_clicks):
     """
     Muestra solo los casos marcados "REVISAR" en columna T.
     Estos son empates reales donde 2+ CPEs tienen la misma fecha más cercana.
+    Se sirven del índice de revisión, que se arma una vez por snapshot de Pesadas y CPE.
     """
     if not n_clicks:
         return "", "", ""
     try:
-        from app import cargar_cpes, get_credentials, normalizar_patente, normalizar_fecha, normalizar_producto, calcular_dias_diferencia, CONFIG
-        import gspread
-
-        creds = get_credentials()
-        gc = gspread.authorize(creds)
-
-        # Cargar CPEs (indexado por patente)
-        cpes = cargar_cpes(gc)
-
-        # Contar patentes duplicadas
-        patentes_duplicadas = {pat: lista for pat, lista in cpes.items() if len(lista) > 1}
-
-        # Cargar Pesadas
-        ss_pesadas = gc.open_by_key(CONFIG['PESADAS_SPREADSHEET_ID'])
-        hoja_pesadas = ss_pesadas.worksheet(CONFIG['PESADAS_SHEET_NAME'])
-        datos_pesadas = hoja_pesadas.get_all_values()
-
-        # Buscar pesadas marcadas como "REVISAR" en columna T
-        casos_revisar = []
-
-        for idx, fila in enumerate(datos_pesadas[1:], start=2):
-            if len(fila) <= CONFIG['PESADAS_COL_VERIFICADO']:
-                continue
-
-            verificado = fila[CONFIG['PESADAS_COL_VERIFICADO']] if len(fila) > CONFIG['PESADAS_COL_VERIFICADO'] else ''
-
-            # Solo mostrar los marcados como REVISAR
-            if str(verificado).strip().upper() != 'REVISAR':
-                continue
-
-            fecha_pesada = fila[CONFIG['PESADAS_COL_FECHA']] if len(fila) > CONFIG['PESADAS_COL_FECHA'] else ''
-            patente_pesada = fila[CONFIG['PESADAS_COL_PATENTE']] if len(fila) > CONFIG['PESADAS_COL_PATENTE'] else ''
-            cpe_asignado = fila[CONFIG['PESADAS_COL_CPE']] if len(fila) > CONFIG['PESADAS_COL_CPE'] else ''
-            producto_pesada = fila[CONFIG['PESADAS_COL_PRODUCTO']] if len(fila) > CONFIG['PESADAS_COL_PRODUCTO'] else ''
-            neto_pesada = fila[CONFIG['PESADAS_COL_NETO']] if len(fila) > CONFIG['PESADAS_COL_NETO'] else ''
-
-            # Buscar CPEs alternativas para esta patente
-            patente_norm = normalizar_patente(patente_pesada)
-            fecha_pesada_norm = normalizar_fecha(fecha_pesada)
-            producto_norm = normalizar_producto(producto_pesada)
-
-            cpes_alternativas = []
-            if patente_norm in cpes:
-                for cpe_data in cpes[patente_norm]:
-                    dias = calcular_dias_diferencia(fecha_pesada_norm, cpe_data['fecha'])
-                    if 0 <= dias <= 7 and cpe_data['grano_tipo'] == producto_norm:
-                        cpes_alternativas.append({
-                            'numero_cpe': cpe_data['numero_cpe'],
-                            'fecha': cpe_data['fecha'],
-                            'dias': dias,
-                            'grano_tipo': cpe_data['grano_tipo']
-                        })
-
-            casos_revisar.append({
-                'fila': idx,
-                'patente': patente_pesada,
-                'fecha_pesada': fecha_pesada,
-                'producto_pesada': producto_pesada,
-                'neto': neto_pesada,
-                'cpe_asignado': cpe_asignado,
-                'cpes_alternativas': sorted(cpes_alternativas, key=lambda x: x['dias'])
-            })
+        casos_revisar = indice_revision.casos()
+        patentes_duplicadas = indice_revision.patentes_duplicadas
 
         if not casos_revisar:
             return (
@@ -1202,7 +1283,7 @@ def cargar_duplicados(n_clicks):
                 html.Div([
                     dbc.Row([
                         dbc.Col([
-                            html.H4(str(len(patentes_duplicadas)), className="text-warning mb-0"),
+                            html.H4(str(patentes_duplicadas), className="text-warning mb-0"),
                             html.Small("Patentes duplicadas", className="text-muted")
                         ], className="text-center"),
                         dbc.Col([
@@ -1218,7 +1299,7 @@ def cargar_duplicados(n_clicks):
         stats = html.Div([
             dbc.Row([
                 dbc.Col([
-                    html.H4(str(len(patentes_duplicadas)), className="text-warning mb-0"),
+                    html.H4(str(patentes_duplicadas), className="text-warning mb-0"),
                     html.Small("Patentes duplicadas", className="text-muted")
                 ], className="text-center"),
                 dbc.Col([
@@ -1238,7 +1319,8 @@ def cargar_duplicados(n_clicks):
             cpes_texto = []
             for alt in caso['cpes_alternativas']:
                 marca = "✓" if alt['numero_cpe'] == caso['cpe_asignado'] else ""
-                cpes_texto.append(f"{marca} {alt['numero_cpe']} ({alt['fecha']}, +{alt['dias']}d)")
+                usada = f" - usada en fila {alt['usada_en']}" if alt['usada_en'] else ""
+                cpes_texto.append(f"{marca} {alt['numero_cpe']} ({alt['fecha']}, +{alt['dias']}d{usada})")
 
             fila_num = caso['fila']
 
@@ -1319,20 +1401,16 @@ def marcar_ok_duplicado(n_clicks_list, ids):
     fila_num = button_id['index']
 
     try:
-        from app import get_credentials, CONFIG
-        import gspread
-
-        creds = get_credentials()
-        gc = gspread.authorize(creds)
-
-        # Abrir hoja de Pesadas
-        ss_pesadas = gc.open_by_key(CONFIG['PESADAS_SPREADSHEET_ID'])
-        hoja_pesadas = ss_pesadas.worksheet(CONFIG['PESADAS_SHEET_NAME'])
+        from app import CONFIG
 
-        # Escribir OK en la columna de verificado (columna T = 20 en base 1)
+        # Encolar OK en la columna de verificado (columna T = 20 en base 1)
         col_verificado = CONFIG['PESADAS_COL_VERIFICADO'] + 1  # +1 porque gspread usa base 1
-        celda = gspread.utils.rowcol_to_a1(fila_num, col_verificado)
-        hoja_pesadas.update(celda, [['OK']])
+        cola_ediciones.encolar(
+            CONFIG['PESADAS_SPREADSHEET_ID'], CONFIG['PESADAS_SHEET_NAME'], fila_num,
+            {col_verificado: 'OK'},
+            descripcion=f"Pesadas fila {fila_num}: OK",
+            inmediato=True
+        )
 
         return dbc.Alert([
             html.I(className="fas fa-check me-2"),
@@ -1356,23 +1434,16 @@ def cargar_fletes_sin_cpe(n_clicks):
     if not n_clicks:
         return "", "", "", "0"
     try:
-        from app import get_credentials, CONFIG
-        import gspread
-
-        creds = get_credentials()
-        gc = gspread.authorize(creds)
+        from app import CONFIG, columnas_fletes_esperadas
 
-        # Abrir hoja de Fletes
-        ss = gc.open_by_key(CONFIG['CPE_SPREADSHEET_ID'])
-        hoja_fletes = ss.worksheet(CONFIG['FLETES_SHEET_NAME'])
-        datos_fletes = hoja_fletes.get_all_values()
+        # Recargar Fletes (actualiza también el snapshot compartido con el Dashboard)
+        datos_fletes = data_loader.get_valores('fletes', use_cache=False)
 
         # URL base del sheet de Fletes
         FLETES_SHEET_URL = f"https://docs.google.com/spreadsheets/d/{CONFIG['CPE_SPREADSHEET_ID']}/edit#gid=0&range=A"
 
-        # Opciones para el dropdown
+        # Opciones para la columna desplegable
         OPCIONES_SIN_CPE = [
-            {'label': 'Seleccionar...', 'value': ''},
             {'label': 'Traslado interno', 'value': 'Traslado interno'},
             {'label': 'Flete en B', 'value': 'Flete en B'},
             {'label': 'CPE Hecha por Terceros', 'value': 'CPE Hecha por Terceros'},
@@ -1381,21 +1452,16 @@ def cargar_fletes_sin_cpe(n_clicks):
             {'label': 'Error de carga', 'value': 'Error de carga'},
         ]
 
-        # Obtener índices de columnas por nombre del header
-        headers = datos_fletes[0] if datos_fletes else []
-        def get_col_idx(nombre):
-            try:
-                return headers.index(nombre)
-            except ValueError:
-                return -1
-
-        col_fecha = get_col_idx('Fecha')
-        col_transportista = get_col_idx('Transportista')
-        col_producto = get_col_idx('Producto')
-        col_ctg = get_col_idx('CTG')
-        col_cantidad = get_col_idx('Cantidad')
-        col_cpe = get_col_idx('CPE')
-        col_m_cpes = get_col_idx("M CPE's")
+        # Obtener índices de columnas por nombre del header (registro por versión del snapshot)
+        columnas = data_loader.columnas('fletes', esperadas=columnas_fletes_esperadas())
+
+        col_fecha = columnas.get('Fecha', -1)
+        col_transportista = columnas.get('Transportista', -1)
+        col_producto = columnas.get('Producto', -1)
+        col_ctg = columnas.get('CTG', -1)
+        col_cantidad = columnas.get('Cantidad', -1)
+        col_cpe = columnas.get('CPE', -1)
+        col_m_cpes = columnas.get("M CPE's", -1)
 
         # Buscar fletes sin CPE (columna M CPE's = "no" o vacía, y columna CPE vacía)
         fletes_sin_cpe = []
@@ -1456,52 +1522,45 @@ def cargar_fletes_sin_cpe(n_clicks):
             ])
         ])
 
-        # Construir tabla
-        filas_tabla = []
-        for flete in fletes_sin_cpe[:100]:  # Limitar a 100 para no sobrecargar
-            fila_num = flete['fila']
-
-            filas_tabla.append(html.Tr([
-                html.Td(str(fila_num), style={'fontWeight': 'bold'}),
-                html.Td(flete['fecha']),
-                html.Td(flete['transportista'], style={'maxWidth': '200px', 'overflow': 'hidden', 'textOverflow': 'ellipsis', 'whiteSpace': 'nowrap'}),
-                html.Td(flete['producto']),
-                html.Td(flete['ctg']),
-                html.Td(flete['cantidad']),
-                html.Td(
-                    dcc.Dropdown(
-                        id={'type': 'dropdown-sin-cpe', 'index': fila_num},
-                        options=OPCIONES_SIN_CPE,
-                        value='',
-                        placeholder='Clasificar...',
-                        style={'minWidth': '160px'},
-                        clearable=False
-                    )
-                ),
-                html.Td([
-                    html.A(
-                        dbc.Button([html.I(className="fas fa-external-link-alt")],
-                                  color="primary", size="sm", outline=True),
-                        href=f"{FLETES_SHEET_URL}{fila_num}",
-                        target="_blank",
-                        title="Ver en Google Sheets"
-                    )
-                ])
-            ]))
-
-        tabla = dbc.Table([
-            html.Thead(html.Tr([
-                html.Th("Fila"),
-                html.Th("Fecha"),
-                html.Th("Transportista"),
-                html.Th("Producto"),
-                html.Th("CTG"),
-                html.Th("Cantidad"),
-                html.Th("Clasificar"),
-                html.Th("Ver")
-            ])),
-            html.Tbody(filas_tabla)
-        ], striped=True, bordered=True, hover=True, responsive=True, size="sm")
+        # Una sola DataTable virtualizada: el costo no depende de cuántos fletes haya
+        tabla = dash_table.DataTable(
+            id='tabla-fletes-sin-cpe',
+            columns=[
+                {'name': 'Fila', 'id': 'fila', 'editable': False},
+                {'name': 'Fecha', 'id': 'fecha', 'editable': False},
+                {'name': 'Transportista', 'id': 'transportista', 'editable': False},
+                {'name': 'Producto', 'id': 'producto', 'editable': False},
+                {'name': 'CTG', 'id': 'ctg', 'editable': False},
+                {'name': 'Cantidad', 'id': 'cantidad', 'editable': False},
+                {'name': 'Clasificar', 'id': 'clasificacion', 'presentation': 'dropdown', 'editable': True},
+                {'name': 'Ver', 'id': 'ver', 'presentation': 'markdown', 'editable': False},
+            ],
+            data=[{
+                'fila': flete['fila'],
+                'fecha': flete['fecha'],
+                'transportista': flete['transportista'],
+                'producto': flete['producto'],
+                'ctg': flete['ctg'],
+                'cantidad': flete['cantidad'],
+                'clasificacion': '',
+                'ver': f"[Abrir]({FLETES_SHEET_URL}{flete['fila']})"
+            } for flete in fletes_sin_cpe],
+            editable=True,
+            dropdown={'clasificacion': {'options': OPCIONES_SIN_CPE, 'clearable': False}},
+            markdown_options={'link_target': '_blank'},
+            virtualization=True,
+            fixed_rows={'headers': True},
+            page_action='none',
+            sort_action='native',
+            filter_action='native',
+            style_table={'height': '600px', 'overflowY': 'auto'},
+            style_cell={'textAlign': 'left', 'padding': '6px', 'fontSize': '13px',
+                        'minWidth': '80px', 'maxWidth': '220px',
+                        'overflow': 'hidden', 'textOverflow': 'ellipsis'},
+            style_cell_conditional=[{'if': {'column_id': 'clasificacion'}, 'minWidth': '190px'}],
+            style_header={'fontWeight': 'bold'},
+            css=[{'selector': '.Select-menu-outer', 'rule': 'display: block !important'}]
+        )
 
         return (
             dbc.Alert([
@@ -1523,79 +1582,158 @@ def cargar_fletes_sin_cpe(n_clicks):
         )
 
 
+# La tabla manda data completa en cada edición: el diff contra data_previous se hace
+# en el navegador y al servidor solo llega la celda que cambió
+app.clientside_callback(
+    """
+    function(data, previo) {
+        if (!data || !previo || data.length !== previo.length) {
+            return window.dash_clientside.no_update;
+        }
+        for (let i = 0; i < data.length; i++) {
+            if (data[i].clasificacion !== previo[i].clasificacion) {
+                return {fila: data[i].fila, valor: data[i].clasificacion, ts: Date.now()};
+            }
+        }
+        return window.dash_clientside.no_update;
+    }
+    """,
+    Output('cambio-sin-cpe', 'data'),
+    Input('tabla-fletes-sin-cpe', 'data'),
+    State('tabla-fletes-sin-cpe', 'data_previous'),
+    prevent_initial_call=True
+)
+
+
 # Callback para clasificar un flete sin CPE
 @app.callback(
     Output('resultado-cargar-sin-cpe', 'children', allow_duplicate=True),
-    Input({'type': 'dropdown-sin-cpe', 'index': ALL}, 'value'),
-    State({'type': 'dropdown-sin-cpe', 'index': ALL}, 'id'),
+    Input('cambio-sin-cpe', 'data'),
     prevent_initial_call=True
 )
-def clasificar_flete_sin_cpe(values, ids):
-    from dash import callback_context
-    if not callback_context.triggered:
-        return dash.no_update
-
-    # Encontrar qué dropdown cambió
-    triggered = callback_context.triggered[0]
-    prop_id = triggered['prop_id']
-    valor_seleccionado = triggered['value']
-
+def clasificar_flete_sin_cpe(cambio):
     # Si no se seleccionó nada, ignorar
-    if not valor_seleccionado:
+    if not cambio or not cambio.get('valor'):
         return dash.no_update
 
-    # Extraer el índice (número de fila) del dropdown
-    import json
-    try:
-        dropdown_id = json.loads(prop_id.split('.')[0])
-        fila_num = dropdown_id['index']
-    except:
-        return dash.no_update
+    fila_num = cambio['fila']
+    valor_seleccionado = cambio['valor']
 
     try:
-        from app import get_credentials, CONFIG
-        import gspread
+        from app import CONFIG, columnas_fletes_esperadas
 
-        creds = get_credentials()
-        gc = gspread.authorize(creds)
-
-        # Abrir hoja de Fletes
-        ss = gc.open_by_key(CONFIG['CPE_SPREADSHEET_ID'])
-        hoja_fletes = ss.worksheet(CONFIG['FLETES_SHEET_NAME'])
-
-        # Obtener headers para encontrar columnas por nombre
-        headers = hoja_fletes.row_values(1)
-
-        def get_col_num(nombre):
-            try:
-                return headers.index(nombre) + 1  # Base 1 para gspread
-            except ValueError:
-                return -1
-
-        col_cpe = get_col_num('CPE')
-        col_m_cpes = get_col_num("M CPE's")
-
-        if col_cpe < 1 or col_m_cpes < 1:
+        # Verificar que existan las columnas, desde el registro (sin leer la hoja)
+        columnas = data_loader.columnas('fletes', esperadas=columnas_fletes_esperadas())
+        if 'CPE' not in columnas or "M CPE's" not in columnas:
             return dbc.Alert("Error: No se encontraron las columnas CPE o M CPE's", color="danger")
 
-        # Actualizar columna CPE con "No corresponde"
-        celda_cpe = gspread.utils.rowcol_to_a1(fila_num, col_cpe)
-        hoja_fletes.update(celda_cpe, [['No corresponde']])
-
-        # Actualizar columna M CPE's con el motivo seleccionado
-        celda_m_cpes = gspread.utils.rowcol_to_a1(fila_num, col_m_cpes)
-        hoja_fletes.update(celda_m_cpes, [[valor_seleccionado]])
+        # CPE = "No corresponde" y M CPE's = motivo seleccionado; las columnas van por nombre y
+        # se resuelven al escribir, contra el encabezado vigente en ese momento
+        cola_ediciones.encolar(
+            CONFIG['CPE_SPREADSHEET_ID'], CONFIG['FLETES_SHEET_NAME'], fila_num,
+            {'CPE': 'No corresponde', "M CPE's": valor_seleccionado},
+            descripcion=f"Fletes fila {fila_num}: {valor_seleccionado}"
+        )
 
         return dbc.Alert([
             html.I(className="fas fa-check me-2"),
             f"Fila {fila_num} clasificada como '{valor_seleccionado}'. ",
-            html.Small("Recargá la lista para actualizar.", className="text-muted")
+            html.Small("Se guarda en unos segundos. Recargá la lista para actualizar.", className="text-muted")
         ], color="success", dismissable=True)
 
     except Exception as e:
         return dbc.Alert(f"Error al clasificar: {str(e)}", color="danger")
 
 
+# Callbacks de la página Explorar
+@app.callback(
+    Output('explorar-sql', 'value'),
+    Input('explorar-ejemplo', 'value'),
+    prevent_initial_call=True
+)
+def elegir_ejemplo_explorar(nombre):
+    from consultas import EJEMPLOS
+    if not nombre:
+        return dash.no_update
+    return EJEMPLOS[nombre]
+
+
+@app.callback(
+    Output('explorar-resultado', 'children'),
+    Input('btn-explorar', 'n_clicks'),
+    State('explorar-sql', 'value'),
+    prevent_initial_call=True
+)
+def ejecutar_explorar(n_clicks, sql):
+    if not n_clicks:
+        return ""
+    try:
+        from consultas import motor_consultas
+        resultado = motor_consultas.consultar(sql)
+    except Exception as e:
+        return dbc.Alert(f"Error: {str(e)}", color="danger")
+
+    # Ids por posición: una consulta puede repetir nombres de columna
+    columnas = [{'name': nombre, 'id': f"c{i}"} for i, nombre in enumerate(resultado['columnas'])]
+    datos = [{f"c{i}": valor for i, valor in enumerate(fila)} for fila in resultado['filas']]
+
+    resumen = f"{len(datos)} filas en {resultado['ms']:.0f} ms ({resultado['motor']}"
+    resumen += ", desde cache)" if resultado['cache'] else ")"
+    return html.Div([
+        dbc.Alert([
+            html.I(className="fas fa-check me-2"),
+            resumen,
+            html.Span(" - resultado truncado, agregar LIMIT o agrupar más", className="fw-bold")
+            if resultado['truncado'] else None
+        ], color="warning" if resultado['truncado'] else "success", className="py-2"),
+        dash_table.DataTable(
+            id='tabla-explorar',
+            columns=columnas,
+            data=datos,
+            page_size=25,
+            sort_action='native',
+            filter_action='native',
+            export_format='csv',
+            style_table={'overflowX': 'auto'},
+            style_cell={'textAlign': 'left', 'padding': '6px', 'fontSize': '13px',
+                        'minWidth': '80px', 'maxWidth': '260px',
+                        'overflow': 'hidden', 'textOverflow': 'ellipsis'},
+            style_header={
+                'backgroundColor': COLORS['primary'],
+                'color': 'white',
+                'fontWeight': 'bold'
+            },
+        )
+    ])
+
+
+# Callback para mostrar el estado de la cola de ediciones manuales
+@app.callback(
+    Output('estado-cola-ediciones', 'children'),
+    Input('intervalo-cola-ediciones', 'n_intervals')
+)
+def mostrar_estado_cola(n_intervals):
+    estado = cola_ediciones.estado()
+    contenido = []
+
+    if estado['pendientes']:
+        contenido.append(dbc.Alert([
+            html.I(className="fas fa-clock me-2"),
+            f"{estado['pendientes']} cambios pendientes de guardar en Google Sheets..."
+        ], color="secondary", className="py-2"))
+
+    if estado['errores']:
+        contenido.append(dbc.Alert([
+            html.H6([
+                html.I(className="fas fa-exclamation-triangle me-2"),
+                "No se pudieron guardar algunos cambios"
+            ], className="alert-heading"),
+            *[html.Div(f"[{e['hora']}] {e['descripcion']}: {e['error']}") for e in estado['errores']]
+        ], color="danger"))
+
+    return contenido
+
+
 if __name__ == '__main__':
     print("=" * 50)
     print("Dashboard de Control de Fletes Agropecuario")
@@ -1604,5 +1742,8 @@ if __name__ == '__main__':
     print("  - Dashboard: http://localhost:5016/")
     print("  - Procesadores: http://localhost:5016/procesadores")
     print("  - Trabajo Manual: http://localhost:5016/trabajo-manual")
+    print("  - Explorar: http://localhost:5016/explorar")
     print("=" * 50)
+    from warmup import calentar_en_segundo_plano
+    calentar_en_segundo_plano()
     app.run(host='0.0.0.0', port=5016, debug=True)
@@ -9,8 +9,18 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 import pandas as pd
 import os
 import json
+import hashlib
+import time
 from datetime import datetime
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from sheets_backend import get_client, cupo_lecturas
+from normalizacion import (ctgs_columna, cpes_columna, patentes_columna, productos_columna,
+                           nombres_columna, extraer_patentes_columna)
+from metrics import contar
+from shared_cache import crear_desde_entorno
+from espejo import INDICES as TABLAS_ESPEJO, crear_desde_entorno as crear_espejo
 
 SCOPES = [
     'https://www.googleapis.com/auth/spreadsheets',
@@ -20,7 +30,8 @@ SCOPES = [
 # IDs de los Spreadsheets
 SPREADSHEET_IDS = {
     'cpe': '1aSZalfUpSFHytq9sYEkzDvXqFC_nBF_9a99kg6qZSXc',
-    'pesadas': '1gTvXfwOsqbbc5lxpcsh8HMoB5F3Bix0qpdNKdyY5DME'
+    'pesadas': '1gTvXfwOsqbbc5lxpcsh8HMoB5F3Bix0qpdNKdyY5DME',
+    'oc': '1e_GIvBUY8uskXXL7c2TsBydxprT_h36VlsLhYooz72w'
 }
 
 # Nombres de las hojas
@@ -28,9 +39,81 @@ SHEET_NAMES = {
     'fletes': 'Fletes facturados todos',
     'pesadas': 'Pesadas Todos',
     'descargas': 'Descargas Todos',
-    'cpe': 'Cartas de Porte Afip'
+    'cpe': 'Cartas de Porte Afip',
+    'oc_fletes': 'OC Fletes'
+}
+
+# Spreadsheet donde vive cada hoja
+HOJA_SPREADSHEET = {
+    'fletes': 'cpe',
+    'pesadas': 'pesadas',
+    'descargas': 'cpe',
+    'cpe': 'cpe',
+    'oc_fletes': 'oc'
 }
 
+# Hojas que crecen casi siempre por el final: entre recargas completas se refrescan
+# leyendo solo las filas nuevas. No son append-only (el pipeline escribe CPE y REVISAR en
+# Pesadas, y Descargas y CPE se editan a mano), así que además se releen completas cada
+# RECARGA_COMPLETA segundos, al pedir un refresco forzado y después de escribirlas.
+HOJAS_INCREMENTALES = {'pesadas', 'descargas', 'cpe'}
+
+# Segundos máximos entre lecturas completas de una hoja incremental
+RECARGA_COMPLETA = int(os.environ.get('SHEETS_RECARGA_COMPLETA', '1800'))
+
+# Cantidad de filas finales que se comparan (hash) para detectar ediciones en la cola
+FILAS_HASH_COLA = 20
+
+# Filas por request cuando se lee una hoja por páginas
+PAGINA_FILAS = 1000
+
+# Hojas con más filas que esto se descargan por páginas en paralelo y cada página se
+# convierte a DataFrame apenas llega, superponiendo descarga y parseo
+PAGINA_INGESTA = int(os.environ.get('SHEETS_PAGINA_INGESTA', '10000'))
+HILOS_DESCARGA = 4
+HILOS_PARSEO = 2
+
+# Columnas que se piden además sin formato (UNFORMATTED_VALUE / SERIAL_NUMBER): los
+# números llegan como float y las fechas como número de serie, sin parsear texto
+INGESTA_TIPADA = os.environ.get('SHEETS_INGESTA_TIPADA', '1') == '1'
+COLUMNAS_TIPADAS = {
+    'fletes': {'Fecha': 'fecha', 'Cantidad': 'numero', 'M Pesadas todos': 'numero',
+               'M Descargas todos': 'numero', 'Subtotal': 'numero', 'Total': 'numero',
+               'Tarifa': 'numero'},
+    'pesadas': {'Fecha': 'fecha', 'Neto': 'numero', 'Bruto': 'numero', 'Tara': 'numero'},
+    'descargas': {'Fecha Descarga': 'fecha', 'Peso Neto': 'numero'},
+    'cpe': {'fecha_documento': 'fecha'}
+}
+
+# Día 0 de los números de serie de fecha de Sheets
+ORIGEN_SERIAL = '1899-12-30'
+
+
+def _recortar_fila(fila):
+    """Quita celdas vacías al final (get_all_values rellena, get no)"""
+    fin = len(fila)
+    while fin and fila[fin - 1] == '':
+        fin -= 1
+    return fila[:fin]
+
+
+def _hash_filas(filas):
+    """Hash estable de un bloque de filas, independiente del relleno a la derecha"""
+    h = hashlib.sha1()
+    for fila in filas:
+        h.update('\x1f'.join(_recortar_fila(fila)).encode('utf-8'))
+        h.update(b'\x1e')
+    return h.hexdigest()
+
+
+def _texto_celda(valor):
+    """Valor escrito (RAW) como lo devuelve get_all_values"""
+    if valor is None:
+        return ''
+    if isinstance(valor, bool):
+        return 'TRUE' if valor else 'FALSE'
+    return str(valor)
+
 
 class DataLoader:
     def __init__(self):
@@ -38,6 +121,29 @@ class DataLoader:
         self._cache = {}
         self._cache_time = {}
         self.cache_duration = 300  # 5 minutos
+        # Snapshot crudo por hoja: {'filas': [...], 'hash_cola': str, 'version': int,
+        # 'completa': time.time() de la última lectura completa}
+        self._snapshots = {}
+        self._worksheets = {}
+        self._version = 0
+        # Índices de columnas por hoja: cache_key -> (version, {encabezado: índice})
+        self._columnas = {}
+        # Snapshots compartidos entre workers (None = cada proceso descarga por su cuenta)
+        self._compartido = crear_desde_entorno()
+        self._version_compartida = {}
+        # Generación (invalidaciones) de cada hoja en el cache compartido cuando se leyó
+        self._generacion = {}
+        # Columnas tipadas de la última descarga, hasta que las use el constructor del DataFrame
+        self._tipadas = {}
+        # DataFrame ya armado durante una descarga por páginas, hasta que lo tome _cargar
+        self._construidos = {}
+        # Filas editadas (base 1) de un snapshot adoptado y (filas, hash_cola) del anterior,
+        # hasta que _cargar rearme solo esas filas del DataFrame
+        self._cambiadas = {}
+        # Copia indexada en SQLite de los DataFrames (None = desactivada)
+        self.espejo = crear_espejo()
+        # Hojas cuya última sincronización del espejo falló (la próxima compara todo)
+        self._espejo_desfasado = set()
 
     def _get_credentials(self):
         """Obtiene credenciales de Google OAuth"""
@@ -84,17 +190,444 @@ class DataLoader:
     def _get_client(self):
         """Obtiene cliente de gspread"""
         if self.gc is None:
-            creds = self._get_credentials()
-            self.gc = gspread.authorize(creds)
+            self.gc = get_client(self._get_credentials)
         return self.gc
 
     def _is_cache_valid(self, key):
-        """Verifica si el cache es válido"""
+        """Verifica si el cache es válido (y que otro worker no haya escrito la hoja desde que se leyó)"""
         if key not in self._cache_time:
             return False
+        if key in self._generacion and self._compartido.generacion(key) != self._generacion[key]:
+            # Otro worker escribió la hoja: _leer_hoja decide si adopta lo que publicó o la relee
+            contar(f'invalidada_afuera_{key}')
+            return False
         elapsed = (datetime.now() - self._cache_time[key]).seconds
         return elapsed < self.cache_duration
 
+    def _get_worksheet(self, cache_key):
+        """Obtiene (y recuerda) el worksheet de una hoja para no reabrir el spreadsheet"""
+        if cache_key not in self._worksheets:
+            gc = self._get_client()
+            ss = gc.open_by_key(SPREADSHEET_IDS[HOJA_SPREADSHEET[cache_key]])
+            self._worksheets[cache_key] = ss.worksheet(SHEET_NAMES[cache_key])
+        return self._worksheets[cache_key]
+
+    def _guardar_snapshot(self, cache_key, filas, completa=None):
+        """
+        Guarda las filas crudas y el hash de las últimas FILAS_HASH_COLA filas de datos.
+        `completa` es el momento de la última lectura completa (None = esta).
+        """
+        self._version += 1
+        self._snapshots[cache_key] = {
+            'filas': filas,
+            'hash_cola': _hash_filas(filas[max(1, len(filas) - FILAS_HASH_COLA):]),
+            'version': self._version,
+            'completa': time.time() if completa is None else completa
+        }
+
+    def _leer_cola(self, hoja, snapshot):
+        """
+        Lee solo las filas agregadas desde el último snapshot.
+        Pide un rango A1 que arranca en las últimas FILAS_HASH_COLA filas conocidas,
+        verifica que no hayan cambiado y retorna las filas nuevas.
+        Retorna None si la cola cambió (hay que recargar todo).
+        """
+        filas = snapshot['filas']
+        ancho = len(filas[0])
+        conocidas = min(FILAS_HASH_COLA, len(filas) - 1)
+        inicio = len(filas) - conocidas + 1  # fila base 1 en la hoja
+
+        col_final = re.sub(r'\d', '', gspread.utils.rowcol_to_a1(1, ancho))
+        valores = hoja.get(f'A{inicio}:{col_final}')
+
+        if len(valores) < conocidas:
+            # La hoja se achicó: se borraron filas
+            return None
+        if conocidas and _hash_filas(valores[:conocidas]) != snapshot['hash_cola']:
+            return None
+
+        return [list(fila) + [''] * (ancho - len(fila)) for fila in valores[conocidas:]]
+
+    def _leer_hoja(self, cache_key, forzar=False):
+        """
+        Obtiene las filas de una hoja. Con cache compartido, primero usa el snapshot
+        que haya guardado otro worker si está vigente; si no, toma el lock de la hoja,
+        vuelve a mirar (otro worker pudo refrescarla mientras esperaba) y recién ahí
+        descarga de Sheets y publica el resultado.
+        Con forzar=True solo se acepta un snapshot compartido posterior al pedido y, si
+        hay que descargar, se lee la hoja completa (no solo la cola).
+        Retorna (datos, filas_nuevas); filas_nuevas es None cuando hubo recarga completa.
+        """
+        if self._compartido is None:
+            return self._descargar_hoja(cache_key, completa=forzar)
+
+        pedido = time.time()
+        generacion = self._compartido.generacion(cache_key)
+        # Otro worker escribió la hoja: la copia local solo sirve para compararla con el
+        # snapshot que haya publicado, no como base de la cola
+        escrita = self._generacion.get(cache_key, generacion) != generacion
+        self._generacion[cache_key] = generacion
+        if escrita:
+            self._version_compartida.pop(cache_key, None)
+
+        def vigente(meta):
+            if meta is None:
+                return False
+            return meta[1] >= pedido if forzar else time.time() - meta[1] < self.cache_duration
+
+        meta = self._compartido.meta(cache_key)
+        if vigente(meta):
+            return self._adoptar_compartido(cache_key, meta)
+
+        with self._compartido.lock(cache_key):
+            meta = self._compartido.meta(cache_key)
+            if vigente(meta):
+                return self._adoptar_compartido(cache_key, meta)
+            if escrita:
+                self._descartar(cache_key)
+                self._generacion[cache_key] = generacion
+            datos, nuevas = self._descargar_hoja(cache_key, completa=forzar)
+            self._version_compartida[cache_key] = self._compartido.escribir(cache_key, datos, generacion)
+            return datos, nuevas
+
+    def _adoptar_compartido(self, cache_key, meta):
+        """
+        Toma el snapshot publicado por otro worker. Si tiene el mismo encabezado que el
+        local, se compara fila por fila: devuelve las filas agregadas y deja en
+        self._cambiadas las editadas (p.ej. celdas que escribió otro worker), para que
+        _cargar rearme solo esas.
+        """
+        local = self._snapshots.get(cache_key)
+        if self._version_compartida.get(cache_key) == meta[0] and local and cache_key in self._cache:
+            contar(f'compartido_hit_{cache_key}')
+            return local['filas'], []
+
+        leido = self._compartido.leer(cache_key)
+        if leido is None:
+            # Se invalidó entre meta() y leer(): la copia local pudo quedar vieja en cualquier fila
+            return self._descargar_hoja(cache_key, completa=True)
+        version, _, datos = leido
+        contar(f'compartido_hit_{cache_key}')
+
+        nuevas = None
+        if local and local['filas'] and cache_key in self._cache:
+            anteriores = local['filas']
+            n = len(anteriores)
+            if len(datos) >= n and datos[0] == anteriores[0]:
+                cambiadas = [f for f in range(2, n + 1) if datos[f - 1] != anteriores[f - 1]]
+                # Con muchas filas editadas conviene rearmar todo el DataFrame
+                if len(cambiadas) <= n // 2:
+                    nuevas = datos[n:]
+                    if cambiadas:
+                        self._cambiadas[cache_key] = (cambiadas, (n, local['hash_cola']))
+
+        self._guardar_snapshot(cache_key, datos)
+        self._version_compartida[cache_key] = version
+        return datos, nuevas
+
+    def _descargar_hoja(self, cache_key, completa=False):
+        """
+        Descarga una hoja de Sheets. Las hojas incrementales con snapshot previo se
+        refrescan leyendo solo la cola, salvo que se pida completa=True o que la última
+        lectura completa tenga más de RECARGA_COMPLETA segundos.
+        """
+        hoja = self._get_worksheet(cache_key)
+        snapshot = self._snapshots.get(cache_key)
+
+        if (not completa and cache_key in HOJAS_INCREMENTALES and snapshot and snapshot['filas'] and
+                cache_key in self._cache and time.time() - snapshot['completa'] < RECARGA_COMPLETA):
+            nuevas = self._leer_cola(hoja, snapshot)
+            if nuevas is not None:
+                if nuevas:
+                    # Se extiende en el lugar para que el costo dependa solo de las filas nuevas
+                    snapshot['filas'].extend(nuevas)
+                    self._guardar_snapshot(cache_key, snapshot['filas'], completa=snapshot['completa'])
+                    self._tipadas[cache_key] = self._leer_tipadas(
+                        hoja, cache_key, snapshot['filas'][0], len(snapshot['filas']) - len(nuevas) + 1, nuevas)
+                return snapshot['filas'], nuevas
+
+        if hoja.row_count > PAGINA_INGESTA:
+            datos = self._descargar_paginado(hoja, cache_key)
+            self._guardar_snapshot(cache_key, datos)
+            return datos, None
+
+        datos = hoja.get_all_values()
+        self._guardar_snapshot(cache_key, datos)
+        if datos:
+            self._tipadas[cache_key] = self._leer_tipadas(hoja, cache_key, datos[0], 2, datos[1:])
+        return datos, None
+
+    def _descargar_paginado(self, hoja, cache_key):
+        """
+        Descarga una hoja grande en páginas de PAGINA_INGESTA filas, con HILOS_DESCARGA
+        requests en paralelo. Cada página pasa al constructor del DataFrame apenas llega,
+        así el parseo corre mientras bajan las demás y el total se acerca a
+        max(descarga, parseo) en lugar de la suma. Retorna las filas (como get_all_values)
+        y deja el DataFrame armado en self._construidos.
+        """
+        encabezados = hoja.row_values(1)
+        ancho = len(encabezados)
+        col_final = re.sub(r'\d', '', gspread.utils.rowcol_to_a1(1, max(ancho, 1)))
+        construir = getattr(self, f'_construir_{cache_key}', None)
+
+        def bajar(inicio):
+            with cupo_lecturas:
+                valores = hoja.get(f'A{inicio}:{col_final}{inicio + PAGINA_INGESTA - 1}')
+            filas = [list(fila) + [''] * (ancho - len(fila)) for fila in valores]
+            with cupo_lecturas:
+                return filas, self._leer_tipadas(hoja, cache_key, encabezados, inicio, filas)
+
+        resultados = {}  # fila de inicio -> (filas, futuro del DataFrame de la página)
+        with ThreadPoolExecutor(HILOS_DESCARGA) as descargas, ThreadPoolExecutor(HILOS_PARSEO) as parseo:
+            futuros = {descargas.submit(bajar, inicio): inicio
+                       for inicio in range(2, hoja.row_count + 1, PAGINA_INGESTA)}
+            while futuros:
+                for futuro in as_completed(list(futuros)):
+                    inicio = futuros.pop(futuro)
+                    filas, tipadas = futuro.result()
+                    marco = parseo.submit(construir, encabezados, filas, tipadas) if construir and filas else None
+                    resultados[inicio] = (filas, marco)
+
+                # La última página vino llena: la hoja creció desde que se abrió, seguir leyendo
+                ultima = max(resultados)
+                if len(resultados[ultima][0]) == PAGINA_INGESTA:
+                    siguiente = ultima + PAGINA_INGESTA
+                    futuros[descargas.submit(bajar, siguiente)] = siguiente
+
+        # Las filas vacías al final no se devuelven (como get_all_values); si una página del
+        # medio vino corta, sus últimas filas estaban vacías y se completan
+        orden = sorted(inicio for inicio, (filas, _) in resultados.items() if filas)
+        datos = [encabezados]
+        marcos = []
+        for inicio in orden:
+            filas, marco = resultados[inicio]
+            hueco = [[''] * ancho for _ in range(inicio - 1 - len(datos))]
+            if hueco:
+                datos.extend(hueco)
+                if construir:
+                    marcos.append(construir(encabezados, hueco, None))
+            datos.extend(filas)
+            if marco is not None:
+                marcos.append(marco.result())
+
+        if construir and marcos:
+            self._construidos[cache_key] = pd.concat(marcos, ignore_index=True)
+        return datos
+
+    def _leer_tipadas(self, hoja, cache_key, encabezados, inicio, filas):
+        """
+        Lee sin formato las columnas de COLUMNAS_TIPADAS para las filas recién descargadas
+        (que empiezan en la fila `inicio` de la hoja), en un solo batch_get por columnas.
+        Retorna {encabezado: [valores]} o None si no se pudo: en ese caso se parsea el texto.
+        """
+        tipos = COLUMNAS_TIPADAS.get(cache_key)
+        if not INGESTA_TIPADA or not tipos or not filas or not getattr(hoja, 'VALORES_TIPADOS', True):
+            return None
+
+        indices = {}
+        for idx, nombre in enumerate(encabezados):
+            indices.setdefault(nombre.strip(), idx)
+        columnas = [(nombre, indices[nombre]) for nombre in tipos if nombre in indices]
+        if not columnas:
+            return None
+
+        fin = inicio + len(filas) - 1
+        rangos = [f"{gspread.utils.rowcol_to_a1(inicio, idx + 1)}:{gspread.utils.rowcol_to_a1(fin, idx + 1)}"
+                  for _, idx in columnas]
+        try:
+            respuestas = hoja.batch_get(
+                rangos,
+                major_dimension=gspread.utils.Dimension.cols,
+                value_render_option=gspread.utils.ValueRenderOption.unformatted,
+                date_time_render_option=gspread.utils.DateTimeOption.serial_number
+            )
+        except Exception as e:
+            print(f"ADVERTENCIA [{SHEET_NAMES[cache_key]}]: no se pudieron leer valores tipados ({e}), se parsea el texto")
+            return None
+
+        tipadas = {}
+        for (nombre, idx), valores in zip(columnas, respuestas):
+            columna = list(valores[0]) if valores else []
+            columna += [''] * (len(filas) - len(columna))
+            # Si la hoja cambió entre las dos lecturas (filas insertadas o borradas), las
+            # celdas vacías no coinciden con las del texto: se descarta la columna
+            if any((c == '') != (len(f) <= idx or f[idx] == '') for c, f in zip(columna, filas)):
+                print(f"ADVERTENCIA [{SHEET_NAMES[cache_key]}]: la columna '{nombre}' cambió durante la lectura, se parsea el texto")
+                continue
+            tipadas[nombre] = columna
+        return tipadas
+
+    def _cargar(self, cache_key, construir, use_cache=True):
+        """
+        Obtiene el DataFrame de una hoja usando el cache. En refrescos incrementales
+        solo se construyen las filas nuevas y se concatenan al DataFrame cacheado.
+        """
+        if use_cache and self._is_cache_valid(cache_key):
+            contar(f'cache_hit_{cache_key}')
+            return self._cache[cache_key].copy()
+
+        contar(f'cache_miss_{cache_key}')
+        datos, nuevas = self._leer_hoja(cache_key, forzar=not use_cache)
+
+        if not datos:
+            return pd.DataFrame()
+
+        # Solo hay columnas tipadas si este proceso descargó la hoja (no si adoptó el snapshot compartido)
+        tipadas = self._tipadas.pop(cache_key, None)
+        construido = self._construidos.pop(cache_key, None)
+        cambiadas, previo = self._cambiadas.pop(cache_key, ((), None))
+        if nuevas is None and construido is not None:
+            df = construido
+        elif nuevas is None:
+            df = construir(datos[0], datos[1:], tipadas)
+        else:
+            df = self._cache[cache_key]
+            if cambiadas:
+                df = self._reemplazar_filas(df, construir, datos, cambiadas)
+            if nuevas:
+                df = pd.concat([df, construir(datos[0], nuevas, tipadas)], ignore_index=True)
+
+        self._cache[cache_key] = df
+        self._cache_time[cache_key] = datetime.now()
+        self._sincronizar_espejo(cache_key, df, datos, nuevas is not None, cambiadas, previo)
+
+        return df.copy()
+
+    @staticmethod
+    def _reemplazar_filas(df, construir, datos, cambiadas):
+        """DataFrame con las filas `cambiadas` de la hoja (base 1) rearmadas desde `datos`"""
+        posiciones = [f - 2 for f in cambiadas]
+        parcial = construir(datos[0], [datos[f - 1] for f in cambiadas], None)
+        parcial.index = posiciones
+        return pd.concat([df.drop(index=posiciones), parcial]).sort_index()
+
+    def _sincronizar_espejo(self, cache_key, df, datos, incremental, cambiadas=(), previo=None):
+        if self.espejo is None or cache_key not in TABLAS_ESPEJO:
+            return
+        # Solo se agregan (o reescriben) filas sueltas si este snapshot extiende al anterior
+        # (cola verificada, o filas editadas conocidas) y el espejo quedó sincronizado con ese anterior
+        incremental = incremental and cache_key not in self._espejo_desfasado
+        try:
+            self.espejo.sincronizar(cache_key, df, datos, incremental=incremental,
+                                    cambiadas=cambiadas, previo=previo)
+            self._espejo_desfasado.discard(cache_key)
+        except Exception as e:
+            # El espejo es opcional: si falla, los DataFrames siguen sirviendo
+            self._espejo_desfasado.add(cache_key)
+            print(f"ADVERTENCIA [espejo]: no se pudo sincronizar {cache_key}: {e}")
+
+    def _loaders(self):
+        return {
+            'fletes': self.get_fletes,
+            'pesadas': self.get_pesadas,
+            'descargas': self.get_descargas,
+            'cpe': self.get_cpe
+        }
+
+    def get_valores(self, cache_key, use_cache=True):
+        """Obtiene las filas crudas (con encabezado) del snapshot de una hoja"""
+        if not (use_cache and self._is_cache_valid(cache_key)) or cache_key not in self._snapshots:
+            self._loaders()[cache_key](use_cache=use_cache)
+        return self._snapshots[cache_key]['filas']
+
+    def marco(self, cache_key):
+        """
+        DataFrame cacheado de una hoja sin copiarlo (refrescándolo si venció), para
+        lectores que no lo modifican. Vacío si la hoja no tiene datos.
+        """
+        if not self._is_cache_valid(cache_key) or cache_key not in self._cache:
+            self._loaders()[cache_key]()
+        return self._cache.get(cache_key, pd.DataFrame())
+
+    def version(self, cache_key):
+        """Versión del snapshot de una hoja (cambia cada vez que se refresca), o None"""
+        snapshot = self._snapshots.get(cache_key)
+        return snapshot['version'] if snapshot else None
+
+    def snapshot_fresco(self, cache_key):
+        """Filas del snapshot (con encabezado) si todavía está vigente, o None"""
+        if self._is_cache_valid(cache_key) and cache_key in self._snapshots:
+            return self._snapshots[cache_key]['filas']
+        return None
+
+    def iterar_filas(self, cache_key, offset=0, limit=None, tamanio_pagina=PAGINA_FILAS):
+        """
+        Retorna (encabezados, generador de filas) empezando en la fila de datos `offset`.
+        Si el snapshot está vigente se sirve desde memoria; si no, se lee la hoja por
+        páginas de `tamanio_pagina` filas, sin descargarla completa.
+        """
+        filas = self.snapshot_fresco(cache_key)
+        if filas is not None:
+            encabezados = filas[0] if filas else []
+            fin = None if limit is None else offset + 1 + limit
+
+            def desde_snapshot():
+                for i in range(offset + 1, len(filas) if fin is None else min(fin, len(filas))):
+                    yield filas[i]
+
+            return encabezados, desde_snapshot()
+
+        hoja = self._get_worksheet(cache_key)
+        encabezados = hoja.row_values(1)
+        ancho = len(encabezados)
+        col_final = re.sub(r'\d', '', gspread.utils.rowcol_to_a1(1, max(ancho, 1)))
+
+        def paginado():
+            inicio = offset + 2  # fila base 1 en la hoja (la 1 es el encabezado)
+            restantes = limit
+            while restantes is None or restantes > 0:
+                cantidad = tamanio_pagina if restantes is None else min(tamanio_pagina, restantes)
+                valores = hoja.get(f'A{inicio}:{col_final}{inicio + cantidad - 1}')
+                if not valores:
+                    return
+                for fila in valores:
+                    yield list(fila) + [''] * (ancho - len(fila))
+                inicio += cantidad
+                if restantes is not None:
+                    restantes -= cantidad
+                if inicio > hoja.row_count:
+                    return
+
+        return encabezados, paginado()
+
+    def columnas(self, cache_key, esperadas=None):
+        """
+        Resuelve encabezado -> índice de columna (base 0) de una hoja.
+        Se calcula una vez por versión del snapshot, sin tráfico extra a Sheets
+        (solo carga la hoja si todavía no hay snapshot).
+        Si se pasan `esperadas` ({encabezado: índice}), avisa si la hoja se corrió.
+        """
+        if cache_key not in self._snapshots:
+            self.get_valores(cache_key)
+        snapshot = self._snapshots[cache_key]
+
+        cacheado = self._columnas.get(cache_key)
+        if cacheado and cacheado[0] == snapshot['version']:
+            return cacheado[1]
+
+        indices = {}
+        for idx, nombre in enumerate(snapshot['filas'][0] if snapshot['filas'] else []):
+            indices.setdefault(nombre.strip(), idx)
+        self._columnas[cache_key] = (snapshot['version'], indices)
+
+        if esperadas:
+            for aviso in self.validar_columnas(indices, esperadas):
+                print(f"ADVERTENCIA [{SHEET_NAMES[cache_key]}]: {aviso}")
+
+        return indices
+
+    @staticmethod
+    def validar_columnas(indices, esperadas):
+        """Compara los índices reales con los esperados y retorna la lista de diferencias"""
+        avisos = []
+        for nombre, idx_esperado in esperadas.items():
+            idx_real = indices.get(nombre)
+            if idx_real is None:
+                avisos.append(f"no se encontró la columna '{nombre}' (se esperaba en índice {idx_esperado})")
+            elif idx_real != idx_esperado:
+                avisos.append(f"la columna '{nombre}' está en el índice {idx_real}, CONFIG espera {idx_esperado}")
+        return avisos
+
     def _parse_number(self, value):
         """Convierte string a número, manejando formatos argentinos"""
         if pd.isna(value) or value == '' or value is None:
@@ -152,23 +685,49 @@ class DataLoader:
 
         return None
 
+    def _numeros(self, texto, tipadas, encabezado):
+        """
+        Columna numérica (float, NaN si vacía). Con valores tipados se toman los números
+        tal cual y solo se parsea el texto de las celdas que no son número en la hoja.
+        """
+        tipados = (tipadas or {}).get(encabezado)
+        if tipados is None:
+            return pd.to_numeric(texto.apply(self._parse_number), errors='coerce')
+
+        valores = pd.Series(tipados, index=texto.index, dtype=object)
+        es_numero = valores.map(lambda v: isinstance(v, (int, float)) and not isinstance(v, bool))
+        numeros = pd.to_numeric(valores.where(es_numero), errors='coerce')
+        parsear = ~es_numero & (valores != '')
+        if parsear.any():
+            numeros[parsear] = pd.to_numeric(texto[parsear].apply(self._parse_number), errors='coerce')
+        return numeros
+
+    def _fechas(self, texto, tipadas, encabezado):
+        """
+        Columna datetime64 (NaT si vacía). Los números de serie se convierten todos juntos;
+        solo se parsea el texto de las celdas que en la hoja no son fecha.
+        """
+        tipados = (tipadas or {}).get(encabezado)
+        if tipados is None:
+            return pd.to_datetime(texto.apply(self._parse_date))
+
+        valores = pd.Series(tipados, index=texto.index, dtype=object)
+        es_numero = valores.map(lambda v: isinstance(v, (int, float)) and not isinstance(v, bool))
+        fechas = pd.to_datetime(pd.to_numeric(valores.where(es_numero), errors='coerce'),
+                                unit='D', origin=ORIGEN_SERIAL).dt.floor('s')
+        parsear = ~es_numero & (valores != '')
+        if parsear.any():
+            fechas[parsear] = pd.to_datetime(texto[parsear].apply(self._parse_date))
+        return fechas
+
     def get_fletes(self, use_cache=True):
         """Obtiene DataFrame de Fletes facturados todos"""
-        cache_key = 'fletes'
-
-        if use_cache and self._is_cache_valid(cache_key):
-            return self._cache[cache_key].copy()
-
-        gc = self._get_client()
-        ss = gc.open_by_key(SPREADSHEET_IDS['cpe'])
-        hoja = ss.worksheet(SHEET_NAMES['fletes'])
-        datos = hoja.get_all_values()
-
-        if not datos:
-            return pd.DataFrame()
+        return self._cargar('fletes', self._construir_fletes, use_cache)
 
+    def _construir_fletes(self, encabezados, filas, tipadas=None):
+        """Construye el DataFrame de Fletes a partir de filas crudas"""
         # Crear DataFrame
-        df = pd.DataFrame(datos[1:], columns=datos[0])
+        df = pd.DataFrame(filas, columns=encabezados)
 
         # Renombrar columnas para facilitar uso
         column_map = {
@@ -198,13 +757,19 @@ class DataLoader:
         df = df.rename(columns=column_map)
 
         # Convertir tipos
-        df['fecha_dt'] = df['fecha'].apply(self._parse_date)
-        df['cantidad_num'] = df['cantidad'].apply(self._parse_number)
-        df['m_pesadas_num'] = df['m_pesadas'].apply(self._parse_number)
-        df['m_descargas_num'] = df['m_descargas'].apply(self._parse_number)
-        df['subtotal_num'] = df['subtotal'].apply(self._parse_number)
-        df['total_num'] = df['total'].apply(self._parse_number)
-        df['tarifa_num'] = df['tarifa'].apply(self._parse_number)
+        df['fecha_dt'] = self._fechas(df['fecha'], tipadas, 'Fecha')
+        df['cantidad_num'] = self._numeros(df['cantidad'], tipadas, 'Cantidad')
+        df['m_pesadas_num'] = self._numeros(df['m_pesadas'], tipadas, 'M Pesadas todos')
+        df['m_descargas_num'] = self._numeros(df['m_descargas'], tipadas, 'M Descargas todos')
+        df['subtotal_num'] = self._numeros(df['subtotal'], tipadas, 'Subtotal')
+        df['total_num'] = self._numeros(df['total'], tipadas, 'Total')
+        df['tarifa_num'] = self._numeros(df['tarifa'], tipadas, 'Tarifa')
+
+        # Claves canónicas, las mismas que usan los procesos para los joins
+        df['ctg_norm'] = ctgs_columna(df['ctg'])
+        df['cpe_norm'] = cpes_columna(df['cpe'])
+        df['producto_norm'] = productos_columna(df['producto'])
+        df['transportista_norm'] = nombres_columna(df['transportista'])
 
         # Calcular merma
         df['merma_kg'] = df.apply(
@@ -230,33 +795,20 @@ class DataLoader:
         )
 
         # Flags útiles
-        df['tiene_cpe'] = df['cpe'].apply(lambda x: bool(x and str(x).strip()))
+        df['tiene_cpe'] = df['cpe_norm'] != ''
         df['tiene_pesadas'] = df['m_pesadas_num'].notna()
         df['tiene_descargas'] = df['m_descargas_num'].notna()
         df['merma_sospechosa'] = df['merma_pct'].apply(lambda x: x > 0.3 if pd.notna(x) else False)
 
-        # Guardar en cache
-        self._cache[cache_key] = df
-        self._cache_time[cache_key] = datetime.now()
-
-        return df.copy()
+        return df
 
     def get_pesadas(self, use_cache=True):
         """Obtiene DataFrame de Pesadas Todos"""
-        cache_key = 'pesadas'
-
-        if use_cache and self._is_cache_valid(cache_key):
-            return self._cache[cache_key].copy()
-
-        gc = self._get_client()
-        ss = gc.open_by_key(SPREADSHEET_IDS['pesadas'])
-        hoja = ss.worksheet(SHEET_NAMES['pesadas'])
-        datos = hoja.get_all_values()
-
-        if not datos:
-            return pd.DataFrame()
+        return self._cargar('pesadas', self._construir_pesadas, use_cache)
 
-        df = pd.DataFrame(datos[1:], columns=datos[0])
+    def _construir_pesadas(self, encabezados, filas, tipadas=None):
+        """Construye el DataFrame de Pesadas Todos a partir de filas crudas"""
+        df = pd.DataFrame(filas, columns=encabezados)
 
         # Renombrar columnas
         column_map = {
@@ -284,32 +836,26 @@ class DataLoader:
         df = df.rename(columns=column_map)
 
         # Convertir tipos
-        df['fecha_dt'] = df['fecha'].apply(self._parse_date)
-        df['neto_num'] = df['neto'].apply(self._parse_number)
-        df['bruto_num'] = df['bruto'].apply(self._parse_number)
-        df['tara_num'] = df['tara'].apply(self._parse_number)
+        df['fecha_dt'] = self._fechas(df['fecha'], tipadas, 'Fecha')
+        df['neto_num'] = self._numeros(df['neto'], tipadas, 'Neto')
+        df['bruto_num'] = self._numeros(df['bruto'], tipadas, 'Bruto')
+        df['tara_num'] = self._numeros(df['tara'], tipadas, 'Tara')
 
-        self._cache[cache_key] = df
-        self._cache_time[cache_key] = datetime.now()
+        # Claves canónicas
+        df['patente_norm'] = patentes_columna(df['patente'])
+        df['cpe_norm'] = cpes_columna(df['cpe'])
+        df['producto_norm'] = productos_columna(df['producto'])
+        df['transportista_norm'] = nombres_columna(df['transportista'])
 
-        return df.copy()
+        return df
 
     def get_descargas(self, use_cache=True):
         """Obtiene DataFrame de Descargas Todos"""
-        cache_key = 'descargas'
+        return self._cargar('descargas', self._construir_descargas, use_cache)
 
-        if use_cache and self._is_cache_valid(cache_key):
-            return self._cache[cache_key].copy()
-
-        gc = self._get_client()
-        ss = gc.open_by_key(SPREADSHEET_IDS['cpe'])
-        hoja = ss.worksheet(SHEET_NAMES['descargas'])
-        datos = hoja.get_all_values()
-
-        if not datos:
-            return pd.DataFrame()
-
-        df = pd.DataFrame(datos[1:], columns=datos[0])
+    def _construir_descargas(self, encabezados, filas, tipadas=None):
+        """Construye el DataFrame de Descargas Todos a partir de filas crudas"""
+        df = pd.DataFrame(filas, columns=encabezados)
 
         # Renombrar columnas clave
         column_map = {
@@ -329,38 +875,42 @@ class DataLoader:
         df = df.rename(columns=column_map)
 
         # Convertir tipos
-        df['fecha_dt'] = df['fecha'].apply(self._parse_date)
-        df['peso_neto_num'] = df['peso_neto'].apply(self._parse_number)
+        df['fecha_dt'] = self._fechas(df['fecha'], tipadas, 'Fecha Descarga')
+        df['peso_neto_num'] = self._numeros(df['peso_neto'], tipadas, 'Peso Neto')
 
-        self._cache[cache_key] = df
-        self._cache_time[cache_key] = datetime.now()
+        # Claves canónicas
+        df['ctg_norm'] = ctgs_columna(df['ctg'])
+        df['cpe_norm'] = cpes_columna(df['cpe'])
+        df['patente_norm'] = patentes_columna(df['patente'])
+        df['producto_norm'] = productos_columna(df['producto'])
+        df['transportista_norm'] = nombres_columna(df['transportista'])
 
-        return df.copy()
+        return df
 
     def get_cpe(self, use_cache=True):
         """Obtiene DataFrame de Cartas de Porte"""
-        cache_key = 'cpe'
-
-        if use_cache and self._is_cache_valid(cache_key):
-            return self._cache[cache_key].copy()
-
-        gc = self._get_client()
-        ss = gc.open_by_key(SPREADSHEET_IDS['cpe'])
-        hoja = ss.worksheet(SHEET_NAMES['cpe'])
-        datos = hoja.get_all_values()
-
-        if not datos:
-            return pd.DataFrame()
+        return self._cargar('cpe', self._construir_cpe, use_cache)
 
-        df = pd.DataFrame(datos[1:], columns=datos[0])
+    def _construir_cpe(self, encabezados, filas, tipadas=None):
+        """Construye el DataFrame de Cartas de Porte a partir de filas crudas"""
+        df = pd.DataFrame(filas, columns=encabezados)
 
         # Convertir fecha
-        df['fecha_dt'] = df['fecha_documento'].apply(self._parse_date)
-
-        self._cache[cache_key] = df
-        self._cache_time[cache_key] = datetime.now()
-
-        return df.copy()
+        df['fecha_dt'] = self._fechas(df['fecha_documento'], tipadas, 'fecha_documento')
+
+        # Claves canónicas (los encabezados son los de AFIP, pueden faltar columnas)
+        if 'ctg' in df:
+            df['ctg_norm'] = ctgs_columna(df['ctg'])
+        if 'numero_cpe' in df:
+            df['cpe_norm'] = cpes_columna(df['numero_cpe'])
+        if 'grano_tipo' in df:
+            df['producto_norm'] = productos_columna(df['grano_tipo'])
+        if 'transportista' in df:
+            df['transportista_norm'] = nombres_columna(df['transportista'])
+        if 'dominios_vehiculos' in df:
+            df['patentes'] = extraer_patentes_columna(df['dominios_vehiculos'])
+
+        return df
 
     def get_summary_stats(self):
         """Obtiene estadísticas resumidas para KPIs"""
@@ -432,10 +982,91 @@ class DataLoader:
 
         return resumen.sort_values('cantidad_fletes', ascending=False)
 
-    def clear_cache(self):
-        """Limpia el cache"""
-        self._cache = {}
+    def _descartar(self, cache_key):
+        """Descarta el snapshot y el DataFrame de una hoja en este proceso"""
+        for cache in (self._cache, self._cache_time, self._snapshots, self._columnas,
+                      self._tipadas, self._construidos, self._cambiadas, self._generacion,
+                      self._version_compartida):
+            cache.pop(cache_key, None)
+
+    def invalidar(self, cache_key):
+        """
+        Descarta el snapshot y el DataFrame de una hoja (la próxima lectura es completa),
+        también en el cache compartido para que los demás workers la relean.
+        """
+        self._descartar(cache_key)
+        if self._compartido is not None:
+            self._compartido.invalidar(cache_key)
+        contar(f'invalidada_{cache_key}')
+
+    def aplicar_celdas(self, cache_key, celdas):
+        """
+        Aplica al snapshot de una hoja celdas que se acaban de escribir en Sheets
+        ({(fila, col): valor}, base 1) y le da una versión nueva, sin volver a descargarla:
+        del DataFrame se rearman solo las filas tocadas. Con cache compartido publica el
+        snapshot, y los demás workers lo toman sin ir a Sheets.
+        Retorna False si no se pudo (no hay snapshot, se escribió el encabezado o fuera de
+        sus columnas, otro worker escribió la hoja antes): entonces hay que invalidarla.
+        """
+        snapshot = self._snapshots.get(cache_key)
+        construir = getattr(self, f'_construir_{cache_key}', None)
+        if not snapshot or not snapshot['filas'] or cache_key not in self._cache or construir is None:
+            return False
+        filas = list(snapshot['filas'])
+        n, ancho = len(filas), len(filas[0])
+        if not celdas or any(fila < 2 or not 1 <= col <= ancho for fila, col in celdas):
+            return False
+
+        por_fila = {}
+        for (fila, col), valor in celdas.items():
+            por_fila.setdefault(fila, {})[col] = valor
+        filas.extend([''] * ancho for _ in range(max(por_fila) - n))
+        for fila, cambios in por_fila.items():
+            nueva = list(filas[fila - 1]) + [''] * (ancho - len(filas[fila - 1]))
+            for col, valor in cambios.items():
+                nueva[col - 1] = _texto_celda(valor)
+            filas[fila - 1] = nueva
+
+        cambiadas = sorted(f for f in por_fila if f <= n)
+        df = self._cache[cache_key]
+        if cambiadas:
+            df = self._reemplazar_filas(df, construir, filas, cambiadas)
+        if len(filas) > n:
+            df = pd.concat([df, construir(filas[0], filas[n:], None)], ignore_index=True)
+
+        if self._compartido is not None:
+            publicado = self._compartido.publicar(cache_key, filas, self._generacion.get(cache_key),
+                                                  self._version_compartida.get(cache_key))
+            if publicado is None:
+                return False
+            self._version_compartida[cache_key], self._generacion[cache_key] = publicado
+
+        previo = (n, snapshot['hash_cola'])
+        self._guardar_snapshot(cache_key, filas, completa=snapshot['completa'])
+        self._cache[cache_key] = df
+        self._sincronizar_espejo(cache_key, df, filas, True, cambiadas, previo)
+        contar(f'celdas_aplicadas_{cache_key}', len(celdas))
+        return True
+
+    @staticmethod
+    def clave_hoja(spreadsheet_id, titulo):
+        """cache_key de la hoja con ese spreadsheet y título, o None si DataLoader no la carga"""
+        for cache_key, nombre in SHEET_NAMES.items():
+            if nombre == titulo and SPREADSHEET_IDS[HOJA_SPREADSHEET[cache_key]] == spreadsheet_id:
+                return cache_key
+        return None
+
+    def clear_cache(self, completo=True):
+        """
+        Limpia el cache. Por defecto descarta también los snapshots, así el próximo
+        refresco relee todas las hojas completas (ve ediciones en cualquier fila).
+        Con completo=False solo lo marca como vencido: las hojas incrementales
+        conservan su snapshot y traen únicamente las filas nuevas.
+        """
         self._cache_time = {}
+        if completo:
+            self._cache = {}
+            self._snapshots = {}
 
 
 # Instancia global
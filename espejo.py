@@ -0,0 +1,288 @@
+"""
+Espejo SQLite - Copia local e indexada de los DataFrames de DataLoader (Fletes,
+Pesadas, Descargas y CPE), para consultar por CTG, número de CPE, patente+fecha o
+transportista con SQL indexado en lugar de recorrer las tablas enteras.
+
+Se activa con la variable de entorno ESPEJO_SQLITE_PATH (ruta del .sqlite); queda en
+disco entre corridas. Cada vez que DataLoader arma un DataFrame se sincroniza la
+tabla: si DataLoader verificó que el snapshot solo agregó filas al final, se insertan
+esas; si sabe exactamente qué filas cambiaron (celdas que escribió la app), se
+reescriben solo esas; si lo releyó completo, se compara el hash de todas las filas y
+se reescribe la tabla cuando el contenido cambió (así se corrigen las filas editadas).
+"""
+
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from metrics import contar
+
+RUTA = os.environ.get('ESPEJO_SQLITE_PATH', '')
+
+# Segundos que se espera a que SQLite libere una escritura
+TIMEOUT_SQLITE = 30
+
+# Filas finales del espejo que se comparan con la hoja para decidir si solo se agregan filas
+FILAS_HASH_COLA = 20
+
+# Índices por tabla: nombre -> columnas del DataFrame (se crean si la columna existe)
+INDICES = {
+    'fletes': {'ctg': ('ctg_norm',), 'cpe': ('cpe_norm',), 'transportista': ('transportista_norm',)},
+    'pesadas': {'cpe': ('cpe_norm',), 'patente_fecha': ('patente_norm', 'fecha_dt'),
+                'transportista': ('transportista_norm',)},
+    'descargas': {'ctg': ('ctg_norm',), 'cpe': ('cpe_norm',), 'patente_fecha': ('patente_norm', 'fecha_dt'),
+                  'transportista': ('transportista_norm',)},
+    'cpe': {'ctg': ('ctg_norm',), 'cpe': ('cpe_norm',), 'transportista': ('transportista_norm',)},
+}
+
+# Las patentes de una CPE (camión + acoplado) van en una tabla aparte, una fila por patente
+TABLA_PATENTES_CPE = 'cpe_patentes'
+
+
+def nombre_columna(encabezado):
+    """Nombre de columna SQL a partir de un encabezado de la hoja ('     Bruto' -> 'bruto')"""
+    nombre = re.sub(r'\W+', '_', str(encabezado).strip().lower()).strip('_')
+    return nombre or 'columna'
+
+
+def _columnas_sql(df):
+    """[(columna del DataFrame, nombre SQL, tipo SQL)] sin repetir nombres"""
+    columnas = []
+    usados = {'fila'}
+    for col in df.columns:
+        serie = df[col]
+        if pd.api.types.is_bool_dtype(serie):
+            tipo = 'INTEGER'
+        elif pd.api.types.is_numeric_dtype(serie):
+            tipo = 'REAL'
+        elif pd.api.types.is_datetime64_any_dtype(serie):
+            tipo = 'TEXT'
+        elif len(serie) and isinstance(serie.iloc[0], tuple):
+            continue  # patentes de la CPE: van a TABLA_PATENTES_CPE
+        else:
+            tipo = 'TEXT'
+        nombre = nombre_columna(col)
+        base, n = nombre, 2
+        while nombre in usados:
+            nombre, n = f"{base}_{n}", n + 1
+        usados.add(nombre)
+        columnas.append((col, nombre, tipo))
+    return columnas
+
+
+def _valores(serie, tipo):
+    """Columna como lista de valores para SQLite (None en vez de NaN/NaT)"""
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        return [None if pd.isna(v) else v for v in serie.dt.strftime('%Y-%m-%d')]
+    if tipo == 'INTEGER':
+        return serie.astype(int).tolist()
+    if tipo == 'REAL':
+        arr = serie.to_numpy(dtype=float, na_value=np.nan)
+        return [None if v != v else v for v in arr.tolist()]
+    return [None if v is None or (isinstance(v, float) and v != v) else str(v) for v in serie.tolist()]
+
+
+class EspejoSQLite:
+    """Tablas indexadas con el último DataFrame de cada hoja y su estado de sincronización"""
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._lock = threading.Lock()
+        with self._conectar() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS espejo_meta ('
+                ' tabla TEXT PRIMARY KEY, filas INTEGER, hash TEXT, columnas TEXT, actualizado REAL,'
+                ' hash_cola TEXT)'
+            )
+            # Espejos creados antes de que existiera hash_cola
+            if 'hash_cola' not in {c[1] for c in conn.execute('PRAGMA table_info(espejo_meta)')}:
+                conn.execute('ALTER TABLE espejo_meta ADD COLUMN hash_cola TEXT')
+
+    @contextmanager
+    def _conectar(self, solo_lectura=False):
+        if solo_lectura:
+            conn = sqlite3.connect(f"file:{self.ruta}?mode=ro", uri=True, timeout=TIMEOUT_SQLITE)
+        else:
+            conn = sqlite3.connect(self.ruta, timeout=TIMEOUT_SQLITE)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def sincronizar(self, tabla, df, datos, incremental, cambiadas=(), previo=None):
+        """
+        Lleva la tabla al contenido de `df` (DataFrame de DataLoader armado a partir de
+        `datos`, las filas crudas con encabezado). Con incremental=True (DataLoader
+        verificó que las filas anteriores del snapshot no cambiaron), si el espejo coincide
+        con el comienzo de la hoja solo se insertan las filas que faltan. Si además se pasan
+        `cambiadas` (filas de la hoja, base 1, editadas en el snapshot) y `previo`
+        ((filas, hash_cola) del snapshot anterior), se reescriben esas filas siempre que el
+        espejo esté en ese snapshot anterior. Si no, se compara el hash de todas las filas
+        y se reescribe la tabla si cambió.
+        Retorna la cantidad de filas escritas.
+        """
+        from data_loader import _hash_filas
+
+        columnas = _columnas_sql(df)
+        firma = '|'.join(f"{nombre}:{tipo}" for _, nombre, tipo in columnas)
+        total = len(datos)
+        hash_cola = _hash_filas(datos[max(1, total - FILAS_HASH_COLA):])
+
+        with self._lock, self._conectar() as conn:
+            meta = conn.execute('SELECT filas, hash, columnas, hash_cola FROM espejo_meta WHERE tabla = ?',
+                                (tabla,)).fetchone()
+
+            desde, hash_total, editadas = 1, None, ()
+            if incremental and meta and meta[2] == firma and 1 < meta[0] <= total:
+                previas = meta[0]
+                if previo is not None:
+                    # El espejo tiene el snapshot anterior: alcanza con las filas editadas
+                    if (previas, meta[3]) == tuple(previo):
+                        desde, editadas = previas, tuple(cambiadas)
+                elif _hash_filas(datos[max(1, previas - FILAS_HASH_COLA):previas]) == meta[3]:
+                    desde = previas
+            if desde == 1:
+                # Hash de todas las filas: después de agregar filas sueltas queda desconocido (NULL)
+                hash_total = _hash_filas(datos[1:])
+                if meta and meta[0] == total and meta[1] == hash_total and meta[2] == firma:
+                    desde = total
+
+            if desde == total and not editadas:
+                contar(f'espejo_al_dia_{tabla}')
+                return 0
+
+            if desde == 1:
+                self._recrear(conn, tabla, columnas)
+            elif editadas:
+                self._borrar(conn, tabla, editadas)
+            # La fila i del DataFrame es la fila i + 2 de la hoja (la 1 es el encabezado)
+            nuevas = df.iloc[[f - 2 for f in editadas] + list(range(desde - 1, len(df)))]
+            self._insertar(conn, tabla, nuevas, columnas)
+            if desde == 1:
+                self._indexar(conn, tabla, columnas)
+            conn.execute('INSERT OR REPLACE INTO espejo_meta (tabla, filas, hash, columnas, actualizado, hash_cola) '
+                         'VALUES (?, ?, ?, ?, ?, ?)', (tabla, total, hash_total, firma, time.time(), hash_cola))
+
+        contar(f"espejo_{'completo' if desde == 1 else 'incremental'}_{tabla}")
+        return len(nuevas)
+
+    def _recrear(self, conn, tabla, columnas):
+        conn.execute(f'DROP TABLE IF EXISTS "{tabla}"')
+        definicion = ', '.join(f'"{nombre}" {tipo}' for _, nombre, tipo in columnas)
+        conn.execute(f'CREATE TABLE "{tabla}" (fila INTEGER PRIMARY KEY, {definicion})')
+        if tabla == 'cpe':
+            conn.execute(f'DROP TABLE IF EXISTS "{TABLA_PATENTES_CPE}"')
+            conn.execute(f'CREATE TABLE "{TABLA_PATENTES_CPE}" (fila INTEGER, patente_norm TEXT, fecha_dt TEXT)')
+
+    def _indexar(self, conn, tabla, columnas):
+        """Índices de INDICES; en una carga completa se crean después de insertar (es más rápido)"""
+        nombres = {col: nombre for col, nombre, _ in columnas}
+        for indice, cols in INDICES.get(tabla, {}).items():
+            if all(c in nombres for c in cols):
+                lista = ', '.join(f'"{nombres[c]}"' for c in cols)
+                conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{tabla}_{indice}" ON "{tabla}" ({lista})')
+        if tabla == 'cpe':
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{TABLA_PATENTES_CPE}_patente_fecha" '
+                         f'ON "{TABLA_PATENTES_CPE}" (patente_norm, fecha_dt)')
+
+    def _borrar(self, conn, tabla, filas):
+        """Borra filas de la hoja (base 1) de la tabla, para volver a insertarlas editadas"""
+        tablas = [tabla] + ([TABLA_PATENTES_CPE] if tabla == 'cpe' else [])
+        for nombre in tablas:
+            conn.executemany(f'DELETE FROM "{nombre}" WHERE fila = ?', ((f,) for f in filas))
+
+    def _insertar(self, conn, tabla, df, columnas):
+        if df.empty:
+            return
+        filas = (df.index.to_numpy() + 2).tolist()
+        valores = [_valores(df[col], tipo) for col, _, tipo in columnas]
+        lista = ', '.join(['fila'] + [f'"{nombre}"' for _, nombre, _ in columnas])
+        marcas = ', '.join('?' * (len(columnas) + 1))
+        conn.executemany(f'INSERT INTO "{tabla}" ({lista}) VALUES ({marcas})', zip(filas, *valores))
+
+        if tabla == 'cpe' and 'patentes' in df:
+            fechas = _valores(df['fecha_dt'], 'TEXT') if 'fecha_dt' in df else [None] * len(df)
+            conn.executemany(
+                f'INSERT INTO "{TABLA_PATENTES_CPE}" (fila, patente_norm, fecha_dt) VALUES (?, ?, ?)',
+                ((fila, patente, fecha) for fila, patentes, fecha in zip(filas, df['patentes'].tolist(), fechas)
+                 for patente in patentes)
+            )
+
+    def consultar(self, sql, parametros=()):
+        """Filas ({columna: valor}) de una consulta, con una conexión de solo lectura"""
+        with self._conectar(solo_lectura=True) as conn:
+            cursor = conn.execute(sql, parametros)
+            nombres = [d[0] for d in cursor.description or []]
+            return [dict(zip(nombres, fila)) for fila in cursor.fetchall()]
+
+    def estado(self):
+        """{tabla: {filas, actualizado}} de lo que hay en el espejo"""
+        with self._conectar(solo_lectura=True) as conn:
+            return {tabla: {'filas': filas - 1, 'actualizado': actualizado}
+                    for tabla, filas, actualizado in conn.execute('SELECT tabla, filas, actualizado FROM espejo_meta')}
+
+    def buscar(self, ctg=None, cpe=None, patente=None, fecha=None, transportista=None, limite=100):
+        """
+        Filas de todas las tablas que coinciden con los filtros dados (claves canónicas de
+        normalizacion), usando los índices del espejo. Retorna {tabla: [filas]}.
+        """
+        from normalizacion import normalizar_ctg, normalizar_cpe, normalizar_patente, normalizar_fecha, normalizar_nombre
+
+        filtros = {
+            'ctg_norm': normalizar_ctg(ctg) if ctg else None,
+            'cpe_norm': normalizar_cpe(cpe) if cpe else None,
+            'patente_norm': normalizar_patente(patente) if patente else None,
+            'fecha_dt': normalizar_fecha(fecha) if fecha else None,
+            'transportista_norm': normalizar_nombre(transportista) if transportista else None,
+        }
+        filtros = {c: v for c, v in filtros.items() if v}
+        if not filtros:
+            return {}
+
+        with self._conectar(solo_lectura=True) as conn:
+            columnas = {tabla: {fila[1] for fila in conn.execute(f'PRAGMA table_info("{tabla}")')}
+                        for tabla in INDICES}
+
+        resultado = {}
+        for tabla in INDICES:
+            if not columnas[tabla]:
+                continue
+            condiciones, parametros, desde = [], [], f'"{tabla}" t'
+            por_patente = tabla == 'cpe' and 'patente_norm' in filtros
+            if por_patente:
+                # Las patentes de la CPE están en su propia tabla, indexada por patente+fecha
+                desde += f' JOIN "{TABLA_PATENTES_CPE}" p ON p.fila = t.fila'
+                for col in ('patente_norm', 'fecha_dt'):
+                    if col in filtros:
+                        condiciones.append(f'p.{col} = ?')
+                        parametros.append(filtros[col])
+            for col, valor in filtros.items():
+                if por_patente and col in ('patente_norm', 'fecha_dt'):
+                    continue
+                if col not in columnas[tabla]:
+                    break
+                condiciones.append(f't."{col}" = ?')
+                parametros.append(valor)
+            else:
+                sql = f'SELECT DISTINCT t.* FROM {desde} WHERE {" AND ".join(condiciones)} ORDER BY t.fila LIMIT ?'
+                resultado[tabla] = self.consultar(sql, parametros + [limite])
+        return resultado
+
+
+def crear_desde_entorno():
+    """EspejoSQLite si ESPEJO_SQLITE_PATH está configurado, si no None"""
+    if not RUTA:
+        return None
+    try:
+        return EspejoSQLite(RUTA)
+    except Exception as e:
+        print(f"ADVERTENCIA: no se pudo abrir el espejo SQLite {RUTA}: {e}")
+        return None
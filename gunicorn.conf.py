@@ -0,0 +1,28 @@
+"""
+Configuración de gunicorn
+La app se carga y se precalienta en el proceso maestro (preload_app) antes de
+crear los workers, que heredan los datos ya cargados y recién ahí reciben tráfico.
+"""
+
+preload_app = True
+
+
+def on_starting(server):
+    from warmup import calentar
+    resultado = calentar()
+    server.log.info(f"Warm-up {resultado['estado']} en {resultado['segundos']}s")
+
+
+def post_fork(server, worker):
+    from warmup import reiniciar_clientes
+    reiniciar_clientes()
+
+
+def worker_exit(server, worker):
+    # Un worker que se detiene (reinicio, max_requests, SIGTERM) no siempre corre atexit:
+    # escribir ahí las ediciones manuales que quedaron en la cola
+    from manual_edits import cola_ediciones
+    cola_ediciones.flush()
+    pendientes = cola_ediciones.estado()['pendientes']
+    if pendientes:
+        server.log.warning(f"Worker {worker.pid}: {pendientes} ediciones manuales sin escribir")
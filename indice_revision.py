@@ -0,0 +1,107 @@
+"""
+Índice de Revisión - Casos REVISAR de Pesadas con sus CPEs alternativas rankeadas.
+Se arma una vez por versión de los snapshots de Pesadas y CPE, con el mismo motor
+que usa asignar_cpes para marcarlos (candidatos_cpe), y la página de duplicados se
+sirve desde memoria.
+
+La única fuente es el snapshot de DataLoader: cuando se escribe en Pesadas (marcar OK,
+una corrida de asignar_cpes) WriteBuffer aplica las celdas escritas al snapshot, que
+cambia de versión sin releer la hoja (y se publica a los demás workers si hay cache
+compartido), y el índice se rearma con esas filas.
+"""
+
+import threading
+
+from claves import Claves
+from data_loader import data_loader
+from normalizacion import normalizar_fecha, normalizar_producto
+
+
+class IndiceRevision:
+    """Casos REVISAR por fila de Pesadas (base 1)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versiones = None
+        self._claves = Claves()       # ids de patentes y CPEs del snapshot
+        self._cpes = [[]]             # id patente -> [CartaPorte] (cpes_por_patente)
+        self._usadas = {}             # id cpe -> fila de Pesadas que la tiene asignada
+        self._casos = {}              # fila -> caso
+        self.patentes_duplicadas = 0
+
+    def _caso(self, fila_num, fila):
+        """Caso de revisión de una fila, o None si no está marcada REVISAR"""
+        from app import CONFIG, candidatos_cpe, empatadas
+
+        def celda(col):
+            return fila[col] if len(fila) > col else ''
+
+        if str(celda(CONFIG['PESADAS_COL_VERIFICADO'])).strip().upper() != 'REVISAR':
+            return None
+
+        patente = celda(CONFIG['PESADAS_COL_PATENTE'])
+        fecha_pesada = celda(CONFIG['PESADAS_COL_FECHA'])
+        producto_pesada = celda(CONFIG['PESADAS_COL_PRODUCTO'])
+
+        _, en_rango = candidatos_cpe(self._cpes[self._claves.patentes.buscar(patente)],
+                                     normalizar_fecha(fecha_pesada), normalizar_producto(producto_pesada))
+
+        def usada_en(id_cpe):
+            # Fila de otra pesada que ya tiene asignada esa CPE (None si está libre)
+            fila_usada = self._usadas.get(id_cpe)
+            return fila_usada if fila_usada != fila_num else None
+
+        return {
+            'fila': fila_num,
+            'patente': patente,
+            'fecha_pesada': fecha_pesada,
+            'producto_pesada': producto_pesada,
+            'neto': celda(CONFIG['PESADAS_COL_NETO']),
+            'cpe_asignado': str(celda(CONFIG['PESADAS_COL_CPE'])).strip(),
+            'empate': len(empatadas(en_rango)),
+            'cpes_alternativas': [{'numero_cpe': c.numero_cpe, 'fecha': c.fecha, 'dias': dias,
+                                   'grano_tipo': c.grano_tipo, 'usada_en': usada_en(c.id)}
+                                  for dias, c in en_rango]
+        }
+
+    def _construir(self, pesadas, cpe):
+        from app import CONFIG, cpes_por_patente
+
+        self._claves = Claves()
+        self._cpes = cpes_por_patente(cpe, self._claves)
+        self.patentes_duplicadas = sum(1 for lista in self._cpes if len(lista) > 1)
+
+        col_cpe = CONFIG['PESADAS_COL_CPE']
+        col_verificado = CONFIG['PESADAS_COL_VERIFICADO']
+        self._usadas = {}
+        revisar = []
+        for fila_num in range(2, len(pesadas) + 1):
+            fila = pesadas[fila_num - 1]
+            id_cpe = self._claves.cpes.buscar(fila[col_cpe]) if len(fila) > col_cpe else -1
+            if id_cpe >= 0:
+                self._usadas[id_cpe] = fila_num
+            if len(fila) > col_verificado and str(fila[col_verificado]).strip().upper() == 'REVISAR':
+                revisar.append(fila_num)
+
+        self._casos = {}
+        for fila_num in revisar:
+            self._casos[fila_num] = self._caso(fila_num, pesadas[fila_num - 1])
+
+    def casos(self, refrescar=False):
+        """
+        Casos REVISAR ordenados por fila. Solo se recalcula si cambió la versión del
+        snapshot de Pesadas o de CPE; con refrescar=True se le pide a DataLoader que relea
+        las hojas completas.
+        """
+        pesadas = data_loader.get_valores('pesadas', use_cache=not refrescar)
+        cpe = data_loader.get_valores('cpe', use_cache=not refrescar)
+        versiones = (data_loader.version('pesadas'), data_loader.version('cpe'))
+        with self._lock:
+            if versiones != self._versiones:
+                self._construir(pesadas, cpe)
+                self._versiones = versiones
+            return [self._casos[f] for f in sorted(self._casos)]
+
+
+# Instancia global
+indice_revision = IndiceRevision()
@@ -0,0 +1,184 @@
+"""
+Cola de Ediciones Manuales - Acepta al instante las clasificaciones hechas
+desde el Dashboard y las escribe en Sheets en lote cada pocos segundos.
+"""
+
+import atexit
+import threading
+from collections import deque
+from datetime import datetime
+
+from write_buffer import WriteBuffer
+from sheets_backend import get_client
+
+# Segundos entre cada escritura en lote
+INTERVALO_FLUSH = 5
+
+# Reintentos antes de descartar una edición y reportarla como fallida
+MAX_INTENTOS = 3
+
+# Cantidad de errores recientes que se muestran en la UI
+MAX_ERRORES = 20
+
+
+class ColaEdiciones:
+    """
+    Cola de ediciones pendientes con un hilo que las aplica periódicamente.
+    Cada edición es (spreadsheet_id, nombre_hoja, fila, {columna: valor}),
+    donde columna es un número base 1 o el nombre del encabezado.
+    """
+
+    def __init__(self, intervalo=INTERVALO_FLUSH):
+        self.intervalo = intervalo
+        self.gc = None
+        self._lock = threading.Lock()
+        # Un solo flush a la vez: el de worker_exit/atexit espera al que está escribiendo
+        # y un lote reintentado no puede pisar a uno más nuevo
+        self._lock_flush = threading.Lock()
+        self._pendientes = []
+        self._errores = deque(maxlen=MAX_ERRORES)
+        self._aplicadas = 0
+        self._en_vuelo = 0
+        self._hojas = {}       # (spreadsheet_id, nombre) -> worksheet
+        self._despertar = threading.Event()
+        self._hilo = None
+
+    def _get_client(self):
+        if self.gc is None:
+            from app import get_credentials
+            self.gc = get_client(get_credentials)
+        return self.gc
+
+    def _get_hoja(self, spreadsheet_id, nombre):
+        clave = (spreadsheet_id, nombre)
+        if clave not in self._hojas:
+            self._hojas[clave] = self._get_client().open_by_key(spreadsheet_id).worksheet(nombre)
+        return self._hojas[clave]
+
+    def _col_num(self, spreadsheet_id, nombre, columna, encabezados):
+        """
+        Resuelve una columna (número o encabezado) a número base 1. Las hojas que carga
+        DataLoader usan sus columnas(), que siguen a la versión del snapshot; las demás
+        leen el encabezado una vez por flush (`encabezados` es el cache de esa pasada).
+        """
+        if isinstance(columna, int):
+            return columna
+        from data_loader import data_loader
+        cache_key = data_loader.clave_hoja(spreadsheet_id, nombre)
+        if cache_key is not None:
+            indices = data_loader.columnas(cache_key)
+        else:
+            clave = (spreadsheet_id, nombre)
+            if clave not in encabezados:
+                fila = self._get_hoja(spreadsheet_id, nombre).row_values(1)
+                encabezados[clave] = {}
+                for idx, titulo in enumerate(fila):
+                    encabezados[clave].setdefault(titulo.strip(), idx)
+            indices = encabezados[clave]
+        if columna not in indices:
+            raise ValueError(f"No se encontró la columna '{columna}' en {nombre}")
+        return indices[columna] + 1
+
+    def encolar(self, spreadsheet_id, nombre, fila, cambios, descripcion='', inmediato=False):
+        """
+        Agrega una edición a la cola y asegura que el hilo de escritura esté corriendo.
+        Con inmediato=True el hilo la escribe ya, sin esperar el intervalo (p.ej. un OK
+        que el usuario va a querer ver al recargar la lista).
+        """
+        with self._lock:
+            self._pendientes.append({
+                'spreadsheet_id': spreadsheet_id,
+                'hoja': nombre,
+                'fila': fila,
+                'cambios': dict(cambios),
+                'descripcion': descripcion or f"Fila {fila}",
+                'intentos': 0
+            })
+        self._iniciar()
+        if inmediato:
+            self._despertar.set()
+
+    def _iniciar(self):
+        if self._hilo is None or not self._hilo.is_alive():
+            self._hilo = threading.Thread(target=self._loop, name='cola-ediciones', daemon=True)
+            self._hilo.start()
+
+    def _loop(self):
+        while True:
+            self._despertar.wait(self.intervalo)
+            self._despertar.clear()
+            self.flush()
+
+    def flush(self):
+        """Escribe todas las ediciones pendientes en un solo batch_update por spreadsheet"""
+        with self._lock_flush:
+            with self._lock:
+                lote, self._pendientes = self._pendientes, []
+                self._en_vuelo += len(lote)
+            if not lote:
+                return
+            reintentar = []
+            try:
+                reintentar = self._escribir(lote)
+            finally:
+                with self._lock:
+                    # Los reintentos van antes que las ediciones más nuevas
+                    self._pendientes = reintentar + self._pendientes
+                    self._en_vuelo -= len(lote)
+
+    def _escribir(self, lote):
+        """Aplica un lote de ediciones y retorna las que hay que reintentar"""
+        buffer = WriteBuffer()
+        encabezados = {}
+        validas = []
+        for edicion in lote:
+            try:
+                hoja = self._get_hoja(edicion['spreadsheet_id'], edicion['hoja'])
+                for columna, valor in edicion['cambios'].items():
+                    col = self._col_num(edicion['spreadsheet_id'], edicion['hoja'], columna, encabezados)
+                    buffer.escribir(hoja, edicion['fila'], col, valor)
+                validas.append(edicion)
+            except Exception as e:
+                self._registrar_error(edicion, e)
+
+        try:
+            buffer.flush()
+            with self._lock:
+                self._aplicadas += len(validas)
+            return []
+        except Exception as e:
+            # Reintentar en la próxima pasada (p.ej. quota excedida)
+            reintentar = []
+            with self._lock:
+                for edicion in validas:
+                    edicion['intentos'] += 1
+                    if edicion['intentos'] >= MAX_INTENTOS:
+                        self._agregar_error(edicion, e)
+                    else:
+                        reintentar.append(edicion)
+            return reintentar
+
+    def _agregar_error(self, edicion, error):
+        self._errores.append({
+            'descripcion': edicion['descripcion'],
+            'error': str(error),
+            'hora': datetime.now().strftime('%H:%M:%S')
+        })
+
+    def _registrar_error(self, edicion, error):
+        with self._lock:
+            self._agregar_error(edicion, error)
+
+    def estado(self):
+        """Resumen para la UI: pendientes, aplicadas y últimos errores"""
+        with self._lock:
+            return {
+                'pendientes': len(self._pendientes) + self._en_vuelo,
+                'aplicadas': self._aplicadas,
+                'errores': list(self._errores)
+            }
+
+
+# Instancia global
+cola_ediciones = ColaEdiciones()
+atexit.register(cola_ediciones.flush)
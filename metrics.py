@@ -0,0 +1,275 @@
+"""
+Métricas del Pipeline - Tiempos por fase, llamadas a Sheets y memoria de cada paso.
+
+    @instrumentado('asignar_cpes')        # mide todo el paso y agrega 'metricas' al resultado
+    def asignar_cpes(...):
+        datos = leer_valores(hoja)        # fase 'descarga' + contadores de lectura
+        with fase('parseo'):
+            ...
+
+Las fases son exclusivas: el tiempo de una fase anidada no se cuenta en la de afuera,
+y lo que no cae en ninguna fase se reporta como 'match'. Los acumulados de todas las
+corridas se exponen en formato Prometheus con prometheus().
+"""
+
+import functools
+import os
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+# tracemalloc da el pico exacto de memoria de Python de cada paso pero hace más lenta
+# la ejecución; sin él se informa cuánto creció el RSS como máximo durante el paso
+# (muestreado cada INTERVALO_RSS segundos, solo en Linux)
+MEDIR_MEMORIA = os.environ.get('METRICS_TRACEMALLOC', '0') == '1'
+
+# Segundos entre muestras del RSS durante un paso
+INTERVALO_RSS = 0.05
+
+# Filas que se miden para estimar los bytes descargados de una hoja
+FILAS_MUESTRA_BYTES = 200
+
+_local = threading.local()
+_lock = threading.Lock()
+_acumulado = Counter()   # (metrica, labels) -> valor (contadores)
+_ultimo = {}             # (metrica, labels) -> valor (gauges de la última corrida)
+
+
+def _rss_mb():
+    """RSS actual del proceso en MB, o None si no hay /proc (no es Linux)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class _MuestreoRSS:
+    """Hilo que toma el RSS cada INTERVALO_RSS segundos mientras dura un paso"""
+
+    def __init__(self):
+        self.inicio = _rss_mb()
+        self.pico = self.inicio
+        self._fin = threading.Event()
+        self._hilo = None
+        if self.inicio is not None:
+            self._hilo = threading.Thread(target=self._loop, name='muestreo-rss', daemon=True)
+            self._hilo.start()
+
+    def _loop(self):
+        while not self._fin.wait(INTERVALO_RSS):
+            rss = _rss_mb()
+            if rss is not None and rss > self.pico:
+                self.pico = rss
+
+    def terminar(self):
+        """Crecimiento máximo del RSS (MB) respecto del comienzo del paso, o None"""
+        if self._hilo is None:
+            return None
+        self._fin.set()
+        self._hilo.join()
+        final = _rss_mb()
+        if final is not None and final > self.pico:
+            self.pico = final
+        return max(self.pico - self.inicio, 0.0)
+
+
+class Medicion:
+    """Tiempos por fase y contadores de un paso del pipeline"""
+
+    def __init__(self, paso):
+        self.paso = paso
+        self.fases = Counter()
+        self.contadores = Counter()
+        self.memoria_pico_mb = None
+        self.segundos = 0.0
+        self._pila = []  # [[nombre, inicio]]
+        self._inicio = time.perf_counter()
+
+    def _entrar(self, nombre):
+        ahora = time.perf_counter()
+        if self._pila:
+            self.fases[self._pila[-1][0]] += ahora - self._pila[-1][1]
+        self._pila.append([nombre, ahora])
+
+    def _salir(self):
+        ahora = time.perf_counter()
+        nombre, inicio = self._pila.pop()
+        self.fases[nombre] += ahora - inicio
+        if self._pila:
+            self._pila[-1][1] = ahora
+
+    def contar(self, nombre, cantidad=1):
+        self.contadores[nombre] += cantidad
+
+    def resumen(self):
+        fases = {nombre: round(seg, 4) for nombre, seg in self.fases.items()}
+        fases['match'] = round(max(self.segundos - sum(self.fases.values()), 0.0), 4)
+        return {
+            'segundos': round(self.segundos, 4),
+            'fases': fases,
+            'contadores': dict(self.contadores),
+            'memoria_pico_mb': self.memoria_pico_mb
+        }
+
+
+def actual():
+    """Medición activa en este hilo (o None)"""
+    pila = getattr(_local, 'pila', None)
+    return pila[-1] if pila else None
+
+
+@contextmanager
+def medir(paso):
+    """Mide un paso completo; al salir publica los valores en los acumulados de /metrics"""
+    m = Medicion(paso)
+    if not hasattr(_local, 'pila'):
+        _local.pila = []
+    _local.pila.append(m)
+
+    propio_tracemalloc = False
+    muestreo = None
+    if MEDIR_MEMORIA:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            propio_tracemalloc = True
+        tracemalloc.reset_peak()
+    else:
+        muestreo = _MuestreoRSS()
+
+    try:
+        yield m
+    finally:
+        m.segundos = time.perf_counter() - m._inicio
+        if MEDIR_MEMORIA:
+            m.memoria_pico_mb = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2)
+            if propio_tracemalloc:
+                tracemalloc.stop()
+        else:
+            pico = muestreo.terminar()
+            m.memoria_pico_mb = round(pico, 2) if pico is not None else None
+        _local.pila.pop()
+        _publicar(m)
+
+
+@contextmanager
+def fase(nombre):
+    """Span de una fase dentro del paso activo; no hace nada si no hay medición"""
+    m = actual()
+    if m is None:
+        yield
+        return
+    m._entrar(nombre)
+    try:
+        yield
+    finally:
+        m._salir()
+
+
+def en_fase(nombre):
+    """Decorador: ejecuta toda la función dentro de fase(nombre)"""
+    def decorador(func):
+        @functools.wraps(func)
+        def envoltura(*args, **kwargs):
+            with fase(nombre):
+                return func(*args, **kwargs)
+        return envoltura
+    return decorador
+
+
+def instrumentado(paso):
+    """Decorador para procesos que retornan un dict: agrega resultado['metricas']"""
+    def decorador(func):
+        @functools.wraps(func)
+        def envoltura(*args, **kwargs):
+            with medir(paso) as m:
+                resultado = func(*args, **kwargs)
+            if isinstance(resultado, dict):
+                resultado['metricas'] = m.resumen()
+            return resultado
+        return envoltura
+    return decorador
+
+
+def contar(nombre, cantidad=1):
+    m = actual()
+    if m is not None:
+        m.contar(nombre, cantidad)
+
+
+def estimar_bytes(datos):
+    """Bytes aproximados de una hoja, midiendo una muestra de filas"""
+    if not datos:
+        return 0
+    muestra = datos[:FILAS_MUESTRA_BYTES]
+    por_fila = sum(len(c) for fila in muestra for c in fila) / len(muestra)
+    return int(por_fila * len(datos))
+
+
+def registrar_lectura(datos):
+    """Cuenta una lectura de hoja completa (filas y bytes) en el paso activo"""
+    if actual() is not None:
+        contar('lecturas_sheets')
+        contar('filas_leidas', len(datos))
+        contar('bytes_descargados', estimar_bytes(datos))
+
+
+def leer_valores(hoja):
+    """get_all_values dentro de la fase 'descarga', contando la lectura, filas y bytes"""
+    with fase('descarga'):
+        datos = hoja.get_all_values()
+    registrar_lectura(datos)
+    return datos
+
+
+def _publicar(m):
+    labels = (('paso', m.paso),)
+    with _lock:
+        _acumulado[('pipeline_paso_ejecuciones_total', labels)] += 1
+        _acumulado[('pipeline_paso_segundos_total', labels)] += m.segundos
+        for nombre, valor in m.resumen()['fases'].items():
+            _acumulado[('pipeline_fase_segundos_total', labels + (('fase', nombre),))] += valor
+        for nombre, valor in m.contadores.items():
+            _acumulado[(f'pipeline_{nombre}_total', labels)] += valor
+        _ultimo[('pipeline_paso_ultimo_segundos', labels)] = m.segundos
+        if m.memoria_pico_mb is not None:
+            _ultimo[('pipeline_paso_memoria_pico_bytes', labels)] = m.memoria_pico_mb * 1024 * 1024
+
+
+def prometheus():
+    """Acumulados en formato de texto de Prometheus"""
+    def linea(nombre, labels, valor):
+        etiquetas = ','.join(f'{k}="{v}"' for k, v in labels)
+        return f"{nombre}{{{etiquetas}}} {valor:g}" if etiquetas else f"{nombre} {valor:g}"
+
+    with _lock:
+        series = [(n, l, v, 'counter') for (n, l), v in _acumulado.items()]
+        series += [(n, l, v, 'gauge') for (n, l), v in _ultimo.items()]
+
+    lineas = []
+    tipos_emitidos = set()
+    for nombre, labels, valor, tipo in sorted(series, key=lambda s: (s[0], s[1])):
+        if nombre not in tipos_emitidos:
+            lineas.append(f"# TYPE {nombre} {tipo}")
+            tipos_emitidos.add(nombre)
+        lineas.append(linea(nombre, labels, valor))
+    return '\n'.join(lineas) + '\n'
+
+
+def describir(metricas):
+    """Texto corto para la UI: '1.2s (descarga 0.8s, match 0.3s) · 3 lecturas · 1 escrituras · 45 MB'"""
+    if not metricas:
+        return ''
+    fases = sorted(metricas['fases'].items(), key=lambda f: -f[1])
+    detalle = ', '.join(f"{nombre} {seg:.1f}s" for nombre, seg in fases if seg >= 0.05)
+    partes = [f"{metricas['segundos']:.1f}s" + (f" ({detalle})" if detalle else '')]
+    contadores = metricas['contadores']
+    if contadores.get('lecturas_sheets'):
+        partes.append(f"{contadores['lecturas_sheets']} lecturas, {contadores.get('filas_leidas', 0)} filas")
+    if contadores.get('escrituras_sheets'):
+        partes.append(f"{contadores['escrituras_sheets']} escrituras")
+    if metricas.get('memoria_pico_mb') is not None:
+        partes.append(f"{metricas['memoria_pico_mb']:.0f} MB pico")
+    return ' · '.join(partes)
@@ -0,0 +1,179 @@
+"""
+Normalización - Formas canónicas de patentes, CTGs, números de CPE, productos, nombres
+y fechas.
+Es la única definición que usan los procesos (app.py), el agente de autocompletado,
+las tablas de ids (claves.py) y DataLoader, para que los joins encuentren las mismas
+claves en todas las hojas.
+
+Cada normalización tiene su versión escalar y una por columna (pandas Series) que
+procesa la columna entera de una vez.
+"""
+
+import json
+import re
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+# Caracteres que se eliminan de una patente ('AB 123 CD', 'AB-123-CD', 'AB.123.CD')
+_SEPARADORES_PATENTE = str.maketrans('', '', ' -.')
+_SEPARADORES_PATENTE_RE = re.compile(r'[ .\-]')
+
+# Array de dominios de AFIP sin escapes: '["AB123CD","EF456GH"]'. Los demás (escapes con \, números,
+# JSON inválido) se resuelven con json.loads como siempre
+_ARRAY_SIMPLE = re.compile(r'\[\s*(?:"[^"\\]*"\s*(?:,\s*"[^"\\]*"\s*)*)?\]')
+_ELEMENTO_ARRAY = re.compile(r'"([^"]*)"')
+
+# Sinónimos de producto en orden de prioridad: si el texto nombra a más de uno, gana el primero
+SINONIMOS_PRODUCTO = [
+    ('soja', ('soja', 'soya')),
+    ('maiz', ('maiz', 'maíz')),
+    ('trigo', ('trigo',)),
+    ('girasol', ('girasol',)),
+    ('cebada', ('cebada',)),
+    ('sorgo', ('sorgo',)),
+]
+
+# Una rama por producto con un lookahead: la alternancia se prueba en orden desde el
+# comienzo del texto y el grupo que queda capturado (lastgroup) es el producto canónico
+_PRODUCTO = re.compile('|'.join(
+    f"(?=.*?(?:{'|'.join(map(re.escape, sinonimos))}))(?P<{canonico}>)"
+    for canonico, sinonimos in SINONIMOS_PRODUCTO
+), re.S)
+
+FORMATOS_FECHA = [
+    '%Y-%m-%d',
+    '%d/%m/%Y',
+    '%d-%m-%Y',
+    '%Y/%m/%d',
+    '%d/%m/%y',
+]
+
+
+def _texto(serie):
+    """Columna como texto, con '' en las celdas vacías"""
+    return serie.fillna('').astype(str)
+
+
+def normalizar_patente(patente):
+    """Normaliza patente eliminando espacios, guiones y puntos"""
+    if not patente:
+        return ''
+    return str(patente).strip().upper().translate(_SEPARADORES_PATENTE)
+
+
+def patentes_columna(serie):
+    """normalizar_patente sobre una columna"""
+    return _texto(serie).str.strip().str.upper().str.replace(_SEPARADORES_PATENTE_RE, '', regex=True)
+
+
+def extraer_patentes(valor):
+    """
+    Patentes normalizadas de una celda que puede ser:
+    - Un array JSON: '["ABC123","DEF456"]'
+    - Una patente simple: 'ABC 123'
+    """
+    if not valor:
+        return []
+    texto = str(valor).strip()
+    if not texto.startswith('['):
+        crudas = [texto]
+    elif _ARRAY_SIMPLE.fullmatch(texto):
+        crudas = _ELEMENTO_ARRAY.findall(texto)
+    else:
+        try:
+            crudas = json.loads(texto)
+        except json.JSONDecodeError:
+            crudas = re.findall(r'"([^"]+)"', texto)
+    return [p for p in map(normalizar_patente, crudas) if p]
+
+
+def extraer_patentes_columna(serie):
+    """
+    extraer_patentes sobre una columna: una tupla de patentes por celda. Los arrays de
+    dominios casi no se repiten, así que se resuelve una vez por valor distinto.
+    """
+    codigos, unicos = pd.factorize(_texto(serie))
+    por_unico = np.empty(len(unicos) + 1, dtype=object)
+    por_unico[:-1] = [tuple(extraer_patentes(u)) for u in unicos]
+    por_unico[-1] = ()
+    return pd.Series(por_unico[codigos], index=serie.index)
+
+
+def normalizar_ctg(ctg):
+    """Forma canónica de un CTG: sin espacios a los costados ni ceros a la izquierda"""
+    if not ctg:
+        return ''
+    return str(ctg).strip().lstrip('0')
+
+
+def ctgs_columna(serie):
+    """normalizar_ctg sobre una columna"""
+    return _texto(serie).str.strip().str.lstrip('0')
+
+
+def normalizar_cpe(cpe):
+    """Forma canónica de un número de CPE: en mayúsculas y sin espacios"""
+    if not cpe:
+        return ''
+    return str(cpe).strip().upper().replace(' ', '')
+
+
+def cpes_columna(serie):
+    """normalizar_cpe sobre una columna"""
+    return _texto(serie).str.strip().str.upper().str.replace(' ', '', regex=False)
+
+
+def normalizar_nombre(nombre):
+    """Nombre (transportista, chofer) para comparar: en mayúsculas y con un solo espacio entre palabras"""
+    if not nombre:
+        return ''
+    return ' '.join(str(nombre).upper().split())
+
+
+def nombres_columna(serie):
+    """normalizar_nombre sobre una columna"""
+    return _texto(serie).str.upper().str.split().str.join(' ')
+
+
+@lru_cache(maxsize=4096)
+def _producto(texto):
+    prod = texto.strip().lower()
+    m = _PRODUCTO.match(prod)
+    return m.lastgroup if m else prod
+
+
+def normalizar_producto(producto):
+    """Normaliza el nombre del producto para comparación (soja, maiz, trigo, etc)"""
+    if not producto:
+        return ''
+    return _producto(str(producto))
+
+
+def productos_columna(serie):
+    """normalizar_producto sobre una columna (se resuelve una vez por valor distinto)"""
+    codigos, unicos = pd.factorize(_texto(serie))
+    if not len(unicos):
+        return pd.Series('', index=serie.index, dtype=object)
+    return pd.Series(pd.Index(unicos).map(normalizar_producto).to_numpy()[codigos], index=serie.index)
+
+
+@lru_cache(maxsize=65536)
+def _fecha(texto):
+    for fmt in FORMATOS_FECHA:
+        try:
+            return datetime.strptime(texto, fmt).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    return texto
+
+
+def normalizar_fecha(fecha):
+    """Normaliza fecha a formato YYYY-MM-DD para comparación"""
+    if not fecha:
+        return ''
+    if isinstance(fecha, datetime):
+        return fecha.strftime('%Y-%m-%d')
+    return _fecha(str(fecha).strip())
@@ -0,0 +1,41 @@
+"""
+Registros - Tipos compactos para las filas de referencia que usan los procesos
+(app.py) y el agente de autocompletado (agent_autocomplete.py).
+
+Son tuplas con nombre: sin diccionario por fila y de solo lectura, así un mismo
+registro se puede indexar por CTG y por CPE a la vez. Los datos propios de un
+match (días de diferencia, candidatos) no se guardan en el registro.
+"""
+
+from typing import NamedTuple
+
+
+class CartaPorte(NamedTuple):
+    """Fila de la hoja CPE; cada proceso completa los campos que usa"""
+    numero_cpe: str = ''
+    ctg: str = ''
+    fecha: str = ''              # normalizada YYYY-MM-DD
+    grano_tipo: str = ''         # normalizado (normalizar_producto)
+    producto: str = ''           # tal como está en la hoja
+    transportista: str = ''
+    chofer: str = ''
+    origen: str = ''
+    destino: str = ''
+    id: int = -1                 # id del número de CPE en claves.Claves
+
+
+class Pesada(NamedTuple):
+    """Fila de Pesadas indexada por CPE"""
+    neto: str = ''
+    origen: str = ''
+    transportista: str = ''
+    chofer: str = ''
+    producto: str = ''
+
+
+class Descarga(NamedTuple):
+    """Fila de Descargas indexada por CTG y por CPE"""
+    peso_neto: str = ''
+    origen: str = ''
+    transportista: str = ''
+    producto: str = ''
@@ -0,0 +1,148 @@
+"""
+Cache Compartido - Snapshots de las hojas en un archivo SQLite que comparten
+todos los workers de gunicorn. Un lock de archivo por hoja hace que un solo
+worker descargue de Sheets (single-flight) y el resto lea el resultado.
+
+Cuando un worker escribe en una hoja publica el snapshot con las celdas escritas
+(o, si no puede, lo borra) y sube la generación de la hoja: los demás workers dejan
+de usar su copia local al verla y toman el publicado, o la releen de Sheets.
+
+Se activa con la variable de entorno SHARED_CACHE_PATH (ruta del .sqlite).
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: solo se sincronizan los hilos del proceso
+    fcntl = None
+
+RUTA = os.environ.get('SHARED_CACHE_PATH', '')
+
+# Segundos que un worker espera a que SQLite libere una escritura
+TIMEOUT_SQLITE = 30
+
+
+class CacheCompartido:
+    """Filas crudas por hoja con versión y fecha de actualización"""
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._locks_locales = {}
+        self._lock = threading.Lock()
+        with self._conectar() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS snapshots ('
+                ' clave TEXT PRIMARY KEY, version INTEGER, actualizado REAL, filas BLOB)'
+            )
+            conn.execute('CREATE TABLE IF NOT EXISTS invalidaciones (clave TEXT PRIMARY KEY, generacion INTEGER)')
+
+    @contextmanager
+    def _conectar(self):
+        conn = sqlite3.connect(self.ruta, timeout=TIMEOUT_SQLITE)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def meta(self, clave):
+        """(version, actualizado) de una hoja, o None si nunca se guardó"""
+        with self._conectar() as conn:
+            fila = conn.execute('SELECT version, actualizado FROM snapshots WHERE clave = ?',
+                                (clave,)).fetchone()
+        return fila
+
+    def leer(self, clave):
+        """(version, actualizado, filas) o None"""
+        with self._conectar() as conn:
+            fila = conn.execute('SELECT version, actualizado, filas FROM snapshots WHERE clave = ?',
+                                (clave,)).fetchone()
+        if fila is None:
+            return None
+        return fila[0], fila[1], json.loads(zlib.decompress(fila[2]))
+
+    def generacion(self, clave):
+        """Cantidad de veces que se invalidó una hoja (0 si nunca)"""
+        with self._conectar() as conn:
+            fila = conn.execute('SELECT generacion FROM invalidaciones WHERE clave = ?', (clave,)).fetchone()
+        return fila[0] if fila else 0
+
+    def invalidar(self, clave):
+        """Borra el snapshot de una hoja y sube su generación (alguien la escribió)"""
+        with self._conectar() as conn:
+            conn.execute('DELETE FROM snapshots WHERE clave = ?', (clave,))
+            conn.execute('INSERT INTO invalidaciones (clave, generacion) VALUES (?, 1) '
+                         'ON CONFLICT(clave) DO UPDATE SET generacion = generacion + 1', (clave,))
+
+    def escribir(self, clave, filas, generacion=None):
+        """
+        Guarda las filas y retorna la nueva versión. Si se pasa la `generacion` vigente
+        cuando empezó la descarga y la hoja se invalidó mientras tanto, no guarda nada
+        (las filas pueden ser anteriores a la escritura) y retorna None.
+        """
+        blob = zlib.compress(json.dumps(filas, ensure_ascii=False).encode('utf-8'), 1)
+        with self._conectar() as conn:
+            if generacion is not None:
+                actual = conn.execute('SELECT generacion FROM invalidaciones WHERE clave = ?', (clave,)).fetchone()
+                if (actual[0] if actual else 0) != generacion:
+                    return None
+            anterior = conn.execute('SELECT version FROM snapshots WHERE clave = ?', (clave,)).fetchone()
+            version = (anterior[0] if anterior else 0) + 1
+            conn.execute('INSERT OR REPLACE INTO snapshots (clave, version, actualizado, filas) '
+                         'VALUES (?, ?, ?, ?)', (clave, version, time.time(), blob))
+        return version
+
+    def publicar(self, clave, filas, generacion, version):
+        """
+        Reemplaza el snapshot de una hoja por el mismo con celdas recién escritas y sube
+        su generación, conservando la fecha de la descarga original. Solo si la hoja sigue
+        en esa `generacion` y `version` (nadie la invalidó ni publicó otra desde que se
+        leyó); si no, no guarda nada y retorna None. Retorna (version, generacion) nuevas.
+        """
+        blob = zlib.compress(json.dumps(filas, ensure_ascii=False).encode('utf-8'), 1)
+        with self._conectar() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            actual = conn.execute('SELECT generacion FROM invalidaciones WHERE clave = ?', (clave,)).fetchone()
+            anterior = conn.execute('SELECT version, actualizado FROM snapshots WHERE clave = ?', (clave,)).fetchone()
+            if (actual[0] if actual else 0) != generacion or anterior is None or anterior[0] != version:
+                return None
+            conn.execute('INSERT OR REPLACE INTO invalidaciones (clave, generacion) VALUES (?, ?)',
+                         (clave, generacion + 1))
+            conn.execute('INSERT OR REPLACE INTO snapshots (clave, version, actualizado, filas) '
+                         'VALUES (?, ?, ?, ?)', (clave, version + 1, anterior[1], blob))
+        return version + 1, generacion + 1
+
+    @contextmanager
+    def lock(self, clave):
+        """Lock exclusivo entre procesos (y entre hilos) para refrescar una hoja"""
+        with self._lock:
+            local = self._locks_locales.setdefault(clave, threading.Lock())
+        with local:
+            if fcntl is None:
+                yield
+                return
+            with open(f"{self.ruta}.{clave}.lock", 'w') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def crear_desde_entorno():
+    """CacheCompartido si SHARED_CACHE_PATH está configurado, si no None"""
+    if not RUTA:
+        return None
+    try:
+        return CacheCompartido(RUTA)
+    except Exception as e:
+        print(f"ADVERTENCIA: no se pudo abrir el cache compartido {RUTA}: {e}")
+        return None
@@ -0,0 +1,345 @@
+"""
+Backend de Hojas - Punto único para obtener el cliente de planillas.
+- 'gspread' (por defecto): Google Sheets real.
+- 'local': planillas en memoria cargadas desde CSV o SQLite, sin red ni credenciales,
+  con conteo de llamadas para benchmarks y pruebas.
+
+Se elige con la variable de entorno SHEETS_BACKEND; el backend local lee de
+SHEETS_LOCAL_PATH (un directorio <spreadsheet_id>/<hoja>.csv o un archivo .sqlite).
+
+leer_hojas() descarga en paralelo las hojas que necesita un paso, dentro del cupo de
+lecturas concurrentes del proceso (SHEETS_LECTURAS_CONCURRENTES).
+"""
+
+import csv
+import os
+import sqlite3
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import gspread
+from gspread.utils import a1_range_to_grid_range
+
+from metrics import fase, registrar_lectura
+
+BACKEND = os.environ.get('SHEETS_BACKEND', 'gspread')
+LOCAL_PATH = os.environ.get('SHEETS_LOCAL_PATH', os.path.join(os.path.dirname(__file__), 'fixtures'))
+
+# Requests de lectura a Sheets en vuelo a la vez en todo el proceso: la cuota de la API
+# es por minuto y por usuario, más paralelismo solo adelanta los errores 429
+MAX_LECTURAS_CONCURRENTES = int(os.environ.get('SHEETS_LECTURAS_CONCURRENTES', '4'))
+cupo_lecturas = threading.BoundedSemaphore(MAX_LECTURAS_CONCURRENTES)
+
+_cliente_local = None
+_lock = threading.Lock()
+
+
+def get_client(obtener_credenciales):
+    """
+    Devuelve el cliente según SHEETS_BACKEND. `obtener_credenciales` es la función
+    get_credentials de cada módulo; solo se llama con el backend gspread.
+    """
+    global _cliente_local
+    if BACKEND == 'local':
+        with _lock:
+            if _cliente_local is None:
+                _cliente_local = ClienteLocal.desde_ruta(LOCAL_PATH)
+            return _cliente_local
+    return gspread.authorize(obtener_credenciales())
+
+
+def usar_cliente_local(cliente):
+    """Fuerza el backend local con un cliente ya armado (benchmarks / pruebas)"""
+    global BACKEND, _cliente_local
+    BACKEND = 'local'
+    _cliente_local = cliente
+
+
+def leer_hojas(gc, pedidos):
+    """
+    Descarga en paralelo hojas independientes: pedidos = {nombre: (spreadsheet_id, titulo)}.
+    Retorna {nombre: (worksheet, filas)}. Cada spreadsheet se abre una sola vez y cada
+    request toma un lugar de cupo_lecturas, así el tiempo de E/S de un paso es el de
+    su hoja más lenta y no la suma de todas.
+    """
+    def abrir(spreadsheet_id):
+        with cupo_lecturas:
+            return gc.open_by_key(spreadsheet_id)
+
+    def leer(planilla, titulo):
+        with cupo_lecturas:
+            hoja = planilla.worksheet(titulo)
+        with cupo_lecturas:
+            return hoja, hoja.get_all_values()
+
+    ids = list(dict.fromkeys(ss_id for ss_id, _ in pedidos.values()))
+    with fase('descarga'):
+        with ThreadPoolExecutor(max(1, min(len(pedidos), MAX_LECTURAS_CONCURRENTES))) as pool:
+            planillas = dict(zip(ids, pool.map(abrir, ids)))
+            futuros = {nombre: pool.submit(leer, planillas[ss_id], titulo)
+                       for nombre, (ss_id, titulo) in pedidos.items()}
+            resultado = {nombre: futuro.result() for nombre, futuro in futuros.items()}
+
+    for _, filas in resultado.values():
+        registrar_lectura(filas)
+    return resultado
+
+
+def _rango_de(rango):
+    """'Hoja'!A1:B9 / A2:Z / A1 -> (fila_ini, col_ini, fila_fin, col_fin) base 0, fin exclusivo o None"""
+    if '!' in rango:
+        rango = rango.rsplit('!', 1)[1]
+    grid = a1_range_to_grid_range(rango)
+    return (grid.get('startRowIndex', 0), grid.get('startColumnIndex', 0),
+            grid.get('endRowIndex'), grid.get('endColumnIndex'))
+
+
+class HojaLocal:
+    """Worksheet en memoria con la parte de la API de gspread que usa el proyecto"""
+
+    # Las celdas se guardan como texto: no hay valores sin formato que pedir
+    VALORES_TIPADOS = False
+
+    def __init__(self, spreadsheet, id, title, filas):
+        self.spreadsheet = spreadsheet
+        self.id = id
+        self.title = title
+        self._filas = [list(map(str, f)) for f in filas]
+
+    @property
+    def spreadsheet_id(self):
+        return self.spreadsheet.id
+
+    @property
+    def row_count(self):
+        return len(self._filas)
+
+    @property
+    def col_count(self):
+        return max((len(f) for f in self._filas), default=0)
+
+    def _contar(self, metodo, celdas=0):
+        self.spreadsheet.cliente._contar(metodo, celdas)
+
+    # Lectura
+
+    def _leer(self, fila_ini, col_ini, fila_fin, col_fin):
+        ancho = self.col_count
+        fin_col = ancho if col_fin is None else col_fin
+        filas = self._filas[fila_ini:fila_fin]
+        resultado = []
+        for fila in filas:
+            fila = (fila + [''] * (fin_col - len(fila)))[col_ini:fin_col]
+            resultado.append(fila)
+        return resultado
+
+    def get_all_values(self, **kwargs):
+        self._contar('get_all_values')
+        return self._leer(0, 0, None, None)
+
+    def get(self, rango=None, **kwargs):
+        """Como gspread: recorta las celdas vacías al final de cada fila y las filas vacías al final"""
+        self._contar('get')
+        if rango is None:
+            valores = self._leer(0, 0, None, None)
+        else:
+            valores = self._leer(*_rango_de(rango))
+        valores = [self._recortar(f) for f in valores]
+        while valores and not valores[-1]:
+            valores.pop()
+        return valores
+
+    def batch_get(self, rangos, major_dimension=None, **kwargs):
+        """Como gspread: una sola llamada para varios rangos (los valores quedan como texto)"""
+        self._contar('batch_get')
+        resultado = []
+        for rango in rangos:
+            valores = [self._recortar(f) for f in self._leer(*_rango_de(rango))]
+            while valores and not valores[-1]:
+                valores.pop()
+            if major_dimension == 'COLUMNS':
+                ancho = max((len(f) for f in valores), default=0)
+                valores = [self._recortar([f[c] if c < len(f) else '' for f in valores]) for c in range(ancho)]
+            resultado.append(valores)
+        return resultado
+
+    @staticmethod
+    def _recortar(fila):
+        fin = len(fila)
+        while fin and fila[fin - 1] == '':
+            fin -= 1
+        return fila[:fin]
+
+    def row_values(self, fila, **kwargs):
+        self._contar('row_values')
+        return self._recortar(self._filas[fila - 1]) if fila <= len(self._filas) else []
+
+    # Escritura
+
+    def _escribir(self, fila_ini, col_ini, valores):
+        for i, fila_valores in enumerate(valores):
+            idx = fila_ini + i
+            while len(self._filas) <= idx:
+                self._filas.append([])
+            fila = self._filas[idx]
+            fin = col_ini + len(fila_valores)
+            if len(fila) < fin:
+                fila.extend([''] * (fin - len(fila)))
+            fila[col_ini:fin] = ['' if v is None else str(v) for v in fila_valores]
+        return sum(len(f) for f in valores)
+
+    def update(self, values=None, range_name=None, **kwargs):
+        # gspread acepta también update(rango, valores)
+        if isinstance(values, str):
+            values, range_name = range_name, values
+        if values and not isinstance(values[0], (list, tuple)):
+            values = [values]
+        fila_ini, col_ini, _, _ = _rango_de(range_name or 'A1')
+        self._contar('update', self._escribir(fila_ini, col_ini, values))
+
+    def update_cell(self, fila, col, valor):
+        self._contar('update_cell', self._escribir(fila - 1, col - 1, [[valor]]))
+
+    def batch_update(self, data, **kwargs):
+        celdas = 0
+        for item in data:
+            fila_ini, col_ini, _, _ = _rango_de(item['range'])
+            celdas += self._escribir(fila_ini, col_ini, item['values'])
+        self._contar('batch_update', celdas)
+
+    def format(self, rango, formato):
+        self._contar('format')
+
+    def batch_format(self, formatos):
+        self._contar('batch_format')
+
+
+class PlanillaLocal:
+    """Spreadsheet en memoria"""
+
+    def __init__(self, cliente, id):
+        self.cliente = cliente
+        self.id = id
+        self._hojas = {}
+
+    def agregar_hoja(self, titulo, filas):
+        hoja = HojaLocal(self, len(self._hojas), titulo, filas)
+        self._hojas[titulo] = hoja
+        return hoja
+
+    def worksheet(self, titulo):
+        self.cliente._contar('worksheet')
+        if titulo not in self._hojas:
+            raise gspread.exceptions.WorksheetNotFound(titulo)
+        return self._hojas[titulo]
+
+    def worksheets(self):
+        return list(self._hojas.values())
+
+    def _hoja_por_titulo(self, rango):
+        titulo = rango.rsplit('!', 1)[0]
+        if titulo.startswith("'") and titulo.endswith("'"):
+            titulo = titulo[1:-1].replace("''", "'")
+        return self._hojas[titulo]
+
+    def values_batch_update(self, body, **kwargs):
+        celdas = 0
+        for item in body.get('data', []):
+            fila_ini, col_ini, _, _ = _rango_de(item['range'])
+            celdas += self._hoja_por_titulo(item['range'])._escribir(fila_ini, col_ini, item['values'])
+        self.cliente._contar('values_batch_update', celdas)
+
+    def batch_update(self, body, **kwargs):
+        # Solo formatos (repeatCell); los valores no cambian
+        self.cliente._contar('spreadsheet_batch_update', len(body.get('requests', [])))
+
+
+class ClienteLocal:
+    """Reemplazo de gspread.Client para correr todo offline"""
+
+    def __init__(self):
+        self._planillas = {}
+        self.llamadas = Counter()
+        self.celdas_escritas = Counter()
+        self._lock = threading.Lock()
+
+    def _contar(self, metodo, celdas=0):
+        with self._lock:
+            self.llamadas[metodo] += 1
+            if celdas:
+                self.celdas_escritas[metodo] += celdas
+
+    def reiniciar_contadores(self):
+        self.llamadas.clear()
+        self.celdas_escritas.clear()
+
+    def contadores(self):
+        return {'llamadas': dict(self.llamadas), 'celdas_escritas': dict(self.celdas_escritas),
+                'total_llamadas': sum(self.llamadas.values())}
+
+    def agregar(self, spreadsheet_id, titulo, filas):
+        """Agrega (o reemplaza) una hoja con sus filas, encabezado incluido"""
+        planilla = self._planillas.setdefault(spreadsheet_id, PlanillaLocal(self, spreadsheet_id))
+        return planilla.agregar_hoja(titulo, filas)
+
+    def open_by_key(self, spreadsheet_id):
+        self._contar('open_by_key')
+        if spreadsheet_id not in self._planillas:
+            raise gspread.exceptions.SpreadsheetNotFound(spreadsheet_id)
+        return self._planillas[spreadsheet_id]
+
+    @classmethod
+    def desde_datos(cls, datos):
+        """datos: {spreadsheet_id: {titulo: [[fila], ...]}}"""
+        cliente = cls()
+        for ss_id, hojas in datos.items():
+            for titulo, filas in hojas.items():
+                cliente.agregar(ss_id, titulo, filas)
+        return cliente
+
+    @classmethod
+    def desde_ruta(cls, ruta):
+        """Carga un directorio de CSV (<spreadsheet_id>/<hoja>.csv) o un archivo SQLite"""
+        cliente = cls()
+        if ruta.endswith(('.sqlite', '.db')):
+            cliente._cargar_sqlite(ruta)
+        elif os.path.isdir(ruta):
+            for ss_id in sorted(os.listdir(ruta)):
+                carpeta = os.path.join(ruta, ss_id)
+                if not os.path.isdir(carpeta):
+                    continue
+                for archivo in sorted(os.listdir(carpeta)):
+                    if archivo.endswith('.csv'):
+                        with open(os.path.join(carpeta, archivo), newline='', encoding='utf-8') as f:
+                            cliente.agregar(ss_id, archivo[:-4], list(csv.reader(f)))
+        else:
+            raise FileNotFoundError(f"No existe la fuente local de planillas: {ruta}")
+        return cliente
+
+    def _cargar_sqlite(self, ruta):
+        # Tabla celdas(spreadsheet_id, hoja, fila, col, valor), fila y col base 1
+        conn = sqlite3.connect(ruta)
+        try:
+            filas_por_hoja = {}
+            for ss_id, hoja, fila, col, valor in conn.execute(
+                    'SELECT spreadsheet_id, hoja, fila, col, valor FROM celdas ORDER BY spreadsheet_id, hoja, fila, col'):
+                filas = filas_por_hoja.setdefault((ss_id, hoja), [])
+                while len(filas) < fila:
+                    filas.append([])
+                f = filas[fila - 1]
+                f.extend([''] * (col - len(f)))
+                f[col - 1] = '' if valor is None else str(valor)
+            for (ss_id, hoja), filas in filas_por_hoja.items():
+                self.agregar(ss_id, hoja, filas)
+        finally:
+            conn.close()
+
+    def guardar_csv(self, ruta):
+        """Escribe todas las hojas como <ruta>/<spreadsheet_id>/<hoja>.csv"""
+        for ss_id, planilla in self._planillas.items():
+            carpeta = os.path.join(ruta, ss_id)
+            os.makedirs(carpeta, exist_ok=True)
+            for hoja in planilla.worksheets():
+                with open(os.path.join(carpeta, f"{hoja.title}.csv"), 'w', newline='', encoding='utf-8') as f:
+                    csv.writer(f).writerows(hoja._filas)
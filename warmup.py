@@ -0,0 +1,98 @@
+"""
+Precalentamiento - Autentica, carga las hojas, arma los índices y renderiza
+las páginas del Dashboard antes de recibir tráfico, para que ningún usuario
+pague el arranque en frío. El estado se consulta en /ready.
+"""
+
+import threading
+import time
+from datetime import datetime
+
+from data_loader import data_loader
+from indice_revision import indice_revision
+
+_estado = {
+    'listo': False,
+    'estado': 'pendiente',
+    'inicio': None,
+    'segundos': None,
+    'pasos': [],
+    'error': None
+}
+_lock = threading.Lock()
+
+
+def _pasos():
+    """(nombre, función) en el orden en que se calientan"""
+    from app import columnas_fletes_esperadas
+    from dashboard import (get_dashboard_content, get_procesadores_content, get_trabajo_manual_content,
+                           get_explorar_content)
+
+    return [
+        ('autenticacion', data_loader._get_client),
+        ('fletes', data_loader.get_fletes),
+        ('pesadas', data_loader.get_pesadas),
+        ('descargas', data_loader.get_descargas),
+        ('cpe', data_loader.get_cpe),
+        ('columnas_fletes', lambda: data_loader.columnas('fletes', esperadas=columnas_fletes_esperadas())),
+        ('indice_revision', indice_revision.casos),
+        ('layout_dashboard', get_dashboard_content),
+        ('layout_procesadores', get_procesadores_content),
+        ('layout_trabajo_manual', get_trabajo_manual_content),
+        ('layout_explorar', get_explorar_content),
+    ]
+
+
+def calentar():
+    """
+    Corre todos los pasos. Un paso que falla no frena a los demás: el servicio queda
+    'degradado' pero listo, para que un problema con Sheets no bloquee el deploy.
+    """
+    with _lock:
+        _estado.update({'listo': False, 'estado': 'calentando', 'pasos': [], 'error': None,
+                        'inicio': datetime.now().isoformat(timespec='seconds')})
+
+    inicio = time.perf_counter()
+    errores = []
+    for nombre, funcion in _pasos():
+        t0 = time.perf_counter()
+        try:
+            funcion()
+            resultado = {'paso': nombre, 'segundos': round(time.perf_counter() - t0, 3), 'ok': True}
+        except Exception as e:
+            errores.append(f"{nombre}: {e}")
+            resultado = {'paso': nombre, 'segundos': round(time.perf_counter() - t0, 3), 'ok': False,
+                         'error': str(e)}
+        print(f"Warm-up {nombre}: {resultado['segundos']}s{'' if resultado['ok'] else ' (error)'}")
+        with _lock:
+            _estado['pasos'].append(resultado)
+
+    with _lock:
+        _estado.update({
+            'listo': True,
+            'estado': 'degradado' if errores else 'ok',
+            'segundos': round(time.perf_counter() - inicio, 3),
+            'error': '; '.join(errores) or None
+        })
+    return estado()
+
+
+def calentar_en_segundo_plano():
+    """Para el servidor de desarrollo: calienta sin demorar el arranque"""
+    hilo = threading.Thread(target=calentar, name='warmup', daemon=True)
+    hilo.start()
+    return hilo
+
+
+def reiniciar_clientes():
+    """
+    Después de un fork: los DataFrames y snapshots se heredan, pero las conexiones
+    HTTP del cliente de Sheets no se comparten entre procesos.
+    """
+    data_loader.gc = None
+    data_loader._worksheets = {}
+
+
+def estado():
+    with _lock:
+        return dict(_estado, pasos=list(_estado['pasos']))
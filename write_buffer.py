@@ -0,0 +1,229 @@
+"""
+Buffer de Escrituras - Junta las escrituras de una corrida del pipeline
+y las aplica en la menor cantidad posible de llamadas a la API de Sheets.
+"""
+
+import json
+import gspread
+
+from metrics import fase, contar
+
+# Tamaño máximo aproximado (en bytes) del payload de cada request
+MAX_PAYLOAD_BYTES = 2 * 1024 * 1024
+
+
+class WriteBuffer:
+    """
+    Acumula valores y formatos de celdas de una o varias hojas.
+    - Deduplica: si una celda se escribe dos veces, queda el último valor.
+    - Agrupa celdas verticalmente contiguas de una misma columna en un solo rango.
+    - Envía una request de valores y una de formatos por spreadsheet
+      (partidas si superan MAX_PAYLOAD_BYTES).
+    """
+
+    def __init__(self, max_payload=MAX_PAYLOAD_BYTES):
+        self.max_payload = max_payload
+        self._hojas = {}     # clave -> worksheet
+        self._valores = {}   # clave -> {(fila, col): valor}
+        self._formatos = {}  # clave -> {(fila, col): formato}
+
+    def _clave(self, hoja):
+        clave = (hoja.spreadsheet_id, hoja.id)
+        self._hojas.setdefault(clave, hoja)
+        return clave
+
+    def escribir(self, hoja, fila, col, valor):
+        """Agrega un valor a escribir (fila y columna base 1)"""
+        self._valores.setdefault(self._clave(hoja), {})[(fila, col)] = valor
+
+    def formatear(self, hoja, fila, col, formato):
+        """Agrega un formato de celda (mismo dict que acepta gspread.format)"""
+        self._formatos.setdefault(self._clave(hoja), {})[(fila, col)] = formato
+
+    def pendientes(self):
+        """Cantidad de celdas pendientes (valores + formatos)"""
+        return (sum(len(v) for v in self._valores.values()) +
+                sum(len(f) for f in self._formatos.values()))
+
+    def superponer(self, hoja, datos):
+        """
+        Aplica sobre `datos` (resultado de get_all_values) los valores pendientes
+        de esa hoja, para que un paso posterior vea lo que escribió uno anterior
+        aunque todavía no se haya hecho flush.
+        """
+        pendientes = self._valores.get((hoja.spreadsheet_id, hoja.id))
+        if not pendientes:
+            return datos
+
+        for (fila, col), valor in pendientes.items():
+            while len(datos) < fila:
+                datos.append([])
+            fila_datos = datos[fila - 1]
+            if len(fila_datos) < col:
+                fila_datos.extend([''] * (col - len(fila_datos)))
+            fila_datos[col - 1] = valor
+
+        return datos
+
+    @staticmethod
+    def _tramos(celdas):
+        """
+        Agrupa {(fila, col): x} en tramos verticales contiguos.
+        Retorna lista de (col, fila_inicio, [x, ...]).
+        """
+        por_columna = {}
+        for (fila, col), x in celdas.items():
+            por_columna.setdefault(col, []).append((fila, x))
+
+        tramos = []
+        for col in sorted(por_columna):
+            filas = sorted(por_columna[col], key=lambda t: t[0])
+            inicio, anterior, items = filas[0][0], filas[0][0], [filas[0][1]]
+            for fila, x in filas[1:]:
+                if fila == anterior + 1:
+                    items.append(x)
+                else:
+                    tramos.append((col, inicio, items))
+                    inicio, items = fila, [x]
+                anterior = fila
+            tramos.append((col, inicio, items))
+        return tramos
+
+    def _partir(self, elementos):
+        """Divide una lista de elementos en grupos que no superen max_payload"""
+        grupos, actual, tamanio = [], [], 0
+        for elem in elementos:
+            peso = len(json.dumps(elem))
+            if actual and tamanio + peso > self.max_payload:
+                grupos.append(actual)
+                actual, tamanio = [], 0
+            actual.append(elem)
+            tamanio += peso
+        if actual:
+            grupos.append(actual)
+        return grupos
+
+    def planificar(self):
+        """
+        Arma las requests a enviar, agrupadas por spreadsheet.
+        Retorna lista de (spreadsheet, tipo, body) con tipo 'valores' o 'formatos'.
+        """
+        data_por_ss = {}
+        formatos_por_ss = {}
+        spreadsheets = {}
+
+        for clave, celdas in self._valores.items():
+            hoja = self._hojas[clave]
+            spreadsheets[clave[0]] = hoja.spreadsheet
+            for col, inicio, valores in self._tramos(celdas):
+                fin = inicio + len(valores) - 1
+                rango = gspread.utils.rowcol_to_a1(inicio, col)
+                if fin > inicio:
+                    rango += ':' + gspread.utils.rowcol_to_a1(fin, col)
+                titulo = hoja.title.replace("'", "''")
+                data_por_ss.setdefault(clave[0], []).append({
+                    'range': f"'{titulo}'!{rango}",
+                    'values': [[v] for v in valores]
+                })
+
+        for clave, celdas in self._formatos.items():
+            hoja = self._hojas[clave]
+            spreadsheets[clave[0]] = hoja.spreadsheet
+            for col, inicio, formatos in self._tramos(celdas):
+                # Dentro de un tramo contiguo, cortar cada vez que cambia el formato
+                desde = 0
+                for i in range(1, len(formatos) + 1):
+                    if i < len(formatos) and formatos[i] == formatos[desde]:
+                        continue
+                    formato = formatos[desde]
+                    formatos_por_ss.setdefault(clave[0], []).append({
+                        'repeatCell': {
+                            'range': {
+                                'sheetId': hoja.id,
+                                'startRowIndex': inicio + desde - 1,
+                                'endRowIndex': inicio + i - 1,
+                                'startColumnIndex': col - 1,
+                                'endColumnIndex': col
+                            },
+                            'cell': {'userEnteredFormat': formato},
+                            'fields': 'userEnteredFormat(%s)' % ','.join(formato.keys())
+                        }
+                    })
+                    desde = i
+
+        plan = []
+        for ss_id, data in data_por_ss.items():
+            for grupo in self._partir(data):
+                plan.append((spreadsheets[ss_id], 'valores', {'valueInputOption': 'RAW', 'data': grupo}))
+        for ss_id, requests in formatos_por_ss.items():
+            for grupo in self._partir(requests):
+                plan.append((spreadsheets[ss_id], 'formatos', {'requests': grupo}))
+
+        return plan
+
+    def _actualizar_snapshots(self, completo):
+        """
+        Lleva los valores escritos a los snapshots de DataLoader (son ediciones en filas
+        viejas que un refresco leyendo solo la cola no vería). Si el flush terminó se
+        aplican las celdas al snapshot, que queda con versión nueva sin releer la hoja; si
+        falló a mitad de camino, o no se pudo aplicar, se invalida y se relee completa.
+        """
+        from data_loader import data_loader
+
+        for clave, celdas in self._valores.items():
+            hoja = self._hojas[clave]
+            cache_key = data_loader.clave_hoja(hoja.spreadsheet_id, hoja.title)
+            if cache_key is None:
+                continue
+            try:
+                aplicadas = completo and data_loader.aplicar_celdas(cache_key, celdas)
+            except Exception as e:
+                print(f"ADVERTENCIA [{hoja.title}]: no se pudieron aplicar las celdas escritas al snapshot: {e}")
+                aplicadas = False
+            if not aplicadas:
+                data_loader.invalidar(cache_key)
+
+    def flush(self, dry_run=False, progreso=None):
+        """
+        Envía todo lo pendiente. Los errores de valores se propagan; los de formato
+        se devuelven en 'errores_formato' (el formato es solo visual).
+        Con dry_run=True no escribe nada: imprime y retorna la cantidad de requests planeadas.
+        Si se pasa `progreso`, se llama progreso(hechas, total) después de cada request.
+        """
+        plan = self.planificar()
+        resumen = {
+            'requests': len(plan),
+            'rangos': sum(len(body.get('data', body.get('requests', []))) for _, _, body in plan),
+            'celdas': self.pendientes(),
+            'errores_formato': []
+        }
+
+        if dry_run:
+            print(f"WriteBuffer (dry-run): {resumen['celdas']} celdas en {resumen['rangos']} rangos, "
+                  f"{resumen['requests']} requests")
+            return resumen
+
+        contar('celdas_escritas', resumen['celdas'])
+        completo = False
+        try:
+            for hechas, (ss, tipo, body) in enumerate(plan, start=1):
+                if tipo == 'valores':
+                    with fase('escritura'):
+                        ss.values_batch_update(body)
+                else:
+                    try:
+                        with fase('formato'):
+                            ss.batch_update(body)
+                    except Exception as e:
+                        resumen['errores_formato'].append(str(e))
+                contar('escrituras_sheets')
+                if progreso:
+                    progreso(hechas, len(plan))
+            completo = True
+        finally:
+            # Aunque falle a mitad de camino, parte de las celdas pudo haberse escrito
+            self._actualizar_snapshots(completo)
+
+        self._valores = {}
+        self._formatos = {}
+        return resumen